@@ -1,16 +1,26 @@
 from litestar.types import ControllerRouterHandler
 
-from .auth.controllers import AuthAdminController, AuthController
-from .cidr.controllers import CidrController
+from app.lib.settings import get_settings
+
+from .auth.controllers import ApiKeyController, AuthAdminController, AuthController
+from .cidr.controllers import CidrController, CidrLookupController
 from .lists.controllers import ListController
+from .metrics.controllers import MetricsController
 from .web.controllers import WebController, WebPartCidrController, WebPartListController
 
+settings = get_settings()
+
 routes: list[ControllerRouterHandler] = [
     CidrController,
+    CidrLookupController,
     ListController,
     AuthController,
     AuthAdminController,
+    ApiKeyController,
     WebController,
     WebPartListController,
     WebPartCidrController,
 ]
+
+if settings.METRICS_ENABLED:
+    routes.append(MetricsController)
@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import hmac
+import secrets
+import time
+from uuid import UUID, uuid4
+
+from asyncpg import Record
+from asyncpg.pool import PoolConnectionProxy
+from litestar.connection import ASGIConnection
+from litestar.exceptions import PermissionDeniedException
+
+from app.domain.auth.schemas import ApiKey, ApiKeyCreate, ApiKeyCreated, User
+from app.domain.lists.schemas import ListTypeEnum
+from app.lib.db.base import get_dbmanager
+from app.lib.settings import get_settings
+
+settings = get_settings()
+
+API_KEY_PREFIX = "cidr_"
+API_KEY_PREFIX_LENGTH = len(API_KEY_PREFIX) + 6
+
+# the API keys can't manage the users nor other API keys, even the ones of a superuser
+MANAGEMENT_PATH_PREFIXES = ("/v1/key", "/v1/admin")
+
+# requests that don't change anything besides the safe methods
+READ_ONLY_PATHS = frozenset(("/v1/cidr/match",))
+
+# endpoints filtering by the query parameter list_type, the only ones allowed with it for
+# the keys restricted to a list type besides the ones checking the type of each list
+LIST_TYPE_PARAMETER_PATHS = frozenset(
+    (
+        "/v1/cidr",
+        "/v1/cidr/",
+        "/v1/cidr/collapsed",
+        "/v1/cidr/collapsed/by-ip-version",
+        "/v1/cidr/changes",
+        "/v1/cidr/overlaps",
+    )
+)
+LIST_TYPE_CHECKED_PATHS = frozenset(("/v1/cidr/lookup", "/v1/cidr/match"))
+
+INSERT_API_KEY = """
+insert into api_key
+    (id, user_id, name, key_prefix, key_hash, read_only, list_type)
+values
+    ($1, $2, $3, $4, $5, $6, $7)
+returning id, name, key_prefix, read_only, list_type::text as list_type, created_at
+"""
+
+SELECT_API_KEYS_BY_USER = """
+select id, name, key_prefix, read_only, list_type::text as list_type, created_at
+from api_key
+where user_id = $1
+order by created_at
+"""
+
+DELETE_API_KEY = """
+delete from api_key where id = $1 and user_id = $2 returning key_hash
+"""
+
+SELECT_API_KEY_USERS = """
+select
+ k.key_hash, k.id, k.name, k.key_prefix, k.read_only, k.list_type::text as list_type, k.created_at,
+ u.id as user_id, u.login, u.role::text as role
+from api_key k
+join user_login u on u.id = k.user_id
+"""
+
+SELECT_API_KEY_USER_BY_HASH = SELECT_API_KEY_USERS + "where k.key_hash = $1"
+
+
+def hash_api_key(key: str) -> str:
+    """Get the HMAC-SHA256 of an API key, keyed with ``API_KEY_SECRET``."""
+    secret = settings.API_KEY_SECRET or settings.JWT_SECRET
+    return hmac.new(secret.encode(), key.encode(), hashlib.sha256).hexdigest()
+
+
+def _to_key_user(record: Record) -> tuple[ApiKey, User]:
+    api_key = ApiKey(**{k: record[k] for k in ApiKey.__struct_fields__})
+    user = User(login=record["login"], salt="", hashed_password="", id=record["user_id"], role=record["role"])
+    return api_key, user
+
+
+class ApiKeyIndex:
+    """API keys and their users by the hash of the key, read again every ``API_KEY_REFRESH_SECONDS``.
+
+    Authenticating a known key is a dict lookup, the deleted keys are rejected by other
+    processes after the next refresh at most.
+    """
+
+    __slots__ = ("keys", "lock", "refreshed_at")
+
+    def __init__(self) -> None:  # noqa: D107
+        self.keys: dict[str, tuple[ApiKey, User]] = {}
+        self.refreshed_at = float("-inf")
+        self.lock = asyncio.Lock()
+
+    async def get(self, key_hash: str) -> tuple[ApiKey, User] | None:
+        """Get the API key and its user from the index, ``None`` if it's not there."""
+        if time.monotonic() - self.refreshed_at > settings.API_KEY_REFRESH_SECONDS:
+            async with self.lock:
+                if time.monotonic() - self.refreshed_at > settings.API_KEY_REFRESH_SECONDS:
+                    async for conn in get_dbmanager().get_connection():
+                        records = await conn.fetch(SELECT_API_KEY_USERS)
+                    self.keys = {record["key_hash"]: _to_key_user(record) for record in records}
+                    self.refreshed_at = time.monotonic()
+        return self.keys.get(key_hash)
+
+    async def lookup(self, key_hash: str) -> tuple[ApiKey, User] | None:
+        """Read a key missing from the index, created after the last refresh, ``None`` if it doesn't exist."""
+        record = None
+        async for conn in get_dbmanager().get_connection():
+            record = await conn.fetchrow(SELECT_API_KEY_USER_BY_HASH, key_hash)
+        if record is None:
+            return None
+        key_user = self.keys[key_hash] = _to_key_user(record)
+        return key_user
+
+
+api_key_index = ApiKeyIndex()
+
+
+def check_api_key_scope(connection: ASGIConnection, api_key: ApiKey) -> None:
+    """Raise ``PermissionDeniedException`` if the request is out of the scopes of the API key.
+
+    The API keys can't be used to manage users nor API keys, nor in the web UI. Keys restricted to
+    a list type can only be used in the endpoints filtering by the query parameter ``list_type``,
+    which must match, and in the ones checking the type of the lists with ``check_list_type_scope``.
+    """
+    path = connection.url.path
+    if not path.startswith("/v1/") or path.startswith(MANAGEMENT_PATH_PREFIXES):
+        raise PermissionDeniedException("API keys can't be used here.")
+    if api_key.read_only and connection.scope["method"] not in ("GET", "HEAD") and path not in READ_ONLY_PATHS:
+        raise PermissionDeniedException("Read only API key.")
+    if not api_key.list_type or path.startswith("/v1/list") or path in LIST_TYPE_CHECKED_PATHS:
+        return
+    if path not in LIST_TYPE_PARAMETER_PATHS or connection.query_params.get("list_type") != api_key.list_type:
+        raise PermissionDeniedException(f"API key restricted to the list_type {api_key.list_type}.")
+
+
+def get_list_type_scope(connection: ASGIConnection) -> ListTypeEnum | None:
+    """Get the list type the request is restricted to by its API key, ``None`` if it isn't."""
+    auth = connection.scope.get("auth")
+    return auth.list_type if isinstance(auth, ApiKey) else None
+
+
+def check_list_type_scope(connection: ASGIConnection, *list_types: str) -> None:
+    """Raise ``PermissionDeniedException`` if the API key of the request is restricted to another list type."""
+    scope = get_list_type_scope(connection)
+    if scope is not None and any(list_type != scope for list_type in list_types):
+        raise PermissionDeniedException(f"API key restricted to the list_type {scope}.")
+
+
+async def create_api_key(conn: PoolConnectionProxy, user_id: UUID, data: ApiKeyCreate) -> ApiKeyCreated:
+    """Create an API key, the key is returned only here."""
+    key = API_KEY_PREFIX + secrets.token_urlsafe(32)
+    record = await conn.fetchrow(
+        INSERT_API_KEY,
+        uuid4(),
+        user_id,
+        data.name,
+        key[:API_KEY_PREFIX_LENGTH],
+        hash_api_key(key),
+        data.read_only,
+        data.list_type,
+    )
+    return ApiKeyCreated(**record, key=key)
+
+
+async def get_api_keys(conn: PoolConnectionProxy, user_id: UUID) -> list[ApiKey]:
+    """Get the API keys of the user."""
+    return [ApiKey(**record) for record in await conn.fetch(SELECT_API_KEYS_BY_USER, user_id)]
+
+
+async def delete_api_key(conn: PoolConnectionProxy, user_id: UUID, key_id: UUID) -> bool:
+    """Delete an API key of the user, return ``False`` if it doesn't exist."""
+    key_hash = await conn.fetchval(DELETE_API_KEY, key_id, user_id)
+    if key_hash is None:
+        return False
+    api_key_index.keys.pop(key_hash, None)
+    return True
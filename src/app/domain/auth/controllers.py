@@ -1,13 +1,18 @@
+from uuid import UUID
+
 from asyncpg.pool import PoolConnectionProxy
-from litestar import Request, Response, post, put
+from litestar import Request, Response, delete, get, post, put
 from litestar.controller import Controller
 from litestar.datastructures import ResponseHeader, State
-from litestar.exceptions import HTTPException, InternalServerException, NotAuthorizedException, ValidationException
-from litestar.status_codes import HTTP_200_OK, HTTP_400_BAD_REQUEST
+from litestar.exceptions import (HTTPException, InternalServerException, NotAuthorizedException, NotFoundException,
+                                 ValidationException)
+from litestar.status_codes import HTTP_200_OK, HTTP_201_CREATED, HTTP_400_BAD_REQUEST
 
-from app.domain.auth.schemas import (Token, TokenResponse, User, UserChangePassword, UserLoginOrCreate, UserReadDTO,
-                                     UserRoleEnum)
-from app.domain.auth.services import generate_token
+from app.domain.auth.api_keys import create_api_key, delete_api_key, get_api_keys
+from app.domain.auth.epochs import token_epochs
+from app.domain.auth.schemas import (ApiKey, ApiKeyCreate, ApiKeyCreated, Token, TokenResponse, User,
+                                     UserChangePassword, UserLoginOrCreate, UserReadDTO, UserRoleEnum)
+from app.domain.auth.services import UPDATE_USER_PASSWORD, generate_token
 from app.lib.authcrypt import generate_salt_and_hashed_password
 from app.lib.settings import get_settings
 
@@ -58,14 +63,11 @@ class AuthController(Controller):
         _ = await generate_token(conn=conn, data=user_login)
         # change the password
         salt, hashed_password = await generate_salt_and_hashed_password(plain_password=data.new_password)
-        _id = await conn.fetchval(
-            "update user_login set salt = $1, hashed_password = $2 where login = $3 returning id",
-            salt,
-            hashed_password,
-            data.login,
-        )
-        if not _id:
+        # the tokens issued before are revoked
+        updated = await conn.fetchrow(UPDATE_USER_PASSWORD, data.login, salt, hashed_password)
+        if not updated:
             raise InternalServerException("Password couldn't be updated.")
+        token_epochs.set(updated["id"], updated["token_epoch"])
 
     @post(
         "/token",
@@ -79,3 +81,36 @@ class AuthController(Controller):
             token,
             headers=[ResponseHeader(name="Authorization", value=f"Bearer {token.access_token}", description="Token")],
         )
+
+
+class ApiKeyController(Controller):
+    path = "/v1/key"
+    tags = ["API keys"]
+
+    @post("/", status_code=HTTP_201_CREATED)
+    async def create_api_key(
+        self, request: Request[User, Token, State], conn: PoolConnectionProxy, data: ApiKeyCreate
+    ) -> ApiKeyCreated:
+        """Create an API key for machine clients.
+
+        - Use it like a token: `Authorization: Bearer <KEY>`, it doesn't expire.
+
+        - The `key` is only returned here, store it safely.
+
+        - `read_only` keys can only read, keys with a `list_type` can only be used with that
+        `list_type` as query parameter.
+        """
+        return await create_api_key(conn=conn, user_id=request.user.id, data=data)
+
+    @get("/")
+    async def get_api_keys(self, request: Request[User, Token, State], conn: PoolConnectionProxy) -> list[ApiKey]:
+        """Get the API keys, without the keys."""
+        return await get_api_keys(conn=conn, user_id=request.user.id)
+
+    @delete("/{key_id:uuid}")
+    async def delete_api_key(
+        self, request: Request[User, Token, State], conn: PoolConnectionProxy, key_id: UUID
+    ) -> None:
+        """Delete an API key, it's rejected by all the processes within a few seconds."""
+        if not await delete_api_key(conn=conn, user_id=request.user.id, key_id=key_id):
+            raise NotFoundException(f"API key {key_id} not found.")
@@ -0,0 +1,59 @@
+import asyncio
+import time
+from uuid import UUID
+
+from app.lib.db.base import get_dbmanager
+from app.lib.settings import get_settings
+
+settings = get_settings()
+
+SELECT_TOKEN_EPOCHS = """
+select id, token_epoch from user_login
+"""  # noqa:S105
+
+SELECT_TOKEN_EPOCH = """
+select token_epoch from user_login where id = $1
+"""  # noqa:S105
+
+
+class TokenEpochs:
+    """Token epoch of every user, read again every ``AUTH_EPOCH_REFRESH_SECONDS``.
+
+    Tokens issued before the current epoch of their user are revoked, other processes
+    see an epoch bumped by this one after the next refresh at most.
+    """
+
+    __slots__ = ("epochs", "lock", "refreshed_at")
+
+    def __init__(self) -> None:  # noqa: D107
+        self.epochs: dict[UUID, int] = {}
+        self.refreshed_at = float("-inf")
+        self.lock = asyncio.Lock()
+
+    async def get(self, user_id: UUID) -> int | None:
+        """Get the token epoch of the user, ``None`` if the user doesn't exist.
+
+        Users created after the last refresh are read alone.
+        """
+        if time.monotonic() - self.refreshed_at > settings.AUTH_EPOCH_REFRESH_SECONDS:
+            async with self.lock:
+                if time.monotonic() - self.refreshed_at > settings.AUTH_EPOCH_REFRESH_SECONDS:
+                    async for conn in get_dbmanager().get_connection():
+                        records = await conn.fetch(SELECT_TOKEN_EPOCHS)
+                    self.epochs = {record["id"]: record["token_epoch"] for record in records}
+                    self.refreshed_at = time.monotonic()
+        if user_id not in self.epochs:
+            epoch = None
+            async for conn in get_dbmanager().get_connection():
+                epoch = await conn.fetchval(SELECT_TOKEN_EPOCH, user_id)
+            if epoch is not None:
+                self.epochs[user_id] = epoch
+            return epoch
+        return self.epochs[user_id]
+
+    def set(self, user_id: UUID, epoch: int) -> None:
+        """Set the epoch of a user changed by this process, so it's seen before the next refresh."""
+        self.epochs[user_id] = epoch
+
+
+token_epochs = TokenEpochs()
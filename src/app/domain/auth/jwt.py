@@ -4,9 +4,9 @@ from uuid import UUID
 import jwt
 from jwt import PyJWTError
 from litestar.exceptions import NotAuthorizedException
-from msgspec import to_builtins
+from msgspec import ValidationError, convert, to_builtins
 
-from app.domain.auth.schemas import Token, TokenResponse
+from app.domain.auth.schemas import Token, TokenResponse, UserRoleEnum
 from app.lib.settings import get_settings
 
 settings = get_settings()
@@ -20,19 +20,27 @@ def decode_jwt_token(encoded_token: str) -> Token:
     """
     try:
         payload = jwt.decode(jwt=encoded_token, key=settings.JWT_SECRET, algorithms=[settings.ALGORITHM])
-        return Token(**payload)
-    except PyJWTError as e:
+        return convert(payload, Token)
+    except (PyJWTError, ValidationError) as e:
         raise NotAuthorizedException("Invalid token") from e
 
 
-def encode_jwt_token(user_id: UUID, login: str, expiration: int = settings.DEFAULT_TOKEN_TTL_SECONDS) -> TokenResponse:
-    """Encode JWT token with expiration and a given user_id."""
+def encode_jwt_token(
+    user_id: UUID,
+    login: str,
+    role: UserRoleEnum,
+    epoch: int,
+    expiration: int = settings.DEFAULT_TOKEN_TTL_SECONDS,
+) -> TokenResponse:
+    """Encode JWT token with expiration and a given user_id, role and token epoch."""
     expires_at = datetime.now(tz=timezone.utc) + timedelta(seconds=expiration)
     token = Token(
         exp=expires_at,
         iat=datetime.now(tz=timezone.utc),
         sub=user_id,
         login=login,
+        role=role,
+        epoch=epoch,
     )
     token_encoded_str = jwt.encode(to_builtins(token), settings.JWT_SECRET, algorithm=settings.ALGORITHM)
     return TokenResponse(access_token=token_encoded_str, expires_in=expiration, expires_at=expires_at)
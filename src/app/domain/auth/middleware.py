@@ -1,55 +1,152 @@
+import time
+from datetime import datetime
+from functools import lru_cache
+from hashlib import sha256
+
 import msgspec
 from litestar.connection import ASGIConnection
 from litestar.exceptions import NotAuthorizedException
 from litestar.middleware import AbstractAuthenticationMiddleware, AuthenticationResult
-from litestar.stores.memory import MemoryStore
+from litestar.stores.base import Store
 
+from app.domain.auth.api_keys import API_KEY_PREFIX, api_key_index, check_api_key_scope, hash_api_key
+from app.domain.auth.epochs import token_epochs
 from app.domain.auth.jwt import decode_jwt_token
-from app.domain.auth.schemas import TokenUser, User
+from app.domain.auth.schemas import Token, TokenUser, User
 from app.lib.db.base import get_dbmanager
+from app.lib.lru_store import BoundedFileStore, LRUMemoryStore
 from app.lib.settings import get_settings
 
 settings = get_settings()
 
 store_encoder = msgspec.msgpack.Encoder()
 store_decoder = msgspec.msgpack.Decoder(type=TokenUser)
-store = MemoryStore()
+
+# cached value of the tokens that failed, so they're rejected without decoding them again
+INVALID_TOKEN = b""
+
+
+@lru_cache
+def get_auth_store() -> Store:
+    """Get the store of the authentication results.
+
+    A file store in ``AUTH_CACHE_PATH`` is shared by the processes of the host, else each one
+    keeps the last ``AUTH_CACHE_MAX_SIZE`` results in memory. Both are bounded to about
+    ``AUTH_CACHE_MAX_SIZE`` values.
+    """
+    if settings.AUTH_CACHE_PATH:
+        return BoundedFileStore(
+            settings.AUTH_CACHE_PATH, max_size=settings.AUTH_CACHE_MAX_SIZE, create_directories=True
+        )
+    return LRUMemoryStore(max_size=settings.AUTH_CACHE_MAX_SIZE)
+
+
+@lru_cache
+def get_invalid_token_store() -> Store:
+    """Get the store of the tokens that failed.
+
+    It's always in memory, so random tokens don't reach the disk, and apart from the
+    authentication results, so a spray of invalid tokens can't evict the valid ones.
+    """
+    return LRUMemoryStore(max_size=settings.AUTH_CACHE_INVALID_MAX_SIZE)
+
+
+def get_request_token(connection: ASGIConnection) -> str:
+    """Get the token of the request from the ``Authorization`` header or the API key cookie."""
+    if not (auth_header := connection.headers.get("Authorization")):
+        if not (cookie_header := connection.cookies.get(settings.API_KEY_COOKIE)):
+            raise NotAuthorizedException()
+        auth_header = f"Bearer {cookie_header}"
+
+    auth_header = auth_header.strip()
+    if not auth_header.startswith("Bearer"):
+        raise NotAuthorizedException("Invalid token, should be: 'Bearer <TOKEN>'")
+    try:
+        return auth_header.split(" ", 1)[1]
+    except IndexError:
+        raise NotAuthorizedException(  # noqa: B904
+            "Invalid token, should be: 'Bearer <TOKEN>' without extra spaces between 'Bearer' and '<TOKEN>'"
+        )
+
+
+async def load_user(token: Token) -> User | None:
+    """Get the user of a token, ``None`` if it doesn't exist or the token was revoked.
+
+    With ``AUTH_TRUST_TOKEN_CLAIMS`` the user comes from the claims, only the old tokens
+    without a role need the user from the DB. The epoch is checked in both cases.
+    """
+    epoch = await token_epochs.get(token.sub)
+    if epoch is None or epoch != token.epoch:
+        return None
+    if settings.AUTH_TRUST_TOKEN_CLAIMS and token.role is not None:
+        return User(
+            login=token.login, salt="", hashed_password="", id=token.sub, role=token.role, token_epoch=token.epoch
+        )
+
+    user_record = None
+    dbmngr = get_dbmanager()
+    async for conn in dbmngr.get_connection():
+        user_record = await conn.fetchrow("select * from user_login where id = $1", token.sub)
+    if not user_record:
+        return None
+    user = User(**user_record)
+    # the credentials aren't needed to authorize requests, they're not cached
+    user.salt, user.hashed_password = "", ""
+    return user
+
+
+async def authenticate_api_key(connection: ASGIConnection, key: str) -> AuthenticationResult:
+    """Authenticate a request with an API key, the unknown keys are cached as invalid."""
+    key_hash = hash_api_key(key)
+    if (key_user := await api_key_index.get(key_hash)) is None:
+        store = get_invalid_token_store()
+        if await store.get(key_hash) == INVALID_TOKEN:
+            raise NotAuthorizedException("Invalid API key")
+        if (key_user := await api_key_index.lookup(key_hash)) is None:
+            await store.set(key_hash, INVALID_TOKEN, expires_in=settings.AUTH_CACHE_INVALID_SECONDS)
+            raise NotAuthorizedException("Invalid API key")
+    api_key, user = key_user
+    check_api_key_scope(connection, api_key)
+    return AuthenticationResult(user=user, auth=api_key)
 
 
 class JWTAuthenticationMiddleware(AbstractAuthenticationMiddleware):
     async def authenticate_request(self, connection: ASGIConnection) -> AuthenticationResult:
-        """Parse the request api key stored in the header and retrieve the user correlating to the token from the DB."""
-        if not (auth_header := connection.headers.get("Authorization")):
-            if not (cookie_header := connection.cookies.get(settings.API_KEY_COOKIE)):
-                raise NotAuthorizedException()
-            auth_header = f"Bearer {cookie_header}"
-
-        auth_header = auth_header.strip()
-        if not auth_header.startswith("Bearer"):
-            raise NotAuthorizedException("Invalid token, should be: 'Bearer <TOKEN>'")
-        try:
-            auth_header = auth_header.split(" ", 1)[1]
-        except IndexError:
-            raise NotAuthorizedException(  # noqa: B904
-                "Invalid token, should be: 'Bearer <TOKEN>' without extra spaces between 'Bearer' and '<TOKEN>'"
-            )
-
-        # try to get a cached token_user pair to avoid a trip to the DB
-        if cached_token := await store.get(auth_header):
+        """Parse the request api key stored in the header and retrieve the user correlating to the token.
+
+        The API keys are checked before the JWT tokens.
+        """
+        auth_header = get_request_token(connection)
+        if auth_header.startswith(API_KEY_PREFIX):
+            return await authenticate_api_key(connection, auth_header)
+
+        # try to get a cached token_user pair to avoid decoding it, the tokens aren't stored
+        store, invalid_store = get_auth_store(), get_invalid_token_store()
+        key = sha256(auth_header.encode()).hexdigest()
+        if await invalid_store.get(key) == INVALID_TOKEN:
+            raise NotAuthorizedException("Invalid token")
+        if (cached_token := await store.get(key)) is not None:
             token_user = store_decoder.decode(cached_token)
+            # the revoked tokens may be cached still
+            if await token_epochs.get(token_user.token.sub) != token_user.token.epoch:
+                await invalid_store.set(key, INVALID_TOKEN, expires_in=settings.AUTH_CACHE_INVALID_SECONDS)
+                raise NotAuthorizedException("Invalid token")
             return AuthenticationResult(user=token_user.user, auth=token_user.token)
 
-        token = decode_jwt_token(encoded_token=auth_header)
-
-        user_record = None
-        dbmngr = get_dbmanager()
-        async for conn in dbmngr.get_connection():
-            user_record = await conn.fetchrow("select * from user_login where id = $1", token.sub)
+        try:
+            token = decode_jwt_token(encoded_token=auth_header)
+        except NotAuthorizedException:
+            await invalid_store.set(key, INVALID_TOKEN, expires_in=settings.AUTH_CACHE_INVALID_SECONDS)
+            raise
 
-        if not user_record:
+        if not (user := await load_user(token)):
+            await invalid_store.set(key, INVALID_TOKEN, expires_in=settings.AUTH_CACHE_INVALID_SECONDS)
             raise NotAuthorizedException()
 
-        user = User(**user_record)
         token_user = TokenUser(token=token, user=user)
-        await store.set(auth_header, store_encoder.encode(token_user), expires_in=settings.AUTH_CACHE_SECONDS)
+        # the token must not outlive its expiration in the cache
+        exp = token.exp.timestamp() if isinstance(token.exp, datetime) else token.exp
+        expires_in = min(settings.AUTH_CACHE_SECONDS, int(exp - time.time()))
+        if expires_in > 0:
+            await store.set(key, store_encoder.encode(token_user), expires_in=expires_in)
         return AuthenticationResult(user=user, auth=token)
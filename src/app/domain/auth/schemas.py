@@ -6,12 +6,14 @@ from typing import Annotated
 from litestar.dto import DTOConfig, MsgspecDTO
 from msgspec import Meta, Struct, field
 
+from app.domain.lists.schemas import ListTypeEnum
 from app.lib.default_factories import datetime_no_microseconds
 
 MIN_PLAIN_PASSWORD_LENGTH = 10
 MAX_PLAIN_PASSWORD_LENGTH = 64
 MIN_LOGIN_LENGTH = 3
 MAX_LOGIN_LENGTH = 64
+MAX_API_KEY_NAME_LENGTH = 64
 
 
 class UserRoleEnum(StrEnum):
@@ -46,6 +48,7 @@ class User(Struct):
     hashed_password: str
     id: uuid.UUID = field(default_factory=uuid.uuid4)  # noqa: A003
     role: UserRoleEnum = UserRoleEnum.USER
+    token_epoch: int = 0
     created_at: datetime = field(default_factory=datetime_no_microseconds)
     updated_at: datetime = field(default_factory=datetime_no_microseconds)
 
@@ -60,7 +63,7 @@ class UserChangePassword(UserLoginOrCreate):
 
 
 class UserReadDTO(MsgspecDTO[User]):
-    config = DTOConfig(exclude={"salt", "hashed_password"})
+    config = DTOConfig(exclude={"salt", "hashed_password", "token_epoch"})
 
 
 class Token(Struct):
@@ -69,12 +72,16 @@ class Token(Struct):
     exp: time at which the JWT will expire
     iat: time when the JWT was created
     sub: user/login identification
+    role: role of the user, tokens without it need the user from the DB
+    epoch: token epoch of the user, tokens of older epochs are revoked
     """
 
     exp: datetime | int
     iat: datetime | int
     sub: uuid.UUID
     login: str
+    role: UserRoleEnum | None = None
+    epoch: int = 0
 
     def __post_init__(self) -> None:  # noqa: D105
         if isinstance(self.exp, datetime):
@@ -95,3 +102,29 @@ class TokenUser(Struct):
 
     token: Token
     user: User
+
+
+class ApiKeyCreate(Struct):
+    name: Annotated[str, Meta(min_length=1, max_length=MAX_API_KEY_NAME_LENGTH)]
+    read_only: Annotated[bool, Meta(description="Only allow reading.")] = False
+    list_type: Annotated[ListTypeEnum | None, Meta(description="Only allow the lists of this type.")] = None
+
+
+class ApiKey(Struct):
+    """An API key without the key.
+
+    key_prefix: first characters of the key to identify it
+    """
+
+    id: uuid.UUID  # noqa: A003
+    name: str
+    key_prefix: str
+    read_only: bool
+    list_type: ListTypeEnum | None
+    created_at: datetime
+
+
+class ApiKeyCreated(ApiKey):
+    """A new API key, the key can't be read again."""
+
+    key: str
@@ -1,6 +1,7 @@
 from asyncpg.pool import PoolConnectionProxy
 from litestar.exceptions import NotAuthorizedException
 
+from app.domain.auth.epochs import token_epochs
 from app.domain.auth.jwt import encode_jwt_token
 from app.domain.auth.schemas import TokenResponse, User, UserLoginOrCreate, UserRoleEnum
 from app.lib.authcrypt import generate_salt_and_hashed_password, verify_password
@@ -13,12 +14,14 @@ VALUES
     ($1, $2, $3, $4, $5);
 """
 
+# bumping the token epoch revokes the tokens issued before
 UPDATE_USER_PASSWORD = """
 UPDATE user_login
 SET
-    salt = $2, hashed_password = $3
+    salt = $2, hashed_password = $3, token_epoch = token_epoch + 1, updated_at = now()
 WHERE
-    login = $1;
+    login = $1
+RETURNING id, token_epoch;
 """  # noqa:S105
 
 
@@ -54,7 +57,8 @@ async def reset_password(login: str, password: str) -> None:
                 user.salt = salt
                 user.hashed_password = hashed_password
 
-                await conn.execute(UPDATE_USER_PASSWORD, user.login, user.salt, user.hashed_password)
+                updated = await conn.fetchrow(UPDATE_USER_PASSWORD, user.login, user.salt, user.hashed_password)
+                token_epochs.set(updated["id"], updated["token_epoch"])
                 print(user)
                 print("User password updated successfully.")
 
@@ -67,4 +71,6 @@ async def generate_token(conn: PoolConnectionProxy, data: UserLoginOrCreate) ->
         salt=record["salt"], hashed_password=record["hashed_password"], plain_password=data.password
     ):
         raise NotAuthorizedException("Wrong login or password.")
-    return encode_jwt_token(user_id=record["id"], login=record["login"])
+    return encode_jwt_token(
+        user_id=record["id"], login=record["login"], role=record["role"], epoch=record["token_epoch"]
+    )
@@ -1,23 +1,101 @@
-from ipaddress import collapse_addresses, ip_network
-from itertools import chain
+import ipaddress
+from collections.abc import Callable
 
+import msgspec
 from asyncpg.pool import PoolConnectionProxy
-from litestar import Request, Response
+from litestar import MediaType, Request, Response
 from litestar.controller import Controller
 from litestar.datastructures import State
-from litestar.handlers import get
+from litestar.exceptions import HTTPException
+from litestar.handlers import get, post
 from litestar.params import Parameter
-from litestar.status_codes import HTTP_200_OK
+from litestar.response import Stream
+from litestar.status_codes import HTTP_200_OK, HTTP_400_BAD_REQUEST
 
+from app.domain.auth.api_keys import get_list_type_scope
 from app.domain.auth.schemas import Token, User
-from app.domain.cidr.schemas import Cidr, CidrByVersion
-from app.domain.cidr.services import get_cidr_records
+from app.domain.cidr.schemas import (
+    Cidr,
+    CidrByVersion,
+    CidrChanges,
+    CidrFormatEnum,
+    CidrLookup,
+    CidrMatchRequest,
+    CidrMatchResult,
+    CidrOverlap,
+)
+from app.domain.cidr.services import (
+    CollapsedCidrs,
+    get_cidr_changes,
+    get_cidr_records,
+    get_cidr_records_query,
+    get_collapsed_cidrs,
+    get_overlapping_cidrs,
+    get_snapshot_etag,
+    get_snapshot_versions,
+    lookup_cidrs,
+    match_ips,
+)
 from app.domain.lists.schemas import (
     LIST_ID_PATTERN,
     MAX_LIST_ID_LEN,
     TAG_PARAMS_PATTERN,
     ListTypeEnum,
 )
+from app.lib.cidr_formats import MEDIA_TYPES, format_cidrs
+from app.lib.etag import etag_matches, not_modified
+from app.lib.streaming import stream_json_array
+
+SNAPSHOT_VERSION_HEADER = "X-Snapshot-Version"
+
+FORMAT_PARAMETER = Parameter(
+    CidrFormatEnum, query="format", default=CidrFormatEnum.JSON, description="Format of the response.", required=False
+)
+SET_NAME_PARAMETER = Parameter(
+    str | None,
+    query="set_name",
+    default=None,
+    max_length=28,
+    pattern=r"^[A-Za-z0-9_]+$",
+    description="Prefix of the set names for the formats ipset and nft, the list_type by default.",
+    required=False,
+)
+
+
+async def collapsed_response(
+    request: Request[User, Token, State],
+    conn: PoolConnectionProxy,
+    cidr_format: CidrFormatEnum,
+    set_name: str | None,
+    to_json: Callable[[CollapsedCidrs], object],
+) -> Response | Stream:
+    """Get the response of the collapsed endpoints, ``to_json`` builds the JSON content."""
+    list_type = request.query_params["list_type"]
+    snapshot_versions = await get_snapshot_versions(
+        conn=conn,
+        user_id=request.user.id,
+        list_type=list_type,
+        list_id=request.query_params.get("list_id", None),
+        tags=request.query_params.get("tags", None),
+    )
+    set_name = set_name or list_type.lower()
+    etag = get_snapshot_etag((request.url.path, cidr_format, set_name), snapshot_versions)
+    if etag and etag_matches(request, etag):
+        return not_modified(etag)
+    version, collapsed = await get_collapsed_cidrs(conn, snapshot_versions)
+    headers = {SNAPSHOT_VERSION_HEADER: str(version)} | ({"ETag": etag} if etag else {})
+    if cidr_format == CidrFormatEnum.JSON:
+        return Response(to_json(collapsed), headers=headers)
+    if cidr_format == CidrFormatEnum.MSGPACK:
+        content = msgspec.msgpack.encode(to_json(collapsed))
+        return Response(content, media_type=MEDIA_TYPES[cidr_format], headers=headers)
+    if cidr_format == CidrFormatEnum.BINARY:
+        return Response(collapsed.binary(), media_type=MEDIA_TYPES[cidr_format], headers=headers)
+    return Stream(
+        format_cidrs(collapsed.cidrs, cidr_format, set_name, allow=list_type == ListTypeEnum.SAFE),
+        media_type=MEDIA_TYPES[cidr_format],
+        headers=headers,
+    )
 
 
 class CidrController(Controller):
@@ -41,69 +119,179 @@ class CidrController(Controller):
     }
 
     @get("/")
-    async def get_cidrs(self, request: Request[User, Token, State], conn: PoolConnectionProxy) -> Response[list[Cidr]]:
+    async def get_cidrs(
+        self, request: Request[User, Token, State], conn: PoolConnectionProxy, stream: bool = False
+    ) -> Response[list[Cidr]] | Stream:
         """Get CIDRs from **enabled** lists.
 
         - The parameter `list_type` is required.
 
         - If the parameter `list_id` is specified, `tags` filter has no effect
         and if `list_type` doesn't match nothing will be returned.
+
+        - The response has an `ETag`, send it in `If-None-Match` to get a `304` if nothing changed.
+
+        - If the parameter `stream` is `true` the CIDRs are streamed as they are read, for big lists.
         """
-        records = await get_cidr_records(
-            conn=conn,
-            user_id=request.user.id,
-            list_type=request.query_params["list_type"],
-            list_id=request.query_params.get("list_id", None),
-            tags=request.query_params.get("tags", None),
-        )
-        return Response([Cidr(**x) for x in records], status_code=HTTP_200_OK)
+        filters = {
+            "user_id": request.user.id,
+            "list_type": request.query_params["list_type"],
+            "list_id": request.query_params.get("list_id", None),
+            "tags": request.query_params.get("tags", None),
+        }
+        etag = get_snapshot_etag("cidrs", await get_snapshot_versions(conn=conn, **filters))
+        if etag and etag_matches(request, etag):
+            return not_modified(etag)
+        if stream:
+            query, args = get_cidr_records_query(**filters)
+            return Stream(
+                stream_json_array(query, args, lambda x: Cidr(**x)),
+                media_type=MediaType.JSON,
+                headers={"ETag": etag} if etag else None,
+            )
+        records = await get_cidr_records(conn=conn, **filters)
+        return Response([Cidr(**x) for x in records], status_code=HTTP_200_OK, headers={"ETag": etag} if etag else None)
 
     @get("/collapsed")
     async def get_collapsed_cidrs(
-        self, request: Request[User, Token, State], conn: PoolConnectionProxy
-    ) -> Response[list[str]]:
+        self,
+        request: Request[User, Token, State],
+        conn: PoolConnectionProxy,
+        cidr_format: CidrFormatEnum = FORMAT_PARAMETER,
+        set_name: str | None = SET_NAME_PARAMETER,
+    ) -> Response[list[str]] | Stream:
         """Get CIDRs from **enabled** lists with all the networks collapsed if possible.
 
         - The parameter `list_type` is required.
 
         - If the parameter `list_id` is specified, `tags` filter has no effect
         and if `list_type` doesn't match nothing will be returned.
-        """
-        all_addresses = set()
-        for record in await get_cidr_records(
-            conn=conn,
-            user_id=request.user.id,
-            list_type=request.query_params["list_type"],
-            list_id=request.query_params.get("list_id", None),
-            tags=request.query_params.get("tags", None),
-        ):
-            all_addresses.add(ip_network(record["address"]))
 
-        ipv4_collapsed = collapse_addresses(x for x in all_addresses if x.version == 4)
-        ipv6_collapsed = collapse_addresses(x for x in all_addresses if x.version == 6)
-        return Response([x.compressed for x in chain(ipv4_collapsed, ipv6_collapsed)])
+        - The parameter `format` returns plain text or firewall native formats instead of JSON,
+        `ipset` and `nft` create a set per ip version named `<set_name>_v4` and `<set_name>_v6`.
+        `msgpack` has the same content as JSON and `binary` packs the networks in arrays, its layout
+        is described in `app.lib.cidr_formats`.
+
+        - The header `X-Snapshot-Version` has the latest version of the lists included.
+
+        - The response has an `ETag`, send it in `If-None-Match` to get a `304` if nothing changed.
+        """
+        return await collapsed_response(
+            request, conn, cidr_format, set_name, lambda x: [*x.strings()[0], *x.strings()[1]]
+        )
 
     @get("/collapsed/by-ip-version")
     async def get_collapsed_by_version_cidrs(
-        self, request: Request[User, Token, State], conn: PoolConnectionProxy
-    ) -> Response[CidrByVersion]:
+        self,
+        request: Request[User, Token, State],
+        conn: PoolConnectionProxy,
+        cidr_format: CidrFormatEnum = FORMAT_PARAMETER,
+        set_name: str | None = SET_NAME_PARAMETER,
+    ) -> Response[CidrByVersion] | Stream:
         """Get CIDRs from **enabled** lists, collapsed by ip version.
 
         - The parameter `list_type` is required.
 
         - If the parameter `list_id` is specified, `tags` filter has no effect
         and if `list_type` doesn't match nothing will be returned.
+
+        - The parameter `format` returns plain text or firewall native formats instead of JSON,
+        `ipset` and `nft` create a set per ip version named `<set_name>_v4` and `<set_name>_v6`.
+        `msgpack` has the same content as JSON and `binary` packs the networks in arrays, its layout
+        is described in `app.lib.cidr_formats`.
+
+        - The header `X-Snapshot-Version` has the latest version of the lists included.
+
+        - The response has an `ETag`, send it in `If-None-Match` to get a `304` if nothing changed.
         """
-        all_addresses = set()
-        for record in await get_cidr_records(
+        return await collapsed_response(request, conn, cidr_format, set_name, lambda x: CidrByVersion(*x.strings()))
+
+    @get("/changes")
+    async def get_cidr_changes(
+        self, request: Request[User, Token, State], conn: PoolConnectionProxy, since: int | None = None
+    ) -> Response[CidrChanges]:
+        """Get the CIDRs added to and deleted from **enabled** lists since a cursor.
+
+        - The parameter `list_type` is required.
+
+        - If the parameter `list_id` is specified, `tags` filter has no effect.
+
+        - Apply the `changes` in order and send the returned `cursor` as the parameter `since` in the next call.
+
+        - If `resync_required` is `true` download the full CIDRs again and continue from the returned `cursor`.
+        To start call it without `since` and download the full CIDRs after.
+        """
+        changes = await get_cidr_changes(
             conn=conn,
             user_id=request.user.id,
             list_type=request.query_params["list_type"],
+            since=since,
             list_id=request.query_params.get("list_id", None),
             tags=request.query_params.get("tags", None),
-        ):
-            all_addresses.add(ip_network(record["address"]))
+        )
+        return Response(changes, status_code=HTTP_200_OK)
+
 
-        ipv4_collapsed = collapse_addresses(x for x in all_addresses if x.version == 4)
-        ipv6_collapsed = collapse_addresses(x for x in all_addresses if x.version == 6)
-        return Response(CidrByVersion(ipv4=list(ipv4_collapsed), ipv6=list(ipv6_collapsed)))
+class CidrLookupController(Controller):
+    path = "/v1/cidr"
+    tags = ["CIDRs"]
+
+    @get("/lookup")
+    async def lookup_cidrs(
+        self,
+        request: Request[User, Token, State],
+        conn: PoolConnectionProxy,
+        ip: str = Parameter(description="An IP address or a network."),
+    ) -> Response[list[CidrLookup]]:
+        """Get the CIDRs of all the lists containing an IP address or a network.
+
+        - Disabled lists are included, check the field `enabled`.
+
+        - The most specific networks come first.
+        """
+        try:
+            address = ipaddress.ip_network(ip.strip())
+        except ValueError as err:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(err)) from err
+        records = await lookup_cidrs(conn=conn, user_id=request.user.id, address=address)
+        if list_type := get_list_type_scope(request):
+            records = [x for x in records if x["list_type"] == list_type]
+        return Response([CidrLookup(**x) for x in records], status_code=HTTP_200_OK)
+
+    @get("/overlaps")
+    async def get_overlapping_cidrs(
+        self,
+        request: Request[User, Token, State],
+        conn: PoolConnectionProxy,
+        list_type: ListTypeEnum,
+        cidr: str = Parameter(description="An IP address or a network."),
+    ) -> Response[list[CidrOverlap]]:
+        """Get the CIDRs of the **enabled** lists of a type containing a network or inside it.
+
+        - The networks containing it come first, the most specific first, then the ones inside it.
+
+        - The CIDRs are read from an in-memory trie of the lists, refreshed when they change.
+        """
+        try:
+            address = ipaddress.ip_network(cidr.strip())
+        except ValueError as err:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(err)) from err
+        overlaps = await get_overlapping_cidrs(conn=conn, user_id=request.user.id, list_type=list_type, address=address)
+        return Response(overlaps, status_code=HTTP_200_OK)
+
+    @post("/match", status_code=HTTP_200_OK)
+    async def match_ips(
+        self, request: Request[User, Token, State], conn: PoolConnectionProxy, data: CidrMatchRequest
+    ) -> Response[list[CidrMatchResult]]:
+        """Get the CIDRs of the **enabled** lists containing each IP.
+
+        - The IPs are matched against an in-memory index of the lists, refreshed when they change.
+        """
+        try:
+            results = await match_ips(conn=conn, user_id=request.user.id, ips=data.ips)
+        except ValueError as err:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(err)) from err
+        if list_type := get_list_type_scope(request):
+            for result in results:
+                result.matches = [x for x in result.matches if x.list_type == list_type]
+        return Response(results, status_code=HTTP_200_OK)
@@ -1,9 +1,24 @@
 from datetime import datetime
+from enum import StrEnum
+from typing import Annotated
 
-from msgspec import Struct, field
+from msgspec import Meta, Struct, field
 
 from app.lib.default_factories import datetime_no_microseconds
 
+MAX_MATCH_IPS = 10_000
+
+
+class CidrFormatEnum(StrEnum):
+    JSON = "json"
+    TEXT = "text"
+    NGINX = "nginx"
+    IPSET = "ipset"
+    NFT = "nft"
+    CSV = "csv"
+    BINARY = "binary"
+    MSGPACK = "msgpack"
+
 
 class Cidr(Struct):
     address: str
@@ -29,3 +44,63 @@ class CidrNL(Struct):
 class CidrByVersion(Struct):
     ipv4: list[str]
     ipv6: list[str]
+
+
+class CidrLookup(Struct):
+    """A CIDR containing the address looked up.
+
+    for /v1/cidr/lookup.
+    """
+
+    list_id: str
+    list_type: str
+    enabled: bool
+    address: str
+    expires_at: datetime | None = None
+
+
+class CidrMatchRequest(Struct):
+    ips: Annotated[list[str], Meta(max_length=MAX_MATCH_IPS, description="IP addresses to match.")]
+
+
+class CidrMatch(Struct):
+    list_id: str
+    list_type: str
+    address: str
+
+
+class CidrMatchResult(Struct):
+    """The CIDRs of the enabled lists containing an IP.
+
+    for /v1/cidr/match.
+    """
+
+    ip: str
+    matches: list[CidrMatch]
+
+
+class CidrOverlap(Struct):
+    """A CIDR containing or inside the network looked up.
+
+    for /v1/cidr/overlaps.
+    """
+
+    list_id: str
+    address: str
+
+
+class CidrChange(Struct):
+    list_id: str
+    address: str
+    change: str
+
+
+class CidrChanges(Struct):
+    """Changes of the CIDRs since a cursor.
+
+    for /v1/cidr/changes.
+    """
+
+    cursor: int
+    resync_required: bool = False
+    changes: list[CidrChange] = field(default_factory=list)
@@ -1,9 +1,25 @@
+import threading
+from collections import OrderedDict
+from functools import reduce
+from ipaddress import IPv4Network, IPv6Network
 from uuid import UUID
 
 from asyncpg import Record
 from asyncpg.pool import PoolConnectionProxy
 from litestar.exceptions import ImproperlyConfiguredException
 
+from app.domain.cidr.schemas import CidrChange, CidrChanges, CidrMatch, CidrMatchResult, CidrOverlap
+from app.lib.cidr_formats import encode_binary
+from app.lib.cidr_trie import CidrTrie
+from app.lib.cidrset import CidrSet, format_cidr
+from app.lib.etag import make_etag
+from app.lib.match_index import MatchIndex, Ranges, parse_ip, parse_networks
+from app.lib.process_pool import run_cpu_bound
+from app.lib.settings import get_settings
+from app.lib.snapshots import decode_snapshot
+
+settings = get_settings()
+
 SELECT_ENABLED_BY_TYPE_AND_ID = """
 select *
 from cidr
@@ -58,6 +74,102 @@ list_id in
  and list_type = $2
 )"""
 
+SELECT_ENABLED_SNAPSHOT_VERSIONS = """
+select
+ l.id as list_id, s.version
+from list l
+left join cidr_snapshot s on s.list_id = l.id
+where
+ l.enabled = true
+ and l.user_id = $1
+ and l.list_type = $2
+ and ($3::text is null or l.id = $3)
+ and ($4::text[] is null or l.tags && $4::text[])
+"""
+
+SELECT_SNAPSHOTS_BY_LIST_IDS = """
+select list_id, version, ipv4, ipv6
+from cidr_snapshot
+where list_id = any($1::text[])
+"""
+
+SELECT_ADDRESSES_BY_LIST_IDS = """
+select address::text as address
+from cidr
+where list_id = any($1::text[])
+"""
+
+SELECT_ENABLED_LIST_VERSIONS = """
+select
+ l.id as list_id, l.list_type::text as list_type, s.version
+from list l
+left join cidr_snapshot s on s.list_id = l.id
+where
+ l.enabled = true
+ and l.user_id = $1
+"""
+
+SELECT_LIST_ADDRESSES_BY_LIST_IDS = """
+select list_id, address::text as address
+from cidr
+where list_id = any($1::text[])
+"""
+
+SELECT_ENABLED_ADDRESSES_BY_LIST_TYPE = """
+select c.list_id, c.address::text as address
+from cidr c
+join list l on l.id = c.list_id
+where
+ l.user_id = $1
+ and l.enabled = true
+ and l.list_type = $2
+"""
+
+# uses the GiST index on the address, the most specific networks first
+SELECT_CIDRS_CONTAINING = """
+select
+ c.list_id, l.list_type::text as list_type, l.enabled, c.address::text as address, c.expires_at
+from cidr c
+join list l on l.id = c.list_id
+where
+ c.address >>= $2::inet
+ and l.user_id = $1
+order by masklen(c.address) desc, c.list_id
+"""
+
+# every transaction below the xmin of the current snapshot has finished, the
+# changes before it can't grow anymore so it's the cursor returned to the client
+SELECT_CHANGES_CURSOR = """
+select
+ pg_snapshot_xmin(pg_current_snapshot())::text::bigint as cursor,
+ (select txid from cidr_change_watermark) as watermark
+"""
+
+SELECT_LIST_CHANGED = """
+select exists (
+ select from cidr_change
+ where user_id = $1 and txid >= $2 and txid < $3 and change = 'LIST'
+)
+"""
+
+SELECT_CIDR_CHANGES = """
+select
+ c.list_id, c.address::text as address, c.change::text as change
+from cidr_change c
+join list l on l.id = c.list_id
+where
+ c.user_id = $1
+ and c.txid >= $2
+ and c.txid < $3
+ and c.change != 'LIST'
+ and l.enabled = true
+ and l.list_type = $4
+ and ($5::text is null or l.id = $5)
+ and ($6::text[] is null or l.tags && $6::text[])
+order by c.id
+limit $7
+"""
+
 SELECT_BY_ID_FIRST_PAGE = """
 select *
 from cidr
@@ -79,46 +191,39 @@ limit $3
 """
 
 
-async def get_cidr_records(
-    conn: PoolConnectionProxy,
+def get_cidr_records_query(
     user_id: UUID,
     list_type: str | None = None,
     list_id: str | None = None,
     tags: str | None = None,
-) -> list[Record]:
-    """Get CIDR records filtering by id, type and or tags."""
+) -> tuple[str, list]:
+    """Get the query and arguments to select CIDR records filtering by id, type and or tags."""
     if list_id and list_type:
-        return await conn.fetch(
-            SELECT_ENABLED_BY_TYPE_AND_ID,
-            user_id,
-            list_type,
-            list_id,
-        )
+        return SELECT_ENABLED_BY_TYPE_AND_ID, [user_id, list_type, list_id]
 
     if tags and list_type:
         tags_split = [x.strip() for x in tags.strip().split(",") if x]
-        return await conn.fetch(
-            SELECT_ENABLED_BY_TYPE_AND_TAGS,
-            user_id,
-            list_type,
-            tags_split,
-        )
+        return SELECT_ENABLED_BY_TYPE_AND_TAGS, [user_id, list_type, tags_split]
 
     if list_id:
-        return await conn.fetch(
-            SELECT_ENABLED_BY_ID,
-            user_id,
-            list_id,
-        )
+        return SELECT_ENABLED_BY_ID, [user_id, list_id]
 
     if not list_type:
         raise ImproperlyConfiguredException("list_type is mandatory if no other filters are used")
 
-    return await conn.fetch(
-        SELECT_ENABLED_BY_TYPE,
-        user_id,
-        list_type,
-    )
+    return SELECT_ENABLED_BY_TYPE, [user_id, list_type]
+
+
+async def get_cidr_records(
+    conn: PoolConnectionProxy,
+    user_id: UUID,
+    list_type: str | None = None,
+    list_id: str | None = None,
+    tags: str | None = None,
+) -> list[Record]:
+    """Get CIDR records filtering by id, type and or tags."""
+    query, args = get_cidr_records_query(user_id=user_id, list_type=list_type, list_id=list_id, tags=tags)
+    return await conn.fetch(query, *args)
 
 
 async def get_cidr_records_paginated(
@@ -141,3 +246,292 @@ async def get_cidr_records_paginated(
         list_id,
         limit,
     )
+
+
+class CollapsedCidrs:
+    """Collapsed IPv4 and IPv6 networks, the strings and the binary format are built on first use."""
+
+    __slots__ = ("_binary", "_strings", "cidrs")
+
+    def __init__(self, cidrs: CidrSet) -> None:  # noqa: D107
+        self.cidrs = cidrs
+        self._strings: tuple[list[str], list[str]] | None = None
+        self._binary: bytes | None = None
+
+    def binary(self) -> bytes:
+        """Get the networks encoded in the binary format."""
+        if self._binary is None:
+            self._binary = encode_binary(self.cidrs)
+        return self._binary
+
+    def strings(self) -> tuple[list[str], list[str]]:
+        """Get the IPv4 and IPv6 networks as strings."""
+        if self._strings is None:
+            self._strings = list(self.cidrs.ipv4.to_strings()), list(self.cidrs.ipv6.to_strings())
+        return self._strings
+
+
+# Collapsed CIDRs keyed by the ``(list_id, version)`` of the snapshots they come from
+_collapsed_cache: OrderedDict[tuple[tuple[str, int], ...], CollapsedCidrs] = OrderedDict()
+
+
+def collapse_snapshots(snapshots: list[tuple[bytes, bytes]], addresses: list[str]) -> CidrSet:
+    """Merge the encoded snapshots and the ``addresses`` of lists without one."""
+    cidr_sets = [decode_snapshot(ipv4, ipv6) for ipv4, ipv6 in snapshots]
+    if addresses:
+        cidr_sets.append(CidrSet.from_strings(addresses))
+    return reduce(CidrSet.union, cidr_sets, CidrSet())
+
+
+async def get_snapshot_versions(
+    conn: PoolConnectionProxy,
+    user_id: UUID,
+    list_type: str,
+    list_id: str | None = None,
+    tags: str | None = None,
+) -> list[Record]:
+    """Get the ``list_id`` and snapshot ``version`` of the **enabled** lists matching the filters.
+
+    The version is ``None`` for lists without a snapshot. If ``list_id`` is given ``tags`` has no effect.
+    """
+    tags_split = [x.strip() for x in tags.strip().split(",") if x] if tags and not list_id else None
+    return await conn.fetch(SELECT_ENABLED_SNAPSHOT_VERSIONS, user_id, list_type, list_id, tags_split)
+
+
+def get_snapshot_etag(resource: object, records: list[Record]) -> str | None:
+    """Get the ETag of ``resource`` built from the snapshot versions of ``get_snapshot_versions``.
+
+    Every change of the CIDRs of a list bumps its version, ``None`` if a list has no snapshot yet.
+    """
+    if any(record["version"] is None for record in records):
+        return None
+    return make_etag(resource, sorted((record["list_id"], record["version"]) for record in records))
+
+
+async def get_collapsed_cidrs(conn: PoolConnectionProxy, records: list[Record]) -> tuple[int, CollapsedCidrs]:
+    """Get the collapsed CIDRs of the lists returned by ``get_snapshot_versions`` from their snapshots.
+
+    Returns the latest version of the snapshots used and the networks, merged results are
+    cached until any of the snapshots changes.
+    """
+    version = max((record["version"] or 0 for record in records), default=0)
+    key = tuple(sorted((record["list_id"], record["version"]) for record in records))
+    if key in _collapsed_cache:
+        _collapsed_cache.move_to_end(key)
+        return version, _collapsed_cache[key]
+
+    # lists without a snapshot yet are read from their rows and the result is not cached
+    missing = [record["list_id"] for record in records if record["version"] is None]
+    snapshot_records = await conn.fetch(
+        SELECT_SNAPSHOTS_BY_LIST_IDS, [record["list_id"] for record in records if record["version"] is not None]
+    )
+    snapshots = [(record["ipv4"], record["ipv6"]) for record in snapshot_records]
+    addresses = (
+        [record["address"] for record in await conn.fetch(SELECT_ADDRESSES_BY_LIST_IDS, missing)] if missing else []
+    )
+    size = sum(len(ipv4) // 5 + len(ipv6) // 17 for ipv4, ipv6 in snapshots) + len(addresses)
+    collapsed = CollapsedCidrs(await run_cpu_bound(collapse_snapshots, size, snapshots, addresses))
+
+    # the snapshots may have changed since the versions were read, cache them with the versions used
+    version = max((record["version"] for record in snapshot_records), default=version)
+    if not missing:
+        key = tuple(sorted((record["list_id"], record["version"]) for record in snapshot_records))
+        _collapsed_cache[key] = collapsed
+        # each entry grows with its networks, its strings and binary body are built on use
+        size = sum(len(x.cidrs) for x in _collapsed_cache.values())
+        while len(_collapsed_cache) > 1 and (
+            len(_collapsed_cache) > settings.SNAPSHOT_CACHE_SIZE or size > settings.SNAPSHOT_CACHE_MAX_NETWORKS
+        ):
+            size -= len(_collapsed_cache.popitem(last=False)[1].cidrs)
+    return version, collapsed
+
+
+async def lookup_cidrs(conn: PoolConnectionProxy, user_id: UUID, address: IPv4Network | IPv6Network) -> list[Record]:
+    """Get the CIDRs of the lists of the user containing ``address``, an IP or a network."""
+    return await conn.fetch(SELECT_CIDRS_CONTAINING, user_id, address)
+
+
+class _UserMatchIndex:
+    """Index of the enabled lists of a user, with the ranges of each list to refresh it."""
+
+    __slots__ = ("index", "key", "lists")
+
+    def __init__(self, key: tuple, lists: dict[str, tuple[int | None, str, Ranges]], index: MatchIndex) -> None:
+        """Keep the ``(version, list_type, ranges)`` of each list in ``lists``."""
+        self.key = key
+        self.lists = lists
+        self.index = index
+
+
+# Match indexes keyed by user, the least recently used are evicted
+_match_cache: OrderedDict[UUID, _UserMatchIndex] = OrderedDict()
+
+
+async def get_match_index(conn: PoolConnectionProxy, user_id: UUID) -> MatchIndex:
+    """Get the index of the **enabled** lists of the user.
+
+    The index is cached until the snapshot version of a list changes, then only the
+    rows of the changed lists are read and parsed again. Lists without a snapshot
+    are always read.
+    """
+    records = await conn.fetch(SELECT_ENABLED_LIST_VERSIONS, user_id)
+    key = tuple(sorted((record["list_id"], record["list_type"], record["version"] or 0) for record in records))
+    cached = _match_cache.get(user_id)
+    if cached and cached.key == key and all(record["version"] is not None for record in records):
+        _match_cache.move_to_end(user_id)
+        return cached.index
+
+    previous = cached.lists if cached else {}
+    lists = {}
+    stale = {}
+    for record in records:
+        list_id, list_type, version = record["list_id"], record["list_type"], record["version"]
+        if version is not None and previous.get(list_id, (None, None))[:2] == (version, list_type):
+            lists[list_id] = previous[list_id]
+        else:
+            stale[list_id] = (version, list_type)
+    if stale:
+        networks = [
+            (record["list_id"], stale[record["list_id"]][1], record["address"])
+            for record in await conn.fetch(SELECT_LIST_ADDRESSES_BY_LIST_IDS, list(stale))
+        ]
+        lists |= {list_id: (version, list_type, {4: [], 6: []}) for list_id, (version, list_type) in stale.items()}
+        for version, version_ranges in (await run_cpu_bound(parse_networks, len(networks), networks)).items():
+            for network_range in version_ranges:
+                lists[network_range[2][0]][2][version].append(network_range)
+
+    ranges = {version: [x for _, _, list_ranges in lists.values() for x in list_ranges[version]] for version in (4, 6)}
+    index = await run_cpu_bound(MatchIndex, len(ranges[4]) + len(ranges[6]), ranges)
+    _match_cache[user_id] = _UserMatchIndex(key, lists, index)
+    _match_cache.move_to_end(user_id)
+    while len(_match_cache) > settings.MATCH_INDEX_CACHE_SIZE:
+        _match_cache.popitem(last=False)
+    return index
+
+
+async def match_ips(conn: PoolConnectionProxy, user_id: UUID, ips: list[str]) -> list[CidrMatchResult]:
+    """Get the CIDRs of the **enabled** lists of the user containing each IP.
+
+    Raises ``ValueError`` if any IP is malformed.
+    """
+    addresses = [parse_ip(ip) for ip in ips]
+    index = await get_match_index(conn, user_id)
+    return [
+        CidrMatchResult(ip=ip, matches=[CidrMatch(*match) for match in index.match(version, address)])
+        for ip, (version, address) in zip(ips, addresses, strict=True)
+    ]
+
+
+async def get_cidr_changes(
+    conn: PoolConnectionProxy,
+    user_id: UUID,
+    list_type: str,
+    since: int | None,
+    list_id: str | None = None,
+    tags: str | None = None,
+) -> CidrChanges:
+    """Get the CIDRs added to and deleted from **enabled** lists since the cursor ``since``.
+
+    A resync is required without a cursor, when the changes after it were pruned, when
+    there are too many changes or when any list of the user was enabled, disabled, retagged
+    or deleted after it. If ``list_id`` is given ``tags`` has no effect.
+    """
+    record = await conn.fetchrow(SELECT_CHANGES_CURSOR)
+    cursor = record["cursor"]
+    if since is None or since < record["watermark"] or since > cursor:
+        return CidrChanges(cursor=cursor, resync_required=True)
+    if await conn.fetchval(SELECT_LIST_CHANGED, user_id, since, cursor):
+        return CidrChanges(cursor=cursor, resync_required=True)
+
+    tags_split = [x.strip() for x in tags.strip().split(",") if x] if tags and not list_id else None
+    records = await conn.fetch(
+        SELECT_CIDR_CHANGES, user_id, since, cursor, list_type, list_id, tags_split, settings.CIDR_CHANGES_MAX_SIZE + 1
+    )
+    if len(records) > settings.CIDR_CHANGES_MAX_SIZE:
+        return CidrChanges(cursor=cursor, resync_required=True)
+    return CidrChanges(cursor=cursor, changes=[CidrChange(**x) for x in records])
+
+
+class _CidrTrieEntry:
+    """Trie of the enabled lists of a user and type with the change log cursor it's up to date with."""
+
+    __slots__ = ("cursor", "trie")
+
+    def __init__(self, trie: CidrTrie, cursor: int) -> None:  # noqa: D107
+        self.trie = trie
+        self.cursor = cursor
+
+
+# Tries keyed by ``(user_id, list_type)``, each process has its own and brings them up to
+# date with the change log on each use, so the changes of the other processes are seen.
+# The worker may run in a thread of the API with ``run_bg``, they're only changed with the
+# lock held. The least recently used are evicted.
+_trie_cache: OrderedDict[tuple[UUID, str], _CidrTrieEntry] = OrderedDict()
+_trie_cache_lock = threading.Lock()
+
+
+async def _get_trie_entry(conn: PoolConnectionProxy, user_id: UUID, list_type: str) -> _CidrTrieEntry:
+    """Get the cached trie entry updated with the change log, building it if needed."""
+    key = (user_id, list_type)
+    with _trie_cache_lock:
+        entry = _trie_cache.get(key)
+    if entry is not None:
+        since = entry.cursor
+        changes = await get_cidr_changes(conn, user_id, list_type, since)
+        if changes.cursor < since:
+            # refreshed by a newer snapshot than the one of this transaction
+            return entry
+        if not changes.resync_required:
+            with _trie_cache_lock:
+                # replaying from an older cursor is fine, changes are applied with set semantics,
+                # but not going back from a newer one
+                if since <= entry.cursor <= changes.cursor:
+                    entry.trie.apply((x.list_id, x.address, x.change) for x in changes.changes)
+                    entry.cursor = changes.cursor
+                if key in _trie_cache:
+                    _trie_cache.move_to_end(key)
+            return entry
+
+    # the cursor is read first, the changes committed while reading the rows are replayed later
+    cursor = (await conn.fetchrow(SELECT_CHANGES_CURSOR))["cursor"]
+    records = await conn.fetch(SELECT_ENABLED_ADDRESSES_BY_LIST_TYPE, user_id, list_type)
+    networks = [(record["list_id"], record["address"]) for record in records]
+    entry = _CidrTrieEntry(await run_cpu_bound(CidrTrie.from_networks, len(networks), networks), cursor)
+    with _trie_cache_lock:
+        current = _trie_cache.get(key)
+        if current is not None and current.cursor > cursor:
+            return current
+        _trie_cache[key] = entry
+        _trie_cache.move_to_end(key)
+        size = sum(len(x.trie) for x in _trie_cache.values())
+        while size > settings.CIDR_TRIE_CACHE_MAX_NETWORKS and len(_trie_cache) > 1:
+            size -= len(_trie_cache.popitem(last=False)[1].trie)
+    return entry
+
+
+async def get_enabled_cidrs(conn: PoolConnectionProxy, user_id: UUID, list_type: str) -> CidrSet:
+    """Get the collapsed CIDRs of the **enabled** lists of the user of type ``list_type``.
+
+    The CIDRs come from an in-memory trie kept up to date with the change log, only
+    committed changes are seen. The rows are read again only when a resync is needed.
+    """
+    entry = await _get_trie_entry(conn, user_id, list_type)
+    with _trie_cache_lock:
+        return entry.trie.collapse()
+
+
+async def get_overlapping_cidrs(
+    conn: PoolConnectionProxy, user_id: UUID, list_type: str, address: IPv4Network | IPv6Network
+) -> list[CidrOverlap]:
+    """Get the CIDRs of the **enabled** lists of type ``list_type`` overlapping ``address``.
+
+    The networks containing ``address`` come first, the most specific first, then the ones inside it.
+    """
+    entry = await _get_trie_entry(conn, user_id, list_type)
+    with _trie_cache_lock:
+        overlaps = entry.trie.overlaps(address.version, int(address.network_address), address.prefixlen)
+    return [
+        CidrOverlap(list_id=list_id, address=format_cidr(address.version, start, prefixlen))
+        for start, prefixlen, list_ids in overlaps
+        for list_id in list_ids
+    ]
@@ -1,17 +1,24 @@
+from asyncpg import Record
 from asyncpg.pool import PoolConnectionProxy
-from litestar import Request, Response
+from litestar import MediaType, Request, Response
 from litestar.controller import Controller
 from litestar.datastructures import State
 from litestar.dto import DTOData
 from litestar.exceptions import HTTPException, NotFoundException
 from litestar.handlers import delete, get, post, put
+from litestar.response import Stream
+from litestar.serialization import encode_json
 from litestar.status_codes import HTTP_400_BAD_REQUEST
 
+from app.domain.auth.api_keys import check_list_type_scope, get_list_type_scope
 from app.domain.auth.schemas import Token, User
 from app.domain.cidr.schemas import CidrNL
 from app.domain.lists.schemas import (ActionEnum, CidrAdd, CidrAddRaw, CidrDelete, CidrDeleteRaw, CidrJob, CidrList,
                                       ListCreateDTO, ListFull, ListTypeEnum, ListUpdateDTO)
 from app.domain.lists.services import insert_cidr_job, parse_raw_cidrs_input_as_str
+from app.lib.etag import etag_matches, make_etag, not_modified
+from app.lib.snapshots import INSERT_EMPTY_SNAPSHOT
+from app.lib.streaming import stream_json_array
 from app.lib.validations import run_validation
 
 INSERT_LIST = """
@@ -37,6 +44,20 @@ WHERE
 RETURNING *;
 """
 
+SELECT_LIST_CIDRS = """
+select * from cidr where list_id = (select id from list where id = $1 and user_id = $2)
+"""
+
+
+def to_cidr_nl(record: Record) -> CidrNL:
+    """Get a CIDR of a list from its record."""
+    return CidrNL(
+        address=record["address"],
+        expires_at=record["expires_at"],
+        created_at=record["created_at"],
+        updated_at=record["updated_at"],
+    )
+
 
 class ListController(Controller):
     path = "/v1/list"
@@ -48,6 +69,8 @@ class ListController(Controller):
     ) -> Response[list[ListFull]]:
         """Get lists."""
         records = await conn.fetch("select * from list where user_id = $1", request.user.id)
+        if list_type := get_list_type_scope(request):
+            records = [x for x in records if x["list_type"] == list_type]
         return Response([ListFull(**x) for x in records])
 
     @post("/", dto=ListCreateDTO, return_dto=None)
@@ -56,6 +79,7 @@ class ListController(Controller):
     ) -> Response[ListFull]:
         """Create list."""
         await run_validation(data=data, target_type=ListFull)
+        check_list_type_scope(request, data.list_type)
         async with conn.transaction():
             record = await conn.fetchrow(
                 INSERT_LIST,
@@ -66,6 +90,8 @@ class ListController(Controller):
                 list({*data.tags, "DEFAULT"}),
                 data.description,
             )
+            if record:
+                await conn.execute(INSERT_EMPTY_SNAPSHOT, data.id)
         if not record:
             raise HTTPException(
                 status_code=HTTP_400_BAD_REQUEST,
@@ -81,6 +107,7 @@ class ListController(Controller):
         record = await conn.fetchrow("select * from list where id = $1 and user_id = $2", id, request.user.id)
         if not record:
             raise NotFoundException(f"List {id} not found")
+        check_list_type_scope(request, record["list_type"])
         return Response(ListFull(**record))
 
     @put("/{id:str}", dto=ListUpdateDTO, return_dto=None)
@@ -97,6 +124,7 @@ class ListController(Controller):
                 raise NotFoundException(f"List {id} not found.")
 
             list_type = to_update.get("list_type", current_record["list_type"])
+            check_list_type_scope(request, current_record["list_type"], list_type)
             enabled = to_update.get("enabled", current_record["enabled"])
             tags = to_update.get("tags", current_record["tags"])
             description = to_update.get("description", current_record["description"])
@@ -140,31 +168,45 @@ class ListController(Controller):
         """Delete list."""
         async with conn.transaction():
             record = await conn.fetchval(
-                "delete from list where id = $1 and user_id = $2 returning id", id, request.user.id
+                "delete from list where id = $1 and user_id = $2 returning list_type", id, request.user.id
             )
             if not record:
                 raise NotFoundException(f"List {id} not found.")
+            # rolled back if the API key can't delete it
+            check_list_type_scope(request, record)
 
     @get("/{id:str}/cidr")
     async def get_cidrs(
-        self, request: Request[User, Token, State], conn: PoolConnectionProxy, id: str
-    ) -> Response[CidrList]:
-        """Get CIDRs."""
+        self, request: Request[User, Token, State], conn: PoolConnectionProxy, id: str, stream: bool = False
+    ) -> Response[CidrList] | Stream:
+        """Get CIDRs.
+
+        - The response has an `ETag`, send it in `If-None-Match` to get a `304` if nothing changed.
+
+        - If the parameter `stream` is `true` the CIDRs are streamed as they are read, for big lists.
+        """
         list_record = await conn.fetchrow("select * from list where id = $1 and user_id = $2", id, request.user.id)
         if not list_record:
             raise NotFoundException(f"List {id} not found.")
-        records = await conn.fetch(  # even if we have the list_id, we need to ensure that the list belongs to the user
-            "select * from cidr where list_id = (select id from list where id = $1 and user_id = $2)",
-            id,
-            request.user.id,
-        )
-        cidrs = [
-            CidrNL(
-                address=x["address"], expires_at=x["expires_at"], created_at=x["created_at"], updated_at=x["updated_at"]
+        check_list_type_scope(request, list_record["list_type"])
+        version = await conn.fetchval("select version from cidr_snapshot where list_id = $1", id)
+        etag = make_etag("list-cidrs", id, version, list_record["updated_at"]) if version is not None else None
+        if etag and etag_matches(request, etag):
+            return not_modified(etag)
+        if stream:
+            # the list fields are encoded once, the CIDRs are streamed in place of the empty array
+            prefix, suffix = encode_json(CidrList(**list_record)).split(b'"cidrs":[]', 1)
+            return Stream(
+                stream_json_array(
+                    SELECT_LIST_CIDRS, [id, request.user.id], to_cidr_nl, prefix=prefix + b'"cidrs":', suffix=suffix
+                ),
+                media_type=MediaType.JSON,
+                headers={"ETag": etag} if etag else None,
             )
-            for x in records
-        ]
-        return Response(CidrList(cidrs=cidrs, **list_record))
+        # even if we have the list_id, we need to ensure that the list belongs to the user
+        records = await conn.fetch(SELECT_LIST_CIDRS, id, request.user.id)
+        cidrs = [to_cidr_nl(x) for x in records]
+        return Response(CidrList(cidrs=cidrs, **list_record), headers={"ETag": etag} if etag else None)
 
     @post("/{id:str}/cidr/add")
     async def add_cidrs(
@@ -187,6 +229,7 @@ class ListController(Controller):
         list_record = await conn.fetchrow("select * from list where id = $1 and user_id = $2", id, request.user.id)
         if not list_record:
             raise NotFoundException(f"List {id} not found.")
+        check_list_type_scope(request, list_record["list_type"])
 
         cidr_job = CidrJob(
             action=ActionEnum.ADD,
@@ -212,6 +255,7 @@ class ListController(Controller):
         list_record = await conn.fetchrow("select * from list where id = $1 and user_id = $2", id, request.user.id)
         if not list_record:
             raise NotFoundException(f"List {id} not found.")
+        check_list_type_scope(request, list_record["list_type"])
 
         cidr_job = CidrJob(
             action=ActionEnum.DELETE,
@@ -249,6 +293,7 @@ class ListController(Controller):
         list_record = await conn.fetchrow("select * from list where id = $1 and user_id = $2", id, request.user.id)
         if not list_record:
             raise NotFoundException(f"List {id} not found.")
+        check_list_type_scope(request, list_record["list_type"])
 
         ipv4_cidrs, ipv6_cidrs = parse_raw_cidrs_input_as_str(raw_data=data.cidrs)
         cidr_job = CidrJob(
@@ -277,6 +322,7 @@ class ListController(Controller):
         list_record = await conn.fetchrow("select * from list where id = $1 and user_id = $2", id, request.user.id)
         if not list_record:
             raise NotFoundException(f"List {id} not found.")
+        check_list_type_scope(request, list_record["list_type"])
 
         ipv4_cidrs, ipv6_cidrs = parse_raw_cidrs_input_as_str(raw_data=data.cidrs)
         cidr_job = CidrJob(
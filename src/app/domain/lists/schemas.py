@@ -12,12 +12,14 @@ from app.lib.default_factories import datetime_no_microseconds
 MAX_LIST_ID_LEN = 64
 MAX_TAG_LEN = 16
 MAX_DESCRIPTION_LEN = 256
+# "ffff:ffff:ffff:ffff:ffff:ffff:255.255.255.255/128" is 49 characters, a bit more for spaces
+MAX_CIDR_LEN = 64
 
 LIST_ID_PATTERN = "^[A-Z][A-Z0-9_]*$"
 TAG_PATTERN = "^[A-Z][A-Z0-9]*$"
 TAG_PARAMS_PATTERN = "^([A-Z][A-Z0-9]*,?)+$"
 
-CidrType = Annotated[str, Meta(description="IP address or network in CIDR notation.")]
+CidrType = Annotated[str, Meta(max_length=MAX_CIDR_LEN, description="IP address or network in CIDR notation.")]
 
 CidrTTL = Annotated[
     int | None,
@@ -14,6 +14,9 @@ VALUES
     ($1, $2::jsonb)
 """
 
+JOB_QUEUE_CHANNEL = "job_queue"
+"""Channel notified when new jobs are queued, the notification is sent when the transaction commits."""
+
 
 IPV4_RE = re.compile(r"\b((?:[0-9]{1,3}\.){3}[0-9]{1,3}(?:\/[0-9]{1,2})?)\b")
 IPV6_RE = re.compile(r"\b([A-Fa-f0-9:]+:[A-Fa-f0-9]*(?:\/[0-9]{1,3})?)\b")
@@ -54,3 +57,4 @@ async def insert_cidr_job(job: CidrJob, conn: PoolConnectionProxy) -> None:
             job.job_id,
             cidr_job_json,
         )
+        await conn.execute("SELECT pg_notify($1, '')", JOB_QUEUE_CHANNEL)
@@ -0,0 +1 @@
+"""Prometheus metrics of the API and the worker."""
@@ -0,0 +1,45 @@
+from asyncpg.pool import PoolConnectionProxy
+from litestar import Request, Response
+from litestar.controller import Controller
+from litestar.exceptions import NotAuthorizedException
+from litestar.handlers import get
+
+from app.lib.metrics import (
+    CONTENT_TYPE,
+    JOB_QUEUE_DEPTH,
+    JOB_QUEUE_FAILED,
+    JOB_QUEUE_OLDEST_SECONDS,
+    is_authorized,
+    registry,
+)
+from app.lib.settings import get_settings
+
+settings = get_settings()
+
+SELECT_JOB_QUEUE_STATS = """
+select
+    count(*) filter (where failed_at is null) as depth,
+    count(*) filter (where failed_at is not null) as failed,
+    coalesce(extract(epoch from now() - min(created_at) filter (where failed_at is null)), 0)::float as oldest
+from job_queue
+"""
+
+
+class MetricsController(Controller):
+    path = "/metrics"
+    include_in_schema = False
+
+    @get()
+    async def metrics(self, conn: PoolConnectionProxy, request: Request) -> Response:
+        """Get the metrics of this process in the Prometheus text format.
+
+        The job queue is shared by all the processes, it's read on each scrape.
+        Every request is denied while ``METRICS_TOKEN`` isn't set.
+        """
+        if not is_authorized(request.headers.get("Authorization", ""), settings.METRICS_TOKEN):
+            raise NotAuthorizedException("Invalid metrics token.")
+        record = await conn.fetchrow(SELECT_JOB_QUEUE_STATS)
+        JOB_QUEUE_DEPTH.set(record["depth"])
+        JOB_QUEUE_OLDEST_SECONDS.set(record["oldest"])
+        JOB_QUEUE_FAILED.set(record["failed"])
+        return Response(registry.render(), media_type=CONTENT_TYPE)
@@ -17,11 +17,12 @@ from msgspec import ValidationError
 
 from app.domain.auth.schemas import Token, User, UserLoginOrCreate
 from app.domain.auth.services import generate_token
-from app.domain.cidr.services import get_cidr_records_paginated
+from app.domain.cidr.services import get_cidr_records_paginated, lookup_cidrs
 from app.domain.lists.controllers import INSERT_LIST, UPDATE_LIST
 from app.domain.lists.schemas import ActionEnum, CidrJob, ListFull, ListTypeEnum
 from app.domain.lists.services import insert_cidr_job, parse_raw_cidrs_input, parse_raw_cidrs_input_as_str
 from app.lib.settings import get_settings
+from app.lib.snapshots import INSERT_EMPTY_SNAPSHOT, update_deleted_snapshots
 
 settings = get_settings()
 
@@ -72,14 +73,9 @@ async def get_network_info(address: str | None, conn: PoolConnectionProxy, user_
         except ValueError as err:
             error = str(err)
 
-    lists = [
-        x["id"]
-        for x in await conn.fetch(
-            "select id from list where user_id = $1 and id in (select list_id from cidr where address >>= $2)",
-            user_id,
-            ipn,
-        )
-    ]
+    lists = []
+    if ipn:
+        lists = list(dict.fromkeys(x["list_id"] for x in await lookup_cidrs(conn=conn, user_id=user_id, address=ipn)))
 
     return Template(
         template_name="partials/network-info.html.j2",
@@ -208,6 +204,8 @@ class WebPartListController(Controller):
                 new_list.tags,
                 new_list.description,
             )
+            if record:
+                await conn.execute(INSERT_EMPTY_SNAPSHOT, new_list.id)
         if not record:
             raise HTTPException(
                 status_code=HTTP_400_BAD_REQUEST,
@@ -438,9 +436,12 @@ class WebPartCidrController(Controller):
         """Delete CIDR."""
         address = ip + "/" + prefix
         async with conn.transaction():
-            record = await conn.fetch(
-                "delete from cidr where list_id = $1 and address = $2 returning address", list_id, address
+            records = await conn.fetch(
+                "delete from cidr where list_id = $1 and address = $2 returning list_id, address::text as address",
+                list_id,
+                address,
             )
-            if not record:
+            if not records:
                 raise NotFoundException(f"CIDR {address} not found.")
+            await update_deleted_snapshots(conn, records)
         return Response("", status_code=HTTP_200_OK)
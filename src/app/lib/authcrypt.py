@@ -1,10 +1,50 @@
+import asyncio
+import threading
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from hashlib import blake2b
 from os import urandom
+from typing import TypeVar
 
 from argon2 import PasswordHasher
 from argon2.exceptions import VerificationError, VerifyMismatchError
+from litestar.exceptions import ServiceUnavailableException
 
-ph = PasswordHasher()
+from app.lib.settings import get_settings
+
+settings = get_settings()
+
+T = TypeVar("T")
+
+# hashes made with other parameters are still verified, they're stored in the hash
+ph = PasswordHasher(
+    time_cost=settings.ARGON2_TIME_COST,
+    memory_cost=settings.ARGON2_MEMORY_COST,
+    parallelism=settings.ARGON2_PARALLELISM,
+)
+
+# argon2 releases the GIL, the hashes run in threads out of the event loop. The requests
+# waiting for a thread are limited so a burst of logins is rejected instead of queued
+_password_slots = threading.BoundedSemaphore(settings.PASSWORD_HASH_THREADS + settings.PASSWORD_HASH_MAX_QUEUE)
+
+
+@lru_cache
+def get_password_executor() -> ThreadPoolExecutor:
+    """Get the thread pool singleton of the password hashes."""
+    return ThreadPoolExecutor(max_workers=settings.PASSWORD_HASH_THREADS, thread_name_prefix="password_hash")
+
+
+async def _run_hasher(func: Callable[..., T], *args: str) -> T:
+    """Run ``func`` in the password thread pool, raising ``ServiceUnavailableException`` if it's full."""
+    if not _password_slots.acquire(blocking=False):
+        raise ServiceUnavailableException(
+            "Too many password checks in progress, retry later.", headers={"Retry-After": "1"}
+        )
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_password_executor(), func, *args)
+    finally:
+        _password_slots.release()
 
 
 async def generate_salt_and_hashed_password(plain_password: str) -> tuple[str, str]:
@@ -21,20 +61,22 @@ async def generate_salt_and_hashed_password(plain_password: str) -> tuple[str, s
     salt = b2.hexdigest()
 
     # append salt to the plain password and generate the final hash
-    hash = ph.hash(plain_password + salt)
+    hash = await _run_hasher(ph.hash, plain_password + salt)
     return salt, hash
 
 
 async def verify_password(salt: str, hashed_password: str, plain_password: str) -> bool:
     """Verifies the plain password against the hashed one."""
     try:
-        return ph.verify(hashed_password, plain_password + salt)
+        return await _run_hasher(ph.verify, hashed_password, plain_password + salt)
     except VerifyMismatchError:
         # Secret does not match the password
         return False
     except VerificationError:
         # Verification failed
         raise
+    except ServiceUnavailableException:
+        raise
     except Exception as err:
         print(err)
         raise
@@ -0,0 +1,130 @@
+"""Plain text, firewall native and binary formats of collapsed CIDRs.
+
+Each text format is written in a single pass over the networks, in chunks of
+``STREAM_CHUNK_SIZE`` lines so big sets can be streamed.
+
+The binary format is a 16 bytes header followed by the IPv4 and the IPv6 networks
+as written by ``CidrArray.to_bytes``, all integers are big endian::
+
+    magic      4 bytes  b"CIDR"
+    version    1 byte   BINARY_VERSION
+    reserved   3 bytes
+    ipv4 count 4 bytes  N
+    ipv6 count 4 bytes  M
+    IPv4       N * 4 bytes addresses, N bytes prefix lengths, padded to 8 bytes
+    IPv6       M * 8 bytes high halves, M * 8 bytes low halves, M bytes prefix lengths
+
+Every array starts at an offset aligned to its item size so it can be mapped directly.
+"""
+
+import struct
+from collections.abc import Iterable, Iterator
+from itertools import chain, islice
+
+from app.lib.cidrset import CidrArray, CidrSet, format_cidr
+from app.lib.settings import get_settings
+
+settings = get_settings()
+
+MEDIA_TYPES = {
+    "text": "text/plain",
+    "nginx": "text/plain",
+    "ipset": "text/plain",
+    "nft": "text/plain",
+    "csv": "text/csv",
+    "binary": "application/octet-stream",
+    "msgpack": "application/vnd.msgpack",
+}
+
+BINARY_MAGIC = b"CIDR"
+BINARY_VERSION = 1
+_BINARY_HEADER = struct.Struct(">4sB3xII")
+
+NFT_TABLE = "inet filter"
+
+_IPSET_FAMILIES = {4: "inet", 6: "inet6"}
+_NFT_TYPES = {4: "ipv4_addr", 6: "ipv6_addr"}
+
+
+def _cidrs(cidr_array: CidrArray, template: str) -> Iterator[str]:
+    """Iterate over the networks of ``cidr_array`` formatted with ``template``."""
+    version = cidr_array.version
+    for start, prefixlen in cidr_array:
+        yield template.format(format_cidr(version, start, prefixlen))
+
+
+def _chunks(lines: Iterable[str]) -> Iterator[bytes]:
+    """Join the lines in chunks of ``STREAM_CHUNK_SIZE``."""
+    lines = iter(lines)
+    while chunk := "".join(islice(lines, settings.STREAM_CHUNK_SIZE)):
+        yield chunk.encode()
+
+
+def _ipset(cidrs: CidrSet, name: str) -> Iterator[bytes]:
+    """``ipset restore`` file with a ``hash:net`` set per IP version."""
+    for cidr_array in (cidrs.ipv4, cidrs.ipv6):
+        set_name = f"{name}_v{cidr_array.version}"
+        family = _IPSET_FAMILIES[cidr_array.version]
+        maxelem = max(len(cidr_array), 65536)
+        yield f"create {set_name} hash:net family {family} maxelem {maxelem} -exist\nflush {set_name}\n".encode()
+        yield from _chunks(_cidrs(cidr_array, f"add {set_name} {{}}\n"))
+
+
+def _nft(cidrs: CidrSet, name: str) -> Iterator[bytes]:
+    """``nft -f`` file with an interval set per IP version in the table ``NFT_TABLE``."""
+    for cidr_array in (cidrs.ipv4, cidrs.ipv6):
+        set_name = f"{name}_v{cidr_array.version}"
+        nft_type = _NFT_TYPES[cidr_array.version]
+        yield (
+            f"add set {NFT_TABLE} {set_name} {{ type {nft_type}; flags interval; }}\nflush set {NFT_TABLE} {set_name}\n"
+        ).encode()
+        # one statement per chunk, nft has no limit but huge statements are slow to parse
+        for chunk in _chunks(_cidrs(cidr_array, "{}, ")):
+            yield f"add element {NFT_TABLE} {set_name} {{ ".encode() + chunk[:-2] + b" }\n"
+
+
+def format_cidrs(cidrs: CidrSet, cidr_format: str, name: str, allow: bool = False) -> Iterator[bytes]:
+    """Write the collapsed ``cidrs`` in ``cidr_format``, IPv4 first.
+
+    ``name`` is the prefix of the ipset and nft sets, a set is created per IP version.
+    ``allow`` writes nginx ``allow`` lines instead of ``deny`` ones.
+    """
+    if cidr_format == "ipset":
+        return _ipset(cidrs, name)
+    if cidr_format == "nft":
+        return _nft(cidrs, name)
+    if cidr_format == "csv":
+        header = ["cidr,ip_version\n"]
+        return _chunks(chain(header, _cidrs(cidrs.ipv4, "{},4\n"), _cidrs(cidrs.ipv6, "{},6\n")))
+    if cidr_format == "nginx":
+        template = "allow {};\n" if allow else "deny {};\n"
+    elif cidr_format == "text":
+        template = "{}\n"
+    else:
+        raise ValueError(f"Unknown format {cidr_format}")
+    return _chunks(chain(_cidrs(cidrs.ipv4, template), _cidrs(cidrs.ipv6, template)))
+
+
+def encode_binary(cidrs: CidrSet) -> bytes:
+    """Encode the collapsed ``cidrs`` in the binary format."""
+    ipv4 = cidrs.ipv4.to_bytes()
+    padding = b"\0" * (-len(ipv4) % 8)
+    header = _BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(cidrs.ipv4), len(cidrs.ipv6))
+    return header + ipv4 + padding + cidrs.ipv6.to_bytes()
+
+
+def decode_binary(data: bytes) -> CidrSet:
+    """Decode networks in the binary format, raising ``ValueError`` if it's malformed."""
+    if len(data) < _BINARY_HEADER.size:
+        raise ValueError("Missing binary header.")
+    magic, version, ipv4_total, ipv6_total = _BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError(f"Unknown binary format {magic!r} version {version}.")
+    ipv4_start = _BINARY_HEADER.size
+    ipv6_start = ipv4_start + ipv4_total * 5 + (-ipv4_total * 5 % 8)
+    if len(data) != ipv6_start + ipv6_total * 17:
+        raise ValueError(f"Invalid length {len(data)} for {ipv4_total} IPv4 and {ipv6_total} IPv6 networks.")
+    return CidrSet(
+        CidrArray.from_bytes(4, data[ipv4_start : ipv4_start + ipv4_total * 5]),
+        CidrArray.from_bytes(6, data[ipv6_start:]),
+    )
@@ -0,0 +1,125 @@
+"""In-memory index of the networks of many lists by prefix length.
+
+It's not a compact trie, there's a dict per prefix length in use from the network
+address to the lists holding that network, so each network costs a dict entry
+and the memory grows linearly with the networks. The networks containing another
+one are found with a dict lookup per level, usually a handful, the networks inside
+it with a binary search over the sorted addresses of each longer level.
+"""
+
+from bisect import bisect_left, bisect_right
+from collections.abc import Iterable
+
+from app.lib.cidrset import MAX_PREFIXLEN, CidrArray, CidrSet, cidr_range, parse_cidr
+
+Overlap = tuple[int, int, tuple[str, ...]]
+"""``(start, prefixlen, list_ids)`` of a network in the trie."""
+
+
+class CidrTrie:
+    """Networks by IP version and prefix length with the lists holding each one, see the module docs.
+
+    Adding and removing networks has set semantics per list, so replaying a
+    sequence of changes more than once gives the same trie.
+    """
+
+    __slots__ = ("_collapsed", "_levels", "_list_ids", "_size", "_sorted")
+
+    def __init__(self) -> None:  # noqa: D107
+        self._levels: dict[int, dict[int, dict[int, tuple[str, ...]]]] = {4: {}, 6: {}}
+        # sorted starts of each level, built on the first contained lookup after a change
+        self._sorted: dict[tuple[int, int], list[int]] = {}
+        self._collapsed: CidrSet | None = None
+        # the single list tuples are shared, most networks are in a single list
+        self._list_ids: dict[str, tuple[str, ...]] = {}
+        self._size = 0
+
+    def __len__(self) -> int:  # noqa: D105
+        return self._size
+
+    @classmethod
+    def from_networks(cls, networks: Iterable[tuple[str, str]]) -> "CidrTrie":
+        """Build a trie from ``(list_id, network)`` pairs, networks must be valid."""
+        trie = cls()
+        for list_id, network in networks:
+            trie.add(list_id, *parse_cidr(network))
+        return trie
+
+    def add(self, list_id: str, version: int, start: int, prefixlen: int) -> bool:
+        """Add a network of ``list_id``, return ``False`` if it was already there."""
+        level = self._levels[version].setdefault(prefixlen, {})
+        list_ids = level.get(start, ())
+        if list_id in list_ids:
+            return False
+        if not list_ids:
+            self._size += 1
+            self._sorted.pop((version, prefixlen), None)
+            level[start] = self._list_ids.setdefault(list_id, (list_id,))
+        else:
+            level[start] = tuple(sorted((*list_ids, list_id)))
+        self._collapsed = None
+        return True
+
+    def remove(self, list_id: str, version: int, start: int, prefixlen: int) -> bool:
+        """Remove a network of ``list_id``, return ``False`` if it wasn't there."""
+        level = self._levels[version].get(prefixlen, {})
+        list_ids = level.get(start, ())
+        if list_id not in list_ids:
+            return False
+        if len(list_ids) > 1:
+            level[start] = tuple(x for x in list_ids if x != list_id)
+            return True
+        del level[start]
+        if not level:
+            del self._levels[version][prefixlen]
+        self._size -= 1
+        self._sorted.pop((version, prefixlen), None)
+        self._collapsed = None
+        return True
+
+    def apply(self, changes: Iterable[tuple[str, str, str]]) -> None:
+        """Apply ``(list_id, network, change)`` changes in order, ``change`` is ``ADD`` or ``DELETE``."""
+        for list_id, network, change in changes:
+            if change == "ADD":
+                self.add(list_id, *parse_cidr(network))
+            else:
+                self.remove(list_id, *parse_cidr(network))
+
+    def containing(self, version: int, start: int, prefixlen: int) -> list[Overlap]:
+        """Get the networks containing or equal to a network, the most specific first."""
+        max_prefixlen = MAX_PREFIXLEN[version]
+        found = []
+        for level_prefixlen, level in self._levels[version].items():
+            if level_prefixlen <= prefixlen:
+                level_start = start >> (max_prefixlen - level_prefixlen) << (max_prefixlen - level_prefixlen)
+                if level_start in level:
+                    found.append((level_start, level_prefixlen, level[level_start]))
+        return sorted(found, key=lambda x: -x[1])
+
+    def contained(self, version: int, start: int, prefixlen: int) -> list[Overlap]:
+        """Get the networks strictly inside a network, sorted by address."""
+        first, last = cidr_range(version, start, prefixlen)
+        found = []
+        for level_prefixlen, level in self._levels[version].items():
+            if level_prefixlen > prefixlen:
+                starts = self._sorted.get((version, level_prefixlen))
+                if starts is None:
+                    starts = self._sorted[(version, level_prefixlen)] = sorted(level)
+                for level_start in starts[bisect_left(starts, first) : bisect_right(starts, last)]:
+                    found.append((level_start, level_prefixlen, level[level_start]))
+        return sorted(found)
+
+    def overlaps(self, version: int, start: int, prefixlen: int) -> list[Overlap]:
+        """Get the networks containing a network and the ones inside it."""
+        return self.containing(version, start, prefixlen) + self.contained(version, start, prefixlen)
+
+    def collapse(self) -> CidrSet:
+        """Get the networks of all the lists collapsed, cached until the trie changes."""
+        if self._collapsed is None:
+            arrays = {4: CidrArray(4), 6: CidrArray(6)}
+            for version, levels in self._levels.items():
+                for prefixlen, level in levels.items():
+                    for start in level:
+                        arrays[version].append(start, prefixlen)
+            self._collapsed = CidrSet(arrays[4], arrays[6]).collapse()
+        return self._collapsed
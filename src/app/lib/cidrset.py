@@ -0,0 +1,367 @@
+import sys
+from array import array
+from bisect import bisect_right
+from collections.abc import Iterable, Iterator
+from ipaddress import IPv4Network, IPv6Address, IPv6Network, ip_network
+from itertools import chain
+from socket import AF_INET6, inet_pton
+
+from app.lib.iputils import exclude_ranges_many, merge_ranges, range_to_cidrs
+
+MAX_PREFIXLEN = {4: 32, 6: 128}
+
+# Superset of the special purpose ranges from the IANA registries, a network whose first address is
+# outside of these ranges is always global. Networks inside them are checked with ``ipaddress``.
+_SPECIAL_NETWORKS = {
+    4: [
+        "0.0.0.0/8",
+        "10.0.0.0/8",
+        "100.64.0.0/10",
+        "127.0.0.0/8",
+        "169.254.0.0/16",
+        "172.16.0.0/12",
+        "192.0.0.0/24",
+        "192.0.2.0/24",
+        "192.88.99.0/24",
+        "192.168.0.0/16",
+        "198.18.0.0/15",
+        "198.51.100.0/24",
+        "203.0.113.0/24",
+        "240.0.0.0/4",
+    ],
+    6: [
+        "::/8",
+        "100::/8",
+        "2001::/16",
+        "2002::/16",
+        "3fff::/16",
+        "5f00::/16",
+        "fc00::/7",
+        "fe80::/9",
+    ],
+}
+
+
+def _special_ranges(version: int) -> list[tuple[int, int]]:
+    return merge_ranges(
+        (int(x.network_address), int(x.broadcast_address)) for x in map(ip_network, _SPECIAL_NETWORKS[version])
+    )
+
+
+SPECIAL_RANGES = {4: _special_ranges(4), 6: _special_ranges(6)}
+_SPECIAL_STARTS = {version: [x[0] for x in ranges] for version, ranges in SPECIAL_RANGES.items()}
+
+
+def _parse_cidr_slow(cidr: str) -> tuple[int, int, int]:
+    """Parse the formats not handled by ``parse_cidr`` (netmasks, scoped addresses...) with ``ipaddress``."""
+    ipn = ip_network(cidr)
+    return ipn.version, int(ipn.network_address), ipn.prefixlen
+
+
+def _parse_ipv4_address(address: str) -> int | None:
+    """Parse a dotted-quad IPv4 address, returns ``None`` if it isn't one."""
+    octets = address.split(".")
+    if len(octets) != 4:
+        return None
+    value = 0
+    for octet in octets:
+        if not (octet.isascii() and octet.isdigit()) or len(octet) > 3 or (octet[0] == "0" and len(octet) > 1):
+            return None
+        if int(octet) > 255:
+            return None
+        value = value << 8 | int(octet)
+    return value
+
+
+def _parse_ipv6_address(address: str) -> int | None:
+    """Parse an IPv6 address without scope or embedded IPv4, returns ``None`` if it isn't one."""
+    if "%" in address or "." in address:
+        return None
+    try:
+        return int.from_bytes(inet_pton(AF_INET6, address), "big")
+    except OSError:
+        return None
+
+
+def parse_cidr(cidr: str) -> tuple[int, int, int]:
+    """Parse an IPv4/IPv6 address or network returning ``(version, network address, prefixlen)``.
+
+    Accepts the same input as ``ipaddress.ip_network`` in strict mode (host bits can't be set)
+    without creating any ``ipaddress`` object for the common formats.
+
+    Raises ``ValueError`` if ``cidr`` is malformed.
+    """
+    address, sep, prefix = cidr.partition("/")
+    if sep and not (prefix.isascii() and prefix.isdigit()):
+        return _parse_cidr_slow(cidr)
+
+    version = 6 if ":" in address else 4
+    start = _parse_ipv6_address(address) if version == 6 else _parse_ipv4_address(address)
+    max_prefixlen = MAX_PREFIXLEN[version]
+    prefixlen = int(prefix) if sep else max_prefixlen
+    if start is None or prefixlen > max_prefixlen:
+        return _parse_cidr_slow(cidr)
+    if start & ((1 << (max_prefixlen - prefixlen)) - 1):
+        raise ValueError(f"{cidr} has host bits set")
+    return version, start, prefixlen
+
+
+def cidr_range(version: int, start: int, prefixlen: int) -> tuple[int, int]:
+    """Return the ``(first, last)`` addresses of a parsed network."""
+    return start, start + (1 << (MAX_PREFIXLEN[version] - prefixlen)) - 1
+
+
+def is_global_cidr(version: int, start: int, prefixlen: int) -> bool:
+    """Return the same as ``ip_network(...).is_global`` for a parsed network."""
+    i = bisect_right(_SPECIAL_STARTS[version], start) - 1
+    if i < 0 or start > SPECIAL_RANGES[version][i][1]:
+        return True
+    network_class = IPv4Network if version == 4 else IPv6Network
+    return network_class((start, prefixlen)).is_global
+
+
+def _compress_hextets(hextets: list[str]) -> list[str]:
+    """Replace the longest run of zeros with '::', like ``ipaddress`` does."""
+    best_start, best_len = -1, 0
+    run_start, run_len = -1, 0
+    for index, hextet in enumerate(hextets):
+        if hextet == "0":
+            run_len += 1
+            if run_start == -1:
+                run_start = index
+            if run_len > best_len:
+                best_start, best_len = run_start, run_len
+        else:
+            run_start, run_len = -1, 0
+
+    if best_len > 1:
+        best_end = best_start + best_len
+        if best_end == len(hextets):
+            hextets += [""]
+        hextets[best_start:best_end] = [""]
+        if best_start == 0:
+            hextets = ["", *hextets]
+    return hextets
+
+
+def format_address(version: int, address: int) -> str:
+    """Return the compressed string of an integer address, same as ``ipaddress``."""
+    if version == 4:
+        return f"{address >> 24}.{address >> 16 & 255}.{address >> 8 & 255}.{address & 255}"
+    if address >> 32 == 0xFFFF:
+        # the representation of IPv4-mapped addresses depends on the python version
+        return IPv6Address(address).compressed
+    return ":".join(_compress_hextets([f"{address >> shift & 0xFFFF:x}" for shift in range(112, -1, -16)]))
+
+
+def format_cidr(version: int, start: int, prefixlen: int) -> str:
+    """Return the compressed string of a network, same as ``ipaddress``."""
+    return f"{format_address(version, start)}/{prefixlen}"
+
+
+class CidrArray:
+    """Networks of a single IP version stored as parallel arrays of network addresses and prefix lengths.
+
+    IPv4 addresses are stored in an ``array('I')``, IPv6 addresses as two ``array('Q')`` (high and low 64 bits).
+    """
+
+    __slots__ = ("_high", "_low", "prefixlens", "version")
+    __hash__ = None  # type: ignore[assignment]
+
+    def __init__(self, version: int) -> None:  # noqa: D107
+        if version not in MAX_PREFIXLEN:
+            raise ValueError(f"Unknown IP Version {version}")
+        self.version = version
+        self.prefixlens = array("B")
+        self._low = array("I") if version == 4 else array("Q")
+        self._high = array("Q")
+
+    @classmethod
+    def from_ranges(cls, version: int, ranges: Iterable[tuple[int, int]]) -> "CidrArray":
+        """Build the minimal list of networks covering ``ranges``, which must be merged and sorted."""
+        cidr_array = cls(version)
+        max_prefixlen = MAX_PREFIXLEN[version]
+        for start, end in ranges:
+            for network, prefixlen in range_to_cidrs(start, end, max_prefixlen):
+                cidr_array.append(network, prefixlen)
+        return cidr_array
+
+    @classmethod
+    def from_buffers(cls, version: int, low: bytes, prefixlens: bytes, high: bytes = b"") -> "CidrArray":
+        """Build the array from the raw (native byte order) buffers of its internal arrays.
+
+        ``low`` holds 32 bit addresses for IPv4 and the low 64 bits of the addresses for IPv6,
+        ``high`` holds the high 64 bits of the IPv6 addresses.
+        """
+        cidr_array = cls(version)
+        cidr_array._low.frombytes(low)
+        cidr_array._high.frombytes(high)
+        cidr_array.prefixlens.frombytes(prefixlens)
+        if len(cidr_array._low) != len(cidr_array.prefixlens) or (
+            version == 6 and len(cidr_array._high) != len(cidr_array._low)
+        ):
+            raise ValueError("Buffers of different length.")
+        return cidr_array
+
+    @classmethod
+    def from_bytes(cls, version: int, data: bytes) -> "CidrArray":
+        """Build the array from the output of ``to_bytes``."""
+        entry_size = 5 if version == 4 else 17
+        if len(data) % entry_size:
+            raise ValueError(f"Invalid length {len(data)} for IPv{version} networks.")
+        cidr_array = cls(version)
+        total = len(data) // entry_size
+        address_size = cidr_array._low.itemsize * total
+        parts = [cidr_array._low] if version == 4 else [cidr_array._high, cidr_array._low]
+        for i, part in enumerate(parts):
+            part.frombytes(data[i * address_size : (i + 1) * address_size])
+            if sys.byteorder == "little":
+                part.byteswap()
+        cidr_array.prefixlens.frombytes(data[len(parts) * address_size :])
+        return cidr_array
+
+    @classmethod
+    def from_strings(cls, version: int, cidrs: Iterable[str]) -> "CidrArray":
+        """Parse ``cidrs``, raising ``ValueError`` if any is malformed or from another IP version."""
+        cidr_array = cls(version)
+        for cidr in cidrs:
+            cidr_version, start, prefixlen = parse_cidr(cidr)
+            if cidr_version != version:
+                raise ValueError(f"{cidr} is not an IPv{version} network")
+            cidr_array.append(start, prefixlen)
+        return cidr_array
+
+    def append(self, start: int, prefixlen: int) -> None:
+        """Append a network, ``start`` must be a valid network address for ``prefixlen``."""
+        if self.version == 4:
+            self._low.append(start)
+        else:
+            self._high.append(start >> 64)
+            self._low.append(start & 0xFFFFFFFFFFFFFFFF)
+        self.prefixlens.append(prefixlen)
+
+    def to_bytes(self) -> bytes:
+        """Serialize the networks as big endian addresses followed by the prefix lengths.
+
+        IPv4 uses 4 bytes per address, IPv6 8 bytes per high half and then 8 bytes per low half.
+        """
+        parts = [self._low] if self.version == 4 else [self._high, self._low]
+        data = bytearray()
+        for part in parts:
+            if sys.byteorder == "little":
+                part = array(part.typecode, part)  # noqa: PLW2901
+                part.byteswap()
+            data += part.tobytes()
+        data += self.prefixlens.tobytes()
+        return bytes(data)
+
+    def starts(self) -> Iterator[int]:
+        """Iterate over the network addresses."""
+        if self.version == 4:
+            return iter(self._low)
+        return (high << 64 | low for high, low in zip(self._high, self._low, strict=True))
+
+    def __iter__(self) -> Iterator[tuple[int, int]]:
+        """Iterate over ``(network address, prefixlen)``."""
+        return zip(self.starts(), self.prefixlens, strict=True)
+
+    def __len__(self) -> int:  # noqa: D105
+        return len(self.prefixlens)
+
+    def __eq__(self, other: object) -> bool:  # noqa: D105
+        if not isinstance(other, CidrArray):
+            return NotImplemented
+        return self.version == other.version and list(self) == list(other)
+
+    def __repr__(self) -> str:  # noqa: D105
+        return f"CidrArray(version={self.version}, networks={len(self)})"
+
+    def ranges(self) -> Iterator[tuple[int, int]]:
+        """Iterate over the ``(first, last)`` addresses of each network."""
+        version = self.version
+        for start, prefixlen in self:
+            yield cidr_range(version, start, prefixlen)
+
+    def collapse(self) -> "CidrArray":
+        """Return the networks collapsed, same as ``ipaddress.collapse_addresses``."""
+        return CidrArray.from_ranges(self.version, merge_ranges(self.ranges()))
+
+    def union(self, other: "CidrArray") -> "CidrArray":
+        """Return the collapsed union of both arrays."""
+        return CidrArray.from_ranges(self.version, merge_ranges(chain(self.ranges(), other.ranges())))
+
+    def difference(self, other: "CidrArray") -> "CidrArray":
+        """Return the collapsed networks of this array with the addresses of ``other`` excluded."""
+        left = exclude_ranges_many(merge_ranges(self.ranges()), other.ranges())
+        return CidrArray.from_ranges(self.version, chain.from_iterable(left))
+
+    def to_strings(self) -> Iterator[str]:
+        """Iterate over the compressed string of each network."""
+        version = self.version
+        for start, prefixlen in self:
+            yield format_cidr(version, start, prefixlen)
+
+
+class CidrSet:
+    """IPv4 and IPv6 networks stored as a ``CidrArray`` per IP version."""
+
+    __slots__ = ("ipv4", "ipv6")
+    __hash__ = None  # type: ignore[assignment]
+
+    def __init__(self, ipv4: CidrArray | None = None, ipv6: CidrArray | None = None) -> None:  # noqa: D107
+        self.ipv4 = ipv4 if ipv4 is not None else CidrArray(4)
+        self.ipv6 = ipv6 if ipv6 is not None else CidrArray(6)
+
+    @classmethod
+    def from_strings(cls, cidrs: Iterable[str]) -> "CidrSet":
+        """Parse ``cidrs``, raising ``ValueError`` if any is malformed."""
+        cidr_set = cls()
+        for cidr in cidrs:
+            cidr_set.add(*parse_cidr(cidr))
+        return cidr_set
+
+    def add(self, version: int, start: int, prefixlen: int) -> None:
+        """Add a parsed network."""
+        self.by_version(version).append(start, prefixlen)
+
+    def by_version(self, version: int) -> CidrArray:
+        """Return the networks of an IP version."""
+        if version == 4:
+            return self.ipv4
+        if version == 6:
+            return self.ipv6
+        raise ValueError(f"Unknown IP Version {version}")
+
+    def __iter__(self) -> Iterator[tuple[int, int, int]]:
+        """Iterate over ``(version, network address, prefixlen)``, IPv4 first."""
+        for cidr_array in (self.ipv4, self.ipv6):
+            version = cidr_array.version
+            for start, prefixlen in cidr_array:
+                yield version, start, prefixlen
+
+    def __len__(self) -> int:  # noqa: D105
+        return len(self.ipv4) + len(self.ipv6)
+
+    def __eq__(self, other: object) -> bool:  # noqa: D105
+        if not isinstance(other, CidrSet):
+            return NotImplemented
+        return self.ipv4 == other.ipv4 and self.ipv6 == other.ipv6
+
+    def __repr__(self) -> str:  # noqa: D105
+        return f"CidrSet(ipv4={len(self.ipv4)}, ipv6={len(self.ipv6)})"
+
+    def collapse(self) -> "CidrSet":
+        """Return the networks collapsed by IP version."""
+        return CidrSet(self.ipv4.collapse(), self.ipv6.collapse())
+
+    def union(self, other: "CidrSet") -> "CidrSet":
+        """Return the collapsed union of both sets."""
+        return CidrSet(self.ipv4.union(other.ipv4), self.ipv6.union(other.ipv6))
+
+    def difference(self, other: "CidrSet") -> "CidrSet":
+        """Return the collapsed networks of this set with the addresses of ``other`` excluded."""
+        return CidrSet(self.ipv4.difference(other.ipv4), self.ipv6.difference(other.ipv6))
+
+    def to_strings(self) -> Iterator[str]:
+        """Iterate over the compressed string of each network, IPv4 first."""
+        return chain(self.ipv4.to_strings(), self.ipv6.to_strings())
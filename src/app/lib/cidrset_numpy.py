@@ -0,0 +1,231 @@
+"""Vectorized parsing and collapsing of big lists of CIDRs.
+
+Needs the optional dependency ``numpy``, check ``HAS_NUMPY`` before using it.
+The output is always the same as the pure python path in ``app.lib.cidrset``.
+"""
+
+from collections import Counter
+
+from app.lib.cidrset import SPECIAL_RANGES, CidrArray, CidrSet, is_global_cidr, parse_cidr
+from app.lib.iputils import range_to_cidrs
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore[assignment]
+
+HAS_NUMPY = np is not None
+
+# "255.255.255.255/32", longer strings are parsed by the pure python path
+_MAX_IPV4_CIDR_LEN = 18
+_CHAR_0, _CHAR_9, _CHAR_DOT, _CHAR_SLASH = ord("0"), ord("9"), ord("."), ord("/")
+_UINT64_MAX = 0xFFFFFFFFFFFFFFFF
+
+
+def _parse_ipv4(cidrs: list[str]) -> tuple["np.ndarray", "np.ndarray", "np.ndarray"]:
+    """Parse dotted-quad IPv4 addresses and networks.
+
+    Returns the network addresses, the prefix lengths and a mask with the
+    rows that were parsed, the rest must be parsed by ``parse_cidr``.
+    """
+    total = len(cidrs)
+    # the array is as wide as the longest string, the long ones are left out so a single
+    # junk string doesn't make it huge, they're never dotted-quad IPv4 CIDRs
+    strings = np.array([x if len(x) <= _MAX_IPV4_CIDR_LEN else "" for x in cidrs], dtype=str)
+    width = strings.dtype.itemsize // 4
+    chars = strings.view(np.uint32).reshape(total, width).astype(np.int64)
+    # numpy drops trailing NULs, those strings aren't valid, nor the ones left out
+    ok = np.char.str_len(strings) == np.fromiter(map(len, cidrs), dtype=np.int64, count=total)
+
+    rows = np.arange(total)
+    values = np.zeros((total, 5), dtype=np.int64)  # 4 octets + prefixlen
+    digits = np.zeros((total, 5), dtype=np.int64)
+    field = np.zeros(total, dtype=np.int64)
+    ended = np.zeros(total, dtype=bool)
+
+    for column in chars.T:
+        is_end = column == 0
+        is_digit = (column >= _CHAR_0) & (column <= _CHAR_9) & ~ended
+        is_dot = (column == _CHAR_DOT) & ~ended
+        is_slash = (column == _CHAR_SLASH) & ~ended
+        ok &= ~(ended & ~is_end)  # nothing can follow the end of the string
+        ok &= is_end | is_digit | is_dot | is_slash
+
+        field_value = values[rows, field]
+        field_digits = digits[rows, field]
+        # octets can't have leading zeros, the prefixlen can
+        ok &= ~(is_digit & (field < 4) & (field_digits > 0) & (field_value == 0))
+        ok &= ~((is_dot | is_slash) & (field_digits == 0))
+        ok &= ~(is_dot & (field >= 3))
+        ok &= ~(is_slash & (field != 3))
+
+        values[rows, field] = np.where(is_digit, field_value * 10 + column - _CHAR_0, field_value)
+        digits[rows, field] = field_digits + is_digit
+        field = np.minimum(field + (is_dot | is_slash), 4)  # invalid rows can't go further
+        ended |= is_end
+
+    ok &= digits[:, 3] > 0
+    ok &= (field == 3) | ((field == 4) & (digits[:, 4] > 0))
+    ok &= (digits[:, :4] <= 3).all(axis=1) & (values[:, :4] <= 255).all(axis=1)
+    ok &= (digits[:, 4] <= 3) & (values[:, 4] <= 32)
+
+    starts = values[:, 0] << 24 | values[:, 1] << 16 | values[:, 2] << 8 | values[:, 3]
+    prefixlens = np.where(field == 4, values[:, 4], 32)
+    return starts, prefixlens, ok
+
+
+def _maybe_special(version: int, starts: "np.ndarray") -> "np.ndarray":
+    """Return a mask with the addresses that fall in a special purpose range."""
+    special_starts = np.array([x[0] for x in SPECIAL_RANGES[version]], dtype=np.int64)
+    special_ends = np.array([x[1] for x in SPECIAL_RANGES[version]], dtype=np.int64)
+    index = np.searchsorted(special_starts, starts, side="right") - 1
+    return (index >= 0) & (starts <= special_ends[np.maximum(index, 0)])
+
+
+def _collapse_ipv4(starts: "np.ndarray", prefixlens: "np.ndarray") -> CidrArray:
+    """Collapse IPv4 networks, same as ``CidrArray.collapse``."""
+    if not starts.size:
+        return CidrArray(4)
+
+    order = np.argsort(starts, kind="stable")
+    starts = starts[order]
+    ends = starts + (np.int64(1) << (32 - prefixlens[order])) - 1
+
+    # merge the ranges that overlap or are adjacent
+    max_ends = np.maximum.accumulate(ends)
+    firsts = np.flatnonzero(np.concatenate(([True], starts[1:] > max_ends[:-1] + 1)))
+    range_starts = starts[firsts]
+    range_ends = np.maximum.reduceat(ends, firsts)
+
+    # split each range in the largest aligned blocks, at most 32 iterations
+    out_starts = []
+    out_prefixlens = []
+    while range_starts.size:
+        lowest_bit = np.where(range_starts == 0, np.int64(1) << 32, range_starts & -range_starts)
+        largest_fit = np.int64(1) << (np.frexp((range_ends - range_starts + 1).astype(np.float64))[1] - 1)
+        block = np.minimum(lowest_bit, largest_fit)
+        out_starts.append(range_starts)
+        out_prefixlens.append(33 - np.frexp(block.astype(np.float64))[1])
+        range_starts = range_starts + block
+        pending = range_starts <= range_ends
+        range_starts = range_starts[pending]
+        range_ends = range_ends[pending]
+
+    result_starts = np.concatenate(out_starts)
+    order = np.argsort(result_starts, kind="stable")
+    return CidrArray.from_buffers(
+        4,
+        low=result_starts[order].astype(np.uint32).tobytes(),
+        prefixlens=np.concatenate(out_prefixlens)[order].astype(np.uint8).tobytes(),
+    )
+
+
+def _collapse_ipv6(starts: list[int], prefixlens: list[int]) -> CidrArray:
+    """Collapse IPv6 networks, same as ``CidrArray.collapse``.
+
+    Addresses are handled as two uint64 halves, the merge is done over the ranks
+    of the 128 bit values so it can use the int64 array operations.
+    """
+    if not starts:
+        return CidrArray(6)
+
+    high = np.array([x >> 64 for x in starts], dtype=np.uint64)
+    low = np.array([x & _UINT64_MAX for x in starts], dtype=np.uint64)
+    host_bits = 128 - np.array(prefixlens, dtype=np.int64)
+    ones = np.uint64(_UINT64_MAX)
+    low_mask = np.where(host_bits >= 64, ones, (np.uint64(1) << np.minimum(host_bits, 63).astype(np.uint64)) - 1)
+    high_mask = np.where(
+        host_bits >= 128,
+        ones,
+        np.where(host_bits > 64, (np.uint64(1) << np.clip(host_bits - 64, 0, 63).astype(np.uint64)) - 1, 0),
+    ).astype(np.uint64)
+    end_high, end_low = high | high_mask, low | low_mask
+    # ``start - 1`` to find adjacent ranges, ``::`` has nothing before it
+    before_low = low - np.uint64(1)
+    before_high = high - (low == 0).astype(np.uint64)
+    is_zero = (high == 0) & (low == 0)
+
+    # rank the 128 bit values, lexsort over two uint64 keys is much faster than a structured sort
+    values_high = np.concatenate((end_high, before_high))
+    values_low = np.concatenate((end_low, before_low))
+    values_order = np.lexsort((values_low, values_high))
+    sorted_high, sorted_low = values_high[values_order], values_low[values_order]
+    is_new = np.concatenate(([True], (sorted_high[1:] != sorted_high[:-1]) | (sorted_low[1:] != sorted_low[:-1])))
+    ranks = np.empty(values_order.size, dtype=np.int64)
+    ranks[values_order] = np.cumsum(is_new) - 1
+    unique_high, unique_low = sorted_high[is_new], sorted_low[is_new]
+    end_ranks, before_ranks = ranks[: len(starts)], np.where(is_zero, -1, ranks[len(starts) :])
+
+    order = np.lexsort((low, high))
+    end_ranks, before_ranks = end_ranks[order], before_ranks[order]
+    max_end_ranks = np.maximum.accumulate(end_ranks)
+    firsts = np.flatnonzero(np.concatenate(([True], before_ranks[1:] > max_end_ranks[:-1])))
+    range_end_ranks = np.maximum.reduceat(end_ranks, firsts)
+    range_ends = zip(unique_high[range_end_ranks].tolist(), unique_low[range_end_ranks].tolist(), strict=True)
+
+    cidr_array = CidrArray(6)
+    for first, (range_end_high, range_end_low) in zip(order[firsts].tolist(), range_ends, strict=True):
+        for start, prefixlen in range_to_cidrs(starts[first], range_end_high << 64 | range_end_low, 128):
+            cidr_array.append(start, prefixlen)
+    return cidr_array
+
+
+def parse_cidrs_vectorized(cidrs: list[str], only_global: bool = True) -> tuple[Counter, CidrSet]:
+    """Vectorized version of ``app.lib.worker.parse_raw_cidrs``.
+
+    Dotted-quad IPv4 CIDRs are parsed, masked, sorted and collapsed with array operations,
+    IPv6 and any other format are parsed by ``parse_cidr`` and collapsed as two uint64 halves.
+    """
+    result = Counter(total_job=len(cidrs), malformed=0, non_global=0)
+    if not cidrs:
+        return result, CidrSet()
+
+    ipv4_starts, ipv4_prefixlens, parsed = _parse_ipv4(cidrs)
+
+    ipv4_fallback_starts: list[int] = []
+    ipv4_fallback_prefixlens: list[int] = []
+    ipv6_starts: list[int] = []
+    ipv6_prefixlens: list[int] = []
+    for i in np.flatnonzero(~parsed).tolist():
+        try:
+            version, start, prefixlen = parse_cidr(cidrs[i])
+        except ValueError:
+            result["malformed"] += 1
+            continue
+        if only_global and not is_global_cidr(version, start, prefixlen):
+            result["not_global"] += 1
+            continue
+        if version == 4:
+            ipv4_fallback_starts.append(start)
+            ipv4_fallback_prefixlens.append(prefixlen)
+        else:
+            ipv6_starts.append(start)
+            ipv6_prefixlens.append(prefixlen)
+
+    ipv4_starts, ipv4_prefixlens = ipv4_starts[parsed], ipv4_prefixlens[parsed]
+    host_bits_set = (ipv4_starts & ((np.int64(1) << (32 - ipv4_prefixlens)) - 1)) != 0
+    result["malformed"] += int(host_bits_set.sum())
+    ipv4_starts, ipv4_prefixlens = ipv4_starts[~host_bits_set], ipv4_prefixlens[~host_bits_set]
+
+    if only_global:
+        maybe_special = np.flatnonzero(_maybe_special(4, ipv4_starts))
+        not_global = [
+            i
+            for i, start, prefixlen in zip(
+                maybe_special.tolist(),
+                ipv4_starts[maybe_special].tolist(),
+                ipv4_prefixlens[maybe_special].tolist(),
+                strict=True,
+            )
+            if not is_global_cidr(4, start, prefixlen)
+        ]
+        if not_global:
+            result["not_global"] += len(not_global)
+            ipv4_starts = np.delete(ipv4_starts, not_global)
+            ipv4_prefixlens = np.delete(ipv4_prefixlens, not_global)
+
+    ipv4 = _collapse_ipv4(
+        np.concatenate((ipv4_starts, np.array(ipv4_fallback_starts, dtype=np.int64))),
+        np.concatenate((ipv4_prefixlens, np.array(ipv4_fallback_prefixlens, dtype=np.int64))),
+    )
+    return result, CidrSet(ipv4, _collapse_ipv6(ipv6_starts, ipv6_prefixlens))
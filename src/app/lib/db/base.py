@@ -4,6 +4,7 @@ from functools import lru_cache
 
 import asyncpg
 
+from app.lib.metrics import DB_POOL_ACQUIRE_SECONDS
 from app.lib.settings import get_settings
 
 settings = get_settings()
@@ -12,6 +13,20 @@ dsn = (
     f"postgres://{settings.DB_USERNAME}:{settings.DB_PASSWORD}@{settings.DB_HOST}:{settings.DB_PORT}/{settings.DB_NAME}"
 )
 
+CONNECTION_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.exceptions.OperatorInterventionError,  # DB shutting down or starting up
+    asyncpg.InterfaceError,
+)
+"""Errors raised when the DB can't be reached, usually while it restarts."""
+
+
+def backoff_delay(attempt: int) -> float:
+    """Return the seconds to wait before the retry number ``attempt`` (starting at 1)."""
+    return min(2 ** (attempt - 1), settings.DB_RETRY_MAX_DELAY)
+
 
 async def get_connection() -> AsyncGenerator[asyncpg.Connection, None]:
     """Get a connection to the DB."""
@@ -25,22 +40,40 @@ async def get_connection() -> AsyncGenerator[asyncpg.Connection, None]:
 class DBManager:
     pool: asyncpg.Pool
 
+    def __init__(self, min_size: int = settings.DB_POOL_MIN_SIZE, max_size: int = settings.DB_POOL_MAX_SIZE) -> None:
+        """Set the pool size, the pool is created by ``setup``."""
+        self.min_size = min_size
+        self.max_size = max_size
+
     async def setup(self) -> None:
-        """Initialize the DB pool."""
-        pool = await asyncpg.create_pool(
-            dsn=dsn,
-            timeout=30,
-            min_size=settings.DB_POOL_MIN_SIZE,
-            max_size=settings.DB_POOL_MAX_SIZE,
-            max_inactive_connection_lifetime=settings.DB_POOL_MAX_IDLE_TIMEOUT,
-        )
+        """Initialize the DB pool, retrying with backoff while the DB can't be reached."""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                pool = await asyncpg.create_pool(
+                    dsn=dsn,
+                    timeout=30,
+                    min_size=self.min_size,
+                    max_size=self.max_size,
+                    max_inactive_connection_lifetime=settings.DB_POOL_MAX_IDLE_TIMEOUT,
+                    statement_cache_size=settings.DB_STATEMENT_CACHE_SIZE,
+                )
+                break
+            except CONNECTION_ERRORS as err:
+                if attempt >= settings.DB_SETUP_RETRIES:
+                    raise
+                delay = backoff_delay(attempt)
+                print(f"Could not connect to the DB ({err!r}), retrying in {delay} seconds ...")
+                await asyncio.sleep(delay)
         if not isinstance(pool, asyncpg.Pool):
             raise Exception("Pool is not initialized")
         self.pool = pool
 
     async def get_connection(self) -> AsyncGenerator[asyncpg.pool.PoolConnectionProxy, None]:
         """Get a connection from the pool."""
-        conn = await self.pool.acquire(timeout=settings.DB_POOL_ACQUIRE_CONN_TIMEOUT)
+        with DB_POOL_ACQUIRE_SECONDS.time():
+            conn = await self.pool.acquire(timeout=settings.DB_POOL_ACQUIRE_CONN_TIMEOUT)
         try:
             yield conn
         finally:
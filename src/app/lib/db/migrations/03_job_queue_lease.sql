@@ -0,0 +1,12 @@
+BEGIN;
+
+-- job_queue claims, a job claimed by a worker is available again
+-- for other workers when its lease expires
+
+ALTER TABLE job_queue
+  ADD COLUMN claimed_by TEXT NULL,
+  ADD COLUMN claimed_at TIMESTAMPTZ NULL;
+
+CREATE INDEX job_queue_user_id_idx ON job_queue ((payload->>'user_id'), id);
+
+COMMIT;
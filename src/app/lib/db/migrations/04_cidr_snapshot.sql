@@ -0,0 +1,19 @@
+BEGIN;
+
+-- cidr_snapshot definition
+-- collapsed CIDRs of each list maintained by the worker, the addresses are
+-- encoded by CidrArray.to_bytes(), the version grows with every change
+
+CREATE SEQUENCE cidr_snapshot_version_seq;
+
+CREATE TABLE cidr_snapshot (
+  list_id TEXT NOT NULL,
+  version BIGINT NOT NULL,
+  ipv4 BYTEA NOT NULL,
+  ipv6 BYTEA NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (list_id),
+  FOREIGN KEY (list_id) REFERENCES list(id) ON DELETE CASCADE
+);
+
+COMMIT;
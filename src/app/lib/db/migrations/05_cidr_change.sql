@@ -0,0 +1,97 @@
+BEGIN;
+
+-- cidr_change definition
+-- log of the addresses added to and deleted from each list, fed by triggers so
+-- every writer (worker, TTL expiry, web) is covered. LIST rows record changes of
+-- the list itself (enabled, list_type, tags or deleted) that need a full resync.
+-- txid is the transaction that made the change, readers use it as the cursor.
+
+CREATE TYPE cidr_change_datatype AS ENUM (
+  'ADD',
+  'DELETE',
+  'LIST');
+
+CREATE TABLE cidr_change (
+  id BIGSERIAL NOT NULL,
+  txid BIGINT NOT NULL DEFAULT pg_current_xact_id()::text::bigint,
+  user_id UUID NOT NULL,
+  list_id TEXT NOT NULL,
+  address CIDR NULL,
+  change cidr_change_datatype NOT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (id)
+);
+
+CREATE INDEX cidr_change_user_id_txid_idx ON cidr_change (user_id, txid);
+CREATE INDEX cidr_change_created_at_idx ON cidr_change (created_at);
+
+-- the log is pruned by age, cursors older than the watermark need a full resync
+CREATE TABLE cidr_change_watermark (
+  id BOOLEAN NOT NULL DEFAULT true CHECK (id),
+  txid BIGINT NOT NULL,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (id)
+);
+
+INSERT INTO cidr_change_watermark (txid) VALUES (pg_snapshot_xmin(pg_current_snapshot())::text::bigint);
+
+-- Statement level triggers, the rows of deleted lists are skipped, their LIST row covers them
+CREATE FUNCTION log_cidr_added()
+RETURNS TRIGGER
+LANGUAGE plpgsql AS
+$func$
+BEGIN
+  INSERT INTO cidr_change (user_id, list_id, address, change)
+  SELECT l.user_id, n.list_id, n.address, 'ADD'
+  FROM new_rows n JOIN list l ON l.id = n.list_id;
+  RETURN NULL;
+END
+$func$;
+
+CREATE FUNCTION log_cidr_deleted()
+RETURNS TRIGGER
+LANGUAGE plpgsql AS
+$func$
+BEGIN
+  INSERT INTO cidr_change (user_id, list_id, address, change)
+  SELECT l.user_id, o.list_id, o.address, 'DELETE'
+  FROM old_rows o JOIN list l ON l.id = o.list_id;
+  RETURN NULL;
+END
+$func$;
+
+CREATE FUNCTION log_list_changed()
+RETURNS TRIGGER
+LANGUAGE plpgsql AS
+$func$
+BEGIN
+  INSERT INTO cidr_change (user_id, list_id, change) VALUES (OLD.user_id, OLD.id, 'LIST');
+  RETURN NULL;
+END
+$func$;
+
+CREATE TRIGGER trig_cidr_change_insert after
+INSERT
+  ON
+  cidr REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION log_cidr_added();
+
+CREATE TRIGGER trig_cidr_change_delete after
+DELETE
+  ON
+  cidr REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION log_cidr_deleted();
+
+CREATE TRIGGER trig_list_change_update after
+UPDATE
+  OF enabled, list_type, tags ON
+  list FOR EACH ROW
+  WHEN (OLD.enabled IS DISTINCT FROM NEW.enabled
+    OR OLD.list_type IS DISTINCT FROM NEW.list_type
+    OR OLD.tags IS DISTINCT FROM NEW.tags)
+  EXECUTE FUNCTION log_list_changed();
+
+CREATE TRIGGER trig_list_change_delete after
+DELETE
+  ON
+  list FOR EACH ROW EXECUTE FUNCTION log_list_changed();
+
+COMMIT;
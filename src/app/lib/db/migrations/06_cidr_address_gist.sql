@@ -0,0 +1,8 @@
+BEGIN;
+
+-- GiST index for the containment lookups (>>=, <<=, &&) on the CIDRs,
+-- the primary key can't be used for them
+
+CREATE INDEX cidr_address_gist_idx ON cidr USING gist (address inet_ops);
+
+COMMIT;
@@ -0,0 +1,7 @@
+BEGIN;
+
+-- partial index for the expiry task, most CIDRs have no TTL and are left out
+
+CREATE INDEX cidr_expires_at_idx ON cidr (expires_at) WHERE expires_at IS NOT NULL;
+
+COMMIT;
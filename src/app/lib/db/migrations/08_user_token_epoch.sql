@@ -0,0 +1,8 @@
+BEGIN;
+
+-- the tokens carry the epoch of the user when they were issued,
+-- bumping it revokes all the tokens issued before
+
+ALTER TABLE user_login ADD COLUMN token_epoch INTEGER NOT NULL DEFAULT 0;
+
+COMMIT;
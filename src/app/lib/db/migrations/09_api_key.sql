@@ -0,0 +1,22 @@
+BEGIN;
+
+-- api_key definition
+-- only the HMAC-SHA256 of the keys is stored, key_prefix identifies them to the users.
+-- read_only keys can only read, keys with a list_type only access lists of that type.
+
+CREATE TABLE api_key (
+  id UUID NOT NULL,
+  user_id UUID NOT NULL,
+  name TEXT NOT NULL,
+  key_prefix TEXT NOT NULL,
+  key_hash TEXT NOT NULL UNIQUE,
+  read_only BOOLEAN NOT NULL DEFAULT false,
+  list_type list_type_datatype NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (id),
+  FOREIGN KEY (user_id) REFERENCES user_login(id) ON DELETE CASCADE
+);
+
+CREATE INDEX api_key_user_id_idx ON api_key (user_id);
+
+COMMIT;
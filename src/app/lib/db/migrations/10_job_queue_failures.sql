@@ -0,0 +1,11 @@
+BEGIN;
+
+-- job_queue failures, a job that fails is retried alone when its lease expires and
+-- after JOB_QUEUE_MAX_ATTEMPTS it's kept as failed with its error, the worker skips it
+
+ALTER TABLE job_queue
+  ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0,
+  ADD COLUMN error TEXT NULL,
+  ADD COLUMN failed_at TIMESTAMPTZ NULL;
+
+COMMIT;
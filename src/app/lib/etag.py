@@ -0,0 +1,30 @@
+import hashlib
+
+from litestar import Request, Response
+from litestar.status_codes import HTTP_304_NOT_MODIFIED
+
+
+def make_etag(*parts: object) -> str:
+    """Return a weak ETag for the representation identified by ``parts``.
+
+    The same tag is sent for the gzip and identity encodings of the body, so it can't be a strong one.
+    """
+    return 'W/"' + hashlib.sha256(repr(parts).encode()).hexdigest()[:32] + '"'
+
+
+def _opaque_tag(etag: str) -> str:
+    return etag.removeprefix("W/")
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Return True if the ``If-None-Match`` header of the request matches ``etag``, with the weak comparison."""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    opaque_tag = _opaque_tag(etag)
+    return any(tag.strip() == "*" or _opaque_tag(tag.strip()) == opaque_tag for tag in if_none_match.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    """Return a ``304 Not Modified`` response for ``etag``."""
+    return Response(content=b"", status_code=HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
@@ -54,6 +54,6 @@ def default_httpexception_handler(request: Request, exc: Exception) -> Response:
     return Response(
         media_type=preferred_type,
         content=content,
-        headers={"HX-Trigger": "cleanErrors"},
+        headers={"HX-Trigger": "cleanErrors", **(getattr(exc, "headers", None) or {})},
         status_code=status_code,
     )
@@ -1,4 +1,4 @@
-from collections.abc import Generator
+from collections.abc import Generator, Iterable, Sequence
 from ipaddress import (
     IPv4Address,
     IPv4Network,
@@ -84,12 +84,94 @@ def exclude_address(
         yield from summarize_address_range(base_class(subn_range[0]), base_class(subn_range[1]))
 
 
-async def address_exclude_many(
+def merge_ranges(ranges: Iterable[tuple[int, int]]) -> list[tuple[int, int]]:
+    """Sort ``ranges`` and merge the ones that overlap or are adjacent.
+
+    All the ranges must be of the same IP version.
+    """
+    merged: list[tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def range_to_cidrs(start: int, end: int, max_prefixlen: int) -> Generator[tuple[int, int], None, None]:
+    """Split the range ``start``-``end`` in the minimal list of (network address, prefixlen).
+
+    Integer version of ``ipaddress.summarize_address_range``, networks are returned in ascending order.
+    """
+    while start <= end:
+        # largest block aligned on ``start`` that doesn't go past ``end``
+        host_bits = min(
+            (start & -start).bit_length() - 1 if start else max_prefixlen,
+            (end - start + 1).bit_length() - 1,
+        )
+        yield start, max_prefixlen - host_bits
+        start += 1 << host_bits
+
+
+def exclude_ranges_many(
+    base_ranges: Sequence[tuple[int, int]],
+    exclude_ranges: Iterable[tuple[int, int]],
+) -> list[list[tuple[int, int]]]:
+    """Subtracts all the ``exclude_ranges`` from every range in ``base_ranges`` in a single pass.
+
+    Both sides are sorted once and walked together, so the cost is
+    O((base + exclude) * log(base + exclude) + output) instead of excluding
+    each range from every other one.
+
+    All the ranges must be of the same IP version, ``base_ranges`` can overlap between them.
+
+    Args:
+    ----
+        base_ranges (Sequence[tuple[int, int]]): IP Ranges to be excluded
+        exclude_ranges (Iterable[tuple[int, int]]): IP Ranges that exclude the ``base_ranges``
+
+    Returns:
+    -------
+        list[list[tuple[int, int]]]: For each range in ``base_ranges`` (same order), the sorted
+        and non adjacent IP Ranges left after the exclusion
+
+    """
+    exclusions = merge_ranges(exclude_ranges)
+    total_exclusions = len(exclusions)
+    result: list[list[tuple[int, int]]] = [[] for _ in base_ranges]
+
+    j = 0
+    for i in sorted(range(len(base_ranges)), key=lambda x: base_ranges[x][0]):
+        start, end = base_ranges[i]
+        # exclusions ending before this range can't affect the next ones either, as they're sorted by start
+        while j < total_exclusions and exclusions[j][1] < start:
+            j += 1
+
+        left = result[i]
+        current = start
+        k = j
+        while k < total_exclusions and exclusions[k][0] <= end:
+            exclude_start, exclude_end = exclusions[k]
+            if exclude_start > current:
+                left.append((current, exclude_start - 1))
+            current = exclude_end + 1
+            if current > end:
+                break
+            k += 1
+
+        if current <= end:
+            left.append((current, end))
+
+    return result
+
+
+def address_exclude_many(
     cidr: IPv4Network | IPv6Network, exclusion_cidrs: set[IPv4Network | IPv6Network]
 ) -> set[IPv4Network | IPv6Network]:
     """Excludes addresses from ``cidr`` present in any ``exclusion_cidrs``, subnetting if necessary."""
 
-    async def _exclude_from_subnets(_subnet_ranges, _exclusion):
+    def _exclude_from_subnets(_subnet_ranges, _exclusion):
         exclude_range = _exclusion.network_address._ip, _exclusion.broadcast_address._ip
         new_subnet_ranges = set()
         for isub_range in _subnet_ranges:
@@ -101,7 +183,7 @@ async def address_exclude_many(
 
     subnet_ranges = {(cidr.network_address._ip, cidr.broadcast_address._ip)}  # type:ignore
     for exclusion_cidr in (x for x in exclusion_cidrs if x.version == cidr.version):
-        subnet_ranges = await _exclude_from_subnets(subnet_ranges, exclusion_cidr)
+        subnet_ranges = _exclude_from_subnets(subnet_ranges, exclusion_cidr)
         if not subnet_ranges:
             break
 
@@ -113,7 +195,7 @@ async def address_exclude_many(
     return set(collapse_addresses(iter(final_subnets)))  # type: ignore
 
 
-async def address_exclude_many_2(
+def address_exclude_many_2(
     cidr: IPv4Network | IPv6Network, exclusion_cidrs: set[IPv4Network | IPv6Network]
 ) -> set[IPv4Network | IPv6Network]:
     """Excludes addresses from ``cidr`` present in any ``exclusion_cidrs``, subnetting if necessary.
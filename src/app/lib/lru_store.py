@@ -0,0 +1,110 @@
+import contextlib
+import os
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from litestar.concurrency import sync_to_thread
+from litestar.stores.base import Store
+from litestar.stores.file import FileStore
+
+
+def _seconds(expires_in: int | timedelta | None) -> float | None:
+    return expires_in.total_seconds() if isinstance(expires_in, timedelta) else expires_in
+
+
+class LRUMemoryStore(Store):
+    """In-memory store bounded to ``max_size`` values, the least recently used are evicted.
+
+    It's only used from the event loop, none of the methods awaits so they don't need a lock.
+    """
+
+    __slots__ = ("_values", "max_size")
+
+    def __init__(self, max_size: int) -> None:  # noqa: D107
+        self.max_size = max_size
+        self._values: OrderedDict[str, tuple[bytes, float | None]] = OrderedDict()
+
+    def __len__(self) -> int:  # noqa: D105
+        return len(self._values)
+
+    async def set(self, key: str, value: str | bytes, expires_in: int | timedelta | None = None) -> None:
+        """Set a value, evicting the least recently used if the store is full."""
+        seconds = _seconds(expires_in)
+        if isinstance(value, str):
+            value = value.encode()
+        self._values[key] = (value, time.monotonic() + seconds if seconds is not None else None)
+        self._values.move_to_end(key)
+        while len(self._values) > self.max_size:
+            self._values.popitem(last=False)
+
+    async def get(self, key: str, renew_for: int | timedelta | None = None) -> bytes | None:
+        """Get a value if it's not expired."""
+        if (item := self._values.get(key)) is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._values[key]
+            return None
+        if renew_for is not None and expires_at is not None:
+            self._values[key] = (value, time.monotonic() + _seconds(renew_for))
+        self._values.move_to_end(key)
+        return value
+
+    async def delete(self, key: str) -> None:
+        """Delete a value."""
+        self._values.pop(key, None)
+
+    async def delete_all(self) -> None:
+        """Delete all the values."""
+        self._values.clear()
+
+    async def exists(self, key: str) -> bool:
+        """Check if ``key`` has a value not expired."""
+        return await self.get(key) is not None
+
+    async def expires_in(self, key: str) -> int | None:
+        """Get the seconds ``key`` expires in."""
+        if await self.get(key) is None or (expires_at := self._values[key][1]) is None:
+            return None
+        return int(expires_at - time.monotonic())
+
+
+class BoundedFileStore(FileStore):
+    """File store shared by the processes of the host, bounded to about ``max_size`` values.
+
+    Every ``max_size // 10`` values set by a process the expired values are deleted, then
+    the least recently written while there are more than ``max_size``.
+    """
+
+    __slots__ = ("_writes", "max_size")
+
+    def __init__(self, path: str, max_size: int, *, create_directories: bool = False) -> None:  # noqa: D107
+        super().__init__(path, create_directories=create_directories)
+        self.max_size = max_size
+        self._writes = 0
+
+    async def set(self, key: str, value: str | bytes, expires_in: int | timedelta | None = None) -> None:
+        """Set a value, pruning the store every ``max_size // 10`` values."""
+        await super().set(key, value, expires_in=expires_in)
+        self._writes += 1
+        if self._writes >= max(self.max_size // 10, 1):
+            self._writes = 0
+            await self.prune()
+
+    async def prune(self) -> None:
+        """Delete the expired values and the oldest ones above ``max_size``."""
+        await self.delete_expired()
+        await sync_to_thread(self._delete_oldest_sync)
+
+    def _delete_oldest_sync(self) -> None:
+        files = []
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                # other processes may delete them at the same time
+                with contextlib.suppress(FileNotFoundError):
+                    files.append((entry.stat().st_mtime, entry.path))
+        files.sort()
+        for _, path in files[: len(files) - self.max_size]:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)  # noqa: PTH108
@@ -0,0 +1,95 @@
+"""In-memory index to find the networks containing many IP addresses.
+
+The networks are split into elementary segments that don't overlap, each one
+with the networks covering it, so an address is matched with a binary search.
+"""
+
+from bisect import bisect_right
+from collections.abc import Iterable
+
+from app.lib.cidrset import cidr_range, parse_cidr
+
+Match = tuple[str, str, str]
+"""``(list_id, list_type, network)`` of a network containing an address."""
+
+Ranges = dict[int, list[tuple[int, int, Match]]]
+"""``(first, last, match)`` address ranges of the networks by IP version."""
+
+
+def parse_ip(ip: str) -> tuple[int, int]:
+    """Parse an IP address into ``(version, address)``, raising ``ValueError`` if it's not one."""
+    version, address, prefixlen = parse_cidr(ip.strip())
+    if prefixlen != (32 if version == 4 else 128):
+        raise ValueError(f"{ip} is not an IP address")
+    return version, address
+
+
+class _Segments:
+    """Sorted elementary segments of a single IP version."""
+
+    __slots__ = ("ends", "matches", "starts")
+
+    def __init__(self, ranges: list[tuple[int, int, Match]]) -> None:
+        """Sweep the ``(first, last, match)`` ranges, the segments covered by no range are skipped.
+
+        Networks are either disjoint or nested, so the ranges covering a point are a stack.
+        """
+        self.starts: list[int] = []
+        self.ends: list[int] = []
+        self.matches: list[tuple[Match, ...]] = []
+
+        stack: list[tuple[int, Match]] = []
+        position = 0
+        for first, last, match in sorted(ranges, key=lambda x: (x[0], -x[1])):
+            while stack and stack[-1][0] < first:
+                position = self._close(stack, position)
+            if stack and position < first:
+                self._add(position, first - 1, stack)
+            stack.append((last, match))
+            position = first
+        while stack:
+            position = self._close(stack, position)
+
+    def _add(self, start: int, end: int, stack: list[tuple[int, Match]]) -> None:
+        self.starts.append(start)
+        self.ends.append(end)
+        self.matches.append((stack[0][1],) if len(stack) == 1 else tuple(sorted(match for _, match in stack)))
+
+    def _close(self, stack: list[tuple[int, Match]], position: int) -> int:
+        """Add the segment up to the end of the innermost range and pop it, return the next position."""
+        last = stack[-1][0]
+        if position <= last:
+            self._add(position, last, stack)
+            position = last + 1
+        stack.pop()
+        return position
+
+    def match(self, address: int) -> tuple[Match, ...]:
+        """Get the matches of the segment containing ``address``."""
+        i = bisect_right(self.starts, address) - 1
+        if i >= 0 and address <= self.ends[i]:
+            return self.matches[i]
+        return ()
+
+
+def parse_networks(networks: Iterable[Match]) -> Ranges:
+    """Get the ranges of ``(list_id, list_type, network)``, networks must be valid."""
+    ranges: Ranges = {4: [], 6: []}
+    for match in networks:
+        version, start, prefixlen = parse_cidr(match[2])
+        ranges[version].append((*cidr_range(version, start, prefixlen), match))
+    return ranges
+
+
+class MatchIndex:
+    """Index of the networks of many lists by IP version."""
+
+    __slots__ = ("segments",)
+
+    def __init__(self, ranges: Ranges) -> None:
+        """Build the index from the output of ``parse_networks``."""
+        self.segments = {version: _Segments(version_ranges) for version, version_ranges in ranges.items()}
+
+    def match(self, version: int, address: int) -> tuple[Match, ...]:
+        """Get the networks containing ``address``, sorted by list."""
+        return self.segments[version].match(address)
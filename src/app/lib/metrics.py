@@ -0,0 +1,301 @@
+"""In-process metrics in the Prometheus text format.
+
+The metrics are updated from the API, the worker and the scheduler threads, each
+metric has its own lock held only to update a few numbers. Every process has its
+own registry, with several app processes each one is scraped on its own. The worker
+running on its own serves its registry with ``start_http_server``.
+"""
+
+import hmac
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections.abc import Iterator
+from contextlib import contextmanager
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TypeVar
+from urllib.parse import urlsplit
+
+from litestar.types import ASGIApp, Message, Receive, Scope, Send
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+"""Default histogram buckets in seconds."""
+
+SLOW_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+"""Buckets in seconds of the background tasks."""
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+M = TypeVar("M", bound="_Metric")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values, strict=True)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(ABC):
+    """Metric with a value per combination of labels."""
+
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:  # noqa: D107
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.lock = threading.Lock()
+
+    def _check(self, labels: tuple[str, ...]) -> None:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {labels}")
+
+    @abstractmethod
+    def _samples(self) -> Iterator[str]:
+        pass
+
+    def render(self) -> str:
+        """Get the metric in the Prometheus text format."""
+        header = f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.type}\n"
+        return header + "".join(f"{line}\n" for line in self._samples())
+
+
+class Counter(_Metric):
+    """Value that only goes up."""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:  # noqa: D107
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        """Increment the value of ``labels`` by ``amount``."""
+        self._check(labels)
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def _samples(self) -> Iterator[str]:
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    """Value that goes up and down."""
+
+    type = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        """Set the value of ``labels``."""
+        self._check(labels)
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(_Metric):
+    """Count of the observations in cumulative buckets, with their sum."""
+
+    type = "histogram"
+
+    def __init__(  # noqa: D107
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # counts per bucket, not cumulative, the last one is +Inf
+        self.counts: dict[tuple[str, ...], list[int]] = {}
+        self.sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        """Add an observation of ``labels``."""
+        self._check(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.counts.get(labels)
+            if counts is None:
+                counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+                self.sums[labels] = 0.0
+            counts[index] += 1
+            self.sums[labels] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        """Observe the seconds taken by the block."""
+        stime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - stime, *labels)
+
+    def _samples(self) -> Iterator[str]:
+        with self.lock:
+            values = sorted((labels, list(counts), self.sums[labels]) for labels, counts in self.counts.items())
+        bucket_names = (*self.labelnames, "le")
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts, strict=True):
+                cumulative += count
+                bucket_labels = _format_labels(bucket_names, (*labels, _format_value(bound)))
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            label_str = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_str} {_format_value(total)}"
+            yield f"{self.name}_count{label_str} {cumulative}"
+
+
+class Registry:
+    """Metrics rendered together, by name."""
+
+    def __init__(self) -> None:  # noqa: D107
+        self.metrics: dict[str, _Metric] = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric: M) -> M:
+        """Add a metric, raising ``ValueError`` if there's another one with the same name."""
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Duplicated metric {metric.name}")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> bytes:
+        """Get all the metrics in the Prometheus text format."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "".join(metric.render() for metric in metrics).encode()
+
+
+registry = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+    """Create a counter in the default registry."""
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+    """Create a gauge in the default registry."""
+    return registry.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(
+    name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS
+) -> Histogram:
+    """Create a histogram in the default registry."""
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# API
+HTTP_REQUEST_SECONDS = histogram(
+    "http_request_duration_seconds", "Seconds to handle the requests by route.", ("method", "route", "status")
+)
+DB_POOL_ACQUIRE_SECONDS = histogram("db_pool_acquire_seconds", "Seconds waiting for a connection from the DB pool.")
+
+# Job queue, read on each scrape
+JOB_QUEUE_DEPTH = gauge("job_queue_depth", "Jobs waiting in the queue.")
+JOB_QUEUE_OLDEST_SECONDS = gauge("job_queue_oldest_age_seconds", "Age of the oldest job in the queue.")
+JOB_QUEUE_FAILED = gauge("job_queue_failed", "Jobs kept as failed in the queue after their last attempt.")
+
+# Worker
+WORKER_JOBS = counter("worker_jobs_total", "Jobs consumed by the worker.")
+WORKER_FAILED_JOBS = counter("worker_failed_jobs_total", "Jobs kept as failed after their last attempt.")
+WORKER_BATCH_SECONDS = histogram(
+    "worker_batch_duration_seconds", "Seconds to apply a batch of jobs.", buckets=SLOW_BUCKETS
+)
+WORKER_PHASE_SECONDS = histogram(
+    "worker_phase_duration_seconds",
+    "Seconds spent in each phase of the jobs: parse, safe_filter, exclusion, upsert, snapshot.",
+    ("phase",),
+    buckets=SLOW_BUCKETS,
+)
+
+# Scheduler
+EXPIRED_CIDRS = counter("expired_cidrs_total", "CIDRs deleted by the expiry task.")
+EXPIRED_RUN_ROWS = histogram(
+    "expired_cidrs_per_run",
+    "CIDRs deleted by each run of the expiry task.",
+    buckets=(0, 1, 10, 100, 1_000, 10_000, 100_000, 1_000_000),
+)
+EXPIRED_RUN_SECONDS = histogram(
+    "expired_cidrs_run_duration_seconds", "Seconds taken by each run of the expiry task.", buckets=SLOW_BUCKETS
+)
+
+
+def is_authorized(authorization: str, token: str | None) -> bool:
+    """Check the ``Authorization`` header of a scrape, every scrape is denied while ``token`` isn't set."""
+    return bool(token) and hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())
+
+
+def start_http_server(host: str, port: int, token: str | None) -> ThreadingHTTPServer:
+    """Serve the default registry at ``/metrics`` from a daemon thread.
+
+    Used by the processes that don't run the API, like the worker on its own.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:  # noqa: N802
+            if urlsplit(self.path).path != "/metrics":
+                self.send_error(HTTPStatus.NOT_FOUND)
+                return
+            if not is_authorized(self.headers.get("Authorization", ""), token):
+                self.send_error(HTTPStatus.UNAUTHORIZED, "Invalid metrics token.")
+                return
+            body = registry.render()
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_: object) -> None:
+            # the scrapes aren't logged
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics_server_thread", daemon=True).start()
+    return server
+
+
+def metrics_middleware_factory(app: ASGIApp) -> ASGIApp:
+    """Observe the seconds to handle each request, until its last byte is sent, by route template."""
+
+    async def middleware(scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stime = time.perf_counter()
+        try:
+            await app(scope, receive, send_wrapper)
+        finally:
+            # the template is only set for routes with parameters, the middleware only runs
+            # for matched routes so the paths without parameters are bounded too
+            route = scope.get("path_template") or scope["path"]
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - stime, scope["method"], route, str(status))
+
+    return middleware
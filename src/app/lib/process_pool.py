@@ -0,0 +1,39 @@
+import asyncio
+import multiprocessing
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from typing import ParamSpec, TypeVar
+
+from app.lib.settings import get_settings
+
+settings = get_settings()
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+
+@lru_cache
+def get_process_pool() -> ProcessPoolExecutor | None:
+    """Get the process pool singleton, ``None`` if it's disabled.
+
+    It uses ``spawn`` so the processes don't inherit the threads and connections of the parent.
+    """
+    if settings.WORKER_PROCESS_POOL_SIZE <= 0:
+        return None
+    return ProcessPoolExecutor(
+        max_workers=settings.WORKER_PROCESS_POOL_SIZE, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+async def run_cpu_bound(func: Callable[P, T], size: int, *args: P.args, **kwargs: P.kwargs) -> T:
+    """Run the pure function ``func`` in the process pool.
+
+    ``size`` is the number of items to process, the function runs inline when it's
+    smaller than ``WORKER_PROCESS_POOL_MIN_SIZE`` as sending it would cost more.
+    ``func`` and its arguments must be picklable.
+    """
+    process_pool = get_process_pool()
+    if process_pool is None or size < settings.WORKER_PROCESS_POOL_MIN_SIZE:
+        return func(*args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(process_pool, partial(func, *args, **kwargs))
@@ -1,26 +1,63 @@
 import asyncio
+import contextlib
 import threading
+import time
 from abc import ABC, abstractmethod
 
-from app.lib.db.base import get_connection
+import asyncpg
+from asyncpg import Connection
+
+from app.lib.db.base import CONNECTION_ERRORS, DBManager, backoff_delay, dsn
+from app.lib.metrics import EXPIRED_CIDRS, EXPIRED_RUN_ROWS, EXPIRED_RUN_SECONDS
 from app.lib.settings import get_settings
+from app.lib.snapshots import update_deleted_snapshots
 
 settings = get_settings()
 
+# notified by the worker when it adds CIDRs with a TTL, they may expire before the next run
+CIDR_EXPIRY_CHANNEL = "cidr_expiry"
+
+# uses the partial index on expires_at, rows locked by the worker are left for the next batch
+DELETE_EXPIRED_CIDRS = """
+DELETE FROM cidr
+WHERE ctid = ANY(ARRAY(
+    SELECT ctid FROM cidr WHERE expires_at < now() ORDER BY expires_at LIMIT $1 FOR UPDATE SKIP LOCKED
+))
+RETURNING list_id, address::text AS address
+"""
+
+# the first row of the partial index on expires_at
+SELECT_NEXT_EXPIRY = """
+SELECT extract(epoch FROM min(expires_at) - now()) FROM cidr WHERE expires_at IS NOT NULL
+"""
+
+# the watermark moves past the pruned transactions, cursors below it must resync
+PRUNE_CIDR_CHANGES = """
+WITH pruned AS (
+    DELETE FROM cidr_change WHERE created_at < now() - make_interval(secs => $1) RETURNING txid
+)
+UPDATE cidr_change_watermark
+SET txid = greatest(txid, (SELECT max(txid) + 1 FROM pruned)), updated_at = now()
+RETURNING (SELECT count(*) FROM pruned) AS total
+"""
+
 
 class ScheduledTask(ABC):
     keep_running: bool
+    dbmngr: DBManager
 
     def __init__(self) -> None:
         self.keep_running = True
         self.name = self.__class__.__name__
+        # the pool is created inside the loop of the task thread
+        self.dbmngr = DBManager(min_size=settings.DB_BG_POOL_MIN_SIZE, max_size=settings.DB_BG_POOL_MAX_SIZE)
 
     def stop(self) -> None:
         print(f"Stopping {self.name} ...")
         self.keep_running = False
 
     async def run(self) -> None:
-        t = threading.Thread(target=asyncio.run, args=(self._execute_loop(),), name=self.name, daemon=True)
+        t = threading.Thread(target=asyncio.run, args=(self._run_loop(),), name=self.name, daemon=True)
         t.start()
         print(f"Starting Scheduler {self.name} - {self.keep_running=}")
 
@@ -29,7 +66,32 @@ class ScheduledTask(ABC):
 
         Mostly used for testing.
         """
-        await self._execute()
+        await self.dbmngr.setup()
+        try:
+            await self._execute()
+        finally:
+            await self.dbmngr.stop()
+
+    async def _run_loop(self) -> None:
+        """Run ``_execute_loop`` with the pool of the task."""
+        await self.dbmngr.setup()
+        try:
+            await self._execute_loop()
+        finally:
+            await self.dbmngr.stop()
+
+    async def _execute_safe(self) -> None:
+        """Run ``_execute`` waiting with backoff while the DB can't be reached."""
+        failed_attempts = 0
+        while self.keep_running:
+            try:
+                await self._execute()
+                return
+            except CONNECTION_ERRORS as err:
+                failed_attempts += 1
+                delay = backoff_delay(failed_attempts)
+                print(f"{self.name} could not reach the DB ({err!r}), retrying in {delay} seconds ...")
+                await asyncio.sleep(delay)
 
     @abstractmethod
     async def _execute_loop(self) -> None:
@@ -41,20 +103,104 @@ class ScheduledTask(ABC):
 
 
 class TaskDeleteExpired(ScheduledTask):
+    """Delete the expired CIDRs when they expire.
+
+    After each run the task sleeps until the next CIDR expires, read from the partial index
+    on ``expires_at``, or ``SCHEDULER_DELETE_EXPIRED_INTERVAL`` seconds if it's later. The worker
+    notifies ``CIDR_EXPIRY_CHANNEL`` when it adds CIDRs with a TTL so the task wakes up to
+    check the next expiry again.
+    """
+
+    listen_conn: Connection | None
+    expiry_changed: asyncio.Event | None
+    next_expiry: float | None
+
+    def __init__(self) -> None:  # noqa: D107
+        super().__init__()
+        self.listen_conn = None
+        self.expiry_changed = None
+        self.next_expiry = None
+
     async def _execute_loop(self) -> None:
+        self.expiry_changed = asyncio.Event()
         try:
             while self.keep_running:
-                await self._execute()
-                await asyncio.sleep(settings.SCHEDULER_DELETE_EXPIRED_INTERVAL)
+                await self._listen()
+                self.expiry_changed.clear()
+                await self._execute_safe()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.expiry_changed.wait(), timeout=self._sleep_time())
+        except KeyboardInterrupt:
+            self.keep_running = False
+        finally:
+            await self._unlisten()
+
+    def _sleep_time(self) -> float:
+        """Get the seconds until the next CIDR expires, at least one if it's overdue but locked."""
+        if self.next_expiry is None:
+            return settings.SCHEDULER_DELETE_EXPIRED_INTERVAL
+        return min(max(self.next_expiry, 1.0), settings.SCHEDULER_DELETE_EXPIRED_INTERVAL)
+
+    def _on_notification(self, *_: object) -> None:
+        """Wake up the loop to check the next expiry."""
+        if self.expiry_changed is not None:
+            self.expiry_changed.set()
+
+    async def _listen(self) -> None:
+        """Open the connection that listens for new expiries, if it's not open already."""
+        if self.listen_conn is not None and not self.listen_conn.is_closed():
+            return
+        try:
+            self.listen_conn = await asyncpg.connect(dsn=dsn)
+            await self.listen_conn.add_listener(CIDR_EXPIRY_CHANNEL, self._on_notification)
+            # wake up to reconnect if the connection is lost
+            self.listen_conn.add_termination_listener(self._on_notification)
+        except CONNECTION_ERRORS as err:
+            print(f"{self.name} could not listen for new expiries, polling instead: {err!r}")
+            await self._unlisten()
+
+    async def _unlisten(self) -> None:
+        """Close the connection that listens for new expiries."""
+        if self.listen_conn is not None:
+            self.listen_conn.terminate()
+            self.listen_conn = None
+
+    async def _execute(self) -> None:
+        """Delete expired CIDRs in batches of ``EXPIRED_DELETE_BATCH_SIZE``, each in its own transaction."""
+        stime = time.perf_counter()
+        total = batches = 0
+        async with self.dbmngr.pool.acquire(timeout=settings.DB_POOL_ACQUIRE_CONN_TIMEOUT) as conn:
+            while self.keep_running:
+                async with conn.transaction():
+                    records = await conn.fetch(DELETE_EXPIRED_CIDRS, settings.EXPIRED_DELETE_BATCH_SIZE)
+                    await update_deleted_snapshots(conn, records)
+                total += len(records)
+                batches += 1
+                if len(records) < settings.EXPIRED_DELETE_BATCH_SIZE:
+                    break
+            next_expiry = await conn.fetchval(SELECT_NEXT_EXPIRY)
+            self.next_expiry = float(next_expiry) if next_expiry is not None else None
+        elapsed = time.perf_counter() - stime
+        EXPIRED_CIDRS.inc(amount=total)
+        EXPIRED_RUN_ROWS.observe(total)
+        EXPIRED_RUN_SECONDS.observe(elapsed)
+        print(f"Delete expired CIDRs task: DELETE {total} in {batches} batches, {elapsed:.3f} seconds")
+
+
+class TaskPruneCidrChanges(ScheduledTask):
+    async def _execute_loop(self) -> None:
+        try:
+            while self.keep_running:
+                await self._execute_safe()
+                await asyncio.sleep(settings.SCHEDULER_PRUNE_CIDR_CHANGES_INTERVAL)
         except KeyboardInterrupt:
             self.keep_running = False
 
     async def _execute(self) -> None:
-        """Delete expired CIDRs."""
-        async for conn in get_connection():
-            async with conn.transaction():
-                res = await conn.execute("delete from cidr where expires_at < now()")
-                print(f"Delete expired CIDRs task: {res}")
+        """Delete the changes of the CIDRs older than the retention."""
+        async with self.dbmngr.pool.acquire(timeout=settings.DB_POOL_ACQUIRE_CONN_TIMEOUT) as conn:
+            total = await conn.fetchval(PRUNE_CIDR_CHANGES, settings.CIDR_CHANGES_RETENTION)
+            print(f"Prune CIDR changes task: DELETE {total}")
 
 
 class Scheduler:
@@ -63,7 +209,7 @@ class Scheduler:
     tasks: list[ScheduledTask]
 
     def __init__(self):
-        self.tasks = [TaskDeleteExpired()]
+        self.tasks = [TaskDeleteExpired(), TaskPruneCidrChanges()]
 
     def stop(self):
         print("Stopping Scheduler.")
@@ -27,14 +27,81 @@ class Settings(BaseSettings):
     """Maximum time allowed to get a connection from the pool."""
     DB_POOL_CLOSE_TIMEOUT: int = 10
     """Timeout to close the pool."""
+    DB_BG_POOL_MIN_SIZE: int = 1
+    """Minimal number of connections of the pools owned by the worker and each scheduled task."""
+    DB_BG_POOL_MAX_SIZE: int = 2
+    """Maximum number of connections of the pools owned by the worker and each scheduled task."""
+    DB_STATEMENT_CACHE_SIZE: int = 256
+    """Number of prepared statements cached by each connection."""
+    DB_SETUP_RETRIES: int = Field(default=10, ge=1)
+    """Attempts to create a pool before giving up."""
+    DB_RETRY_MAX_DELAY: int = 30
+    """Maximum time to wait between attempts to reach the DB."""
 
     # Worker
-    JOB_QUEUE_QUERY_INTERVAL: int = 5
-    """Interval between the DB query that fetches the jobs from the 'job_queue' table."""
+    JOB_QUEUE_QUERY_INTERVAL: int = 60
+    """Interval between the DB query that fetches the jobs from the 'job_queue' table.
+
+    The worker is woken up by a notification when a job is queued, this is a fallback.
+    """
+    JOB_QUEUE_BATCH_SIZE: int = Field(default=500, ge=1)
+    """Maximum number of jobs consumed in one batch."""
+    JOB_QUEUE_LEASE_SECONDS: int = Field(default=300, ge=10)
+    """Time a worker holds the jobs it claims, after that other workers can claim them."""
+    JOB_QUEUE_MAX_ATTEMPTS: int = Field(default=3, ge=1)
+    """Times a job that fails is tried, one lease apart, before it's kept as failed in the queue."""
+    WORKER_PROCESS_POOL_SIZE: int = 2
+    """Processes used by the worker to parse and exclude CIDRs, 0 runs everything in the worker thread."""
+    WORKER_PROCESS_POOL_MIN_SIZE: int = 1_000
+    """Minimal number of CIDRs to send the work to the process pool, smaller jobs run in the worker thread."""
+    JOB_VECTORIZED_PARSE_MIN_SIZE: int = 10_000
+    """Minimal number of CIDRs in a job to parse it with numpy, if it's installed."""
+
+    # Snapshots
+    SNAPSHOT_CACHE_SIZE: int = 32
+    """Number of merged list snapshots cached by the API."""
+    SNAPSHOT_CACHE_MAX_NETWORKS: int = 1_000_000
+    """Networks kept in the merged list snapshots cached by each process, the least used are evicted."""
+
+    MATCH_INDEX_CACHE_SIZE: int = 16
+    """Number of users whose in-memory index of enabled lists is kept by the API for /v1/cidr/match."""
+
+    CIDR_TRIE_CACHE_MAX_NETWORKS: int = 1_000_000
+    """Networks kept in the tries of enabled lists by each process, the least used are evicted."""
+
+    # Streaming
+    STREAM_CHUNK_SIZE: int = 5_000
+    """Rows fetched from the server side cursor and encoded at once by the streamed responses."""
+
+    # Compression
+    GZIP_MIN_SIZE: int = 1_024
+    """Minimal size of a response to compress it with gzip, when the client accepts it."""
+    GZIP_COMPRESS_LEVEL: int = 6
+    """Gzip compression level, higher levels compress big lists a bit more with much more CPU."""
+
+    # Change log
+    CIDR_CHANGES_RETENTION: int = 86_400
+    """Seconds the changes of the CIDRs are kept, clients with an older cursor must resync."""
+    CIDR_CHANGES_MAX_SIZE: int = 100_000
+    """Maximum number of changes returned at once, clients that are further behind must resync."""
 
     # Scheduler tasks
     SCHEDULER_DELETE_EXPIRED_INTERVAL: int = 30
-    """Interval between the task that deletes expired CIDRs."""
+    """Maximum interval between the runs of the task that deletes expired CIDRs, it runs when the next one expires."""
+    EXPIRED_DELETE_BATCH_SIZE: int = 10_000
+    """Expired CIDRs deleted per transaction, so a mass expiry doesn't hold the locks of the worker for long."""
+    SCHEDULER_PRUNE_CIDR_CHANGES_INTERVAL: int = 300
+    """Interval between the task that prunes the change log of the CIDRs."""
+
+    # Metrics
+    METRICS_ENABLED: bool = True
+    """Serve the metrics of the process in the Prometheus text format at /metrics."""
+    METRICS_TOKEN: str | None = None
+    """Bearer token required to read /metrics, every request is denied if not set."""
+    WORKER_METRICS_HOST: str = "0.0.0.0"  # noqa: S104
+    """Address of the /metrics endpoint of the worker when it runs on its own with ``python -m app.worker``."""
+    WORKER_METRICS_PORT: int | None = 9100
+    """Port of the /metrics endpoint of the worker when it runs on its own, it's disabled if not set."""
 
     # APP
     VERSION: str = "1.0"
@@ -54,6 +121,34 @@ class Settings(BaseSettings):
 
     AUTH_CACHE_SECONDS: int = 120
     """Internal TTL for the cached authentication results"""
+    AUTH_CACHE_INVALID_SECONDS: int = 10
+    """TTL of the cached invalid tokens, they're rejected without decoding them."""
+    AUTH_CACHE_INVALID_MAX_SIZE: int = 1_000
+    """Invalid tokens cached in memory by each process, apart from the results so they can't evict them."""
+    AUTH_CACHE_MAX_SIZE: int = 10_000
+    """Authentication results cached by each process or in AUTH_CACHE_PATH, the least recently used are evicted."""
+    AUTH_CACHE_PATH: str | None = None
+    """Directory of a file store for the authentication results shared by the processes, not for invalid tokens."""
+    AUTH_TRUST_TOKEN_CLAIMS: bool = True
+    """Authorize the requests with the user and role of the token claims instead of reading the user from the DB."""
+    AUTH_EPOCH_REFRESH_SECONDS: int = 5
+    """Interval to read the token epochs of the users again, the revoked tokens are rejected after it at most."""
+    API_KEY_SECRET: str | None = None
+    """Key of the HMAC of the stored API keys, ``JWT_SECRET`` if not set. Changing it invalidates the API keys."""
+    API_KEY_REFRESH_SECONDS: int = 5
+    """Interval to read the API keys again, the deleted keys are rejected after it at most."""
+
+    # Password hashing
+    ARGON2_TIME_COST: int = 3
+    """Iterations of argon2 for the new password hashes."""
+    ARGON2_MEMORY_COST: int = 65_536
+    """Memory in KiB used by argon2 for the new password hashes."""
+    ARGON2_PARALLELISM: int = 4
+    """Lanes of argon2 for the new password hashes."""
+    PASSWORD_HASH_THREADS: int = 2
+    """Threads hashing and verifying passwords, out of the event loop."""
+    PASSWORD_HASH_MAX_QUEUE: int = 16
+    """Password hashes waiting for a thread, more are rejected with a 503 status."""
 
     # OpenAPI
     OPENAPI_TITLE: str = "CIDR Listings"
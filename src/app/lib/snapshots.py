@@ -0,0 +1,153 @@
+from collections import defaultdict
+from collections.abc import Iterable
+
+from asyncpg import Connection, Record
+from asyncpg.pool import PoolConnectionProxy
+
+from app.lib.cidrset import CidrArray, CidrSet
+from app.lib.process_pool import run_cpu_bound
+
+UPSERT_SNAPSHOT = """
+INSERT INTO cidr_snapshot
+    (list_id, version, ipv4, ipv6)
+VALUES
+    ($1, nextval('cidr_snapshot_version_seq'), $2, $3)
+ON CONFLICT (list_id)
+DO
+    UPDATE SET version = EXCLUDED.version, ipv4 = EXCLUDED.ipv4, ipv6 = EXCLUDED.ipv6, updated_at = now()
+"""
+
+INSERT_EMPTY_SNAPSHOT = """
+INSERT INTO cidr_snapshot
+    (list_id, version, ipv4, ipv6)
+VALUES
+    ($1, nextval('cidr_snapshot_version_seq'), '', '')
+ON CONFLICT (list_id)
+    DO NOTHING
+"""
+
+SELECT_SNAPSHOT_FOR_UPDATE = """
+SELECT ipv4, ipv6 FROM cidr_snapshot WHERE list_id = $1 FOR UPDATE
+"""
+
+SELECT_LIST_ADDRESSES = """
+SELECT address::text AS address FROM cidr WHERE list_id = $1
+"""
+
+# uses the GiST index on the address
+SELECT_OVERLAPPING_ADDRESSES = """
+SELECT DISTINCT c.address::text AS address
+FROM unnest($2::text[]::cidr[]) AS d(address)
+JOIN cidr c ON c.address && d.address
+WHERE c.list_id = $1
+"""
+
+SELECT_LISTS_WITHOUT_SNAPSHOT = """
+SELECT id FROM list WHERE NOT EXISTS (SELECT 1 FROM cidr_snapshot WHERE list_id = list.id)
+"""
+
+
+def encode_snapshot(cidrs: CidrSet) -> tuple[bytes, bytes]:
+    """Encode the IPv4 and IPv6 networks of a snapshot."""
+    return cidrs.ipv4.to_bytes(), cidrs.ipv6.to_bytes()
+
+
+def decode_snapshot(ipv4: bytes, ipv6: bytes) -> CidrSet:
+    """Decode the networks of a snapshot."""
+    return CidrSet(CidrArray.from_bytes(4, ipv4), CidrArray.from_bytes(6, ipv6))
+
+
+def build_snapshot(addresses: list[str]) -> tuple[bytes, bytes]:
+    """Collapse the addresses of a list and encode them."""
+    return encode_snapshot(CidrSet.from_strings(addresses).collapse())
+
+
+def apply_snapshot_changes(ipv4: bytes, ipv6: bytes, changes: list[tuple[bool, CidrSet]]) -> tuple[bytes, bytes]:
+    """Apply the ``(added, cidrs)`` changes to an encoded snapshot, in order."""
+    snapshot = decode_snapshot(ipv4, ipv6)
+    for added, cidrs in changes:
+        snapshot = snapshot.union(cidrs) if added else snapshot.difference(cidrs)
+    return encode_snapshot(snapshot)
+
+
+class SnapshotChanges:
+    """Changes made to the CIDRs of each list while processing jobs.
+
+    Adding CIDRs to a list adds them to its snapshot and excluding CIDRs from the rows
+    of a list excludes them from its snapshot, so the snapshots don't need to be rebuilt
+    from all the rows of the list.
+    """
+
+    __slots__ = ("changes",)
+
+    def __init__(self) -> None:  # noqa: D107
+        self.changes: dict[str, list[tuple[bool, CidrSet]]] = {}
+
+    def add(self, list_id: str, cidrs: CidrSet) -> None:
+        """Record ``cidrs`` added to ``list_id``."""
+        self.changes.setdefault(list_id, []).append((True, cidrs))
+
+    def exclude(self, list_id: str, cidrs: CidrSet) -> None:
+        """Record ``cidrs`` excluded from ``list_id``."""
+        self.changes.setdefault(list_id, []).append((False, cidrs))
+
+    def extend(self, other: "SnapshotChanges") -> None:
+        """Record the changes of ``other`` after the ones already recorded."""
+        for list_id, changes in other.changes.items():
+            self.changes.setdefault(list_id, []).extend(changes)
+
+
+async def rebuild_snapshots(conn: Connection | PoolConnectionProxy, list_ids: Iterable[str]) -> None:
+    """Rebuild the snapshots of ``list_ids`` from all their rows."""
+    for list_id in sorted(set(list_ids)):
+        await conn.execute(SELECT_SNAPSHOT_FOR_UPDATE, list_id)
+        addresses = [record["address"] for record in await conn.fetch(SELECT_LIST_ADDRESSES, list_id)]
+        ipv4, ipv6 = await run_cpu_bound(build_snapshot, len(addresses), addresses)
+        await conn.execute(UPSERT_SNAPSHOT, list_id, ipv4, ipv6)
+
+
+async def rebuild_missing_snapshots(conn: Connection | PoolConnectionProxy) -> None:
+    """Build the snapshots of the lists created before snapshots existed."""
+    list_ids = [record["id"] for record in await conn.fetch(SELECT_LISTS_WITHOUT_SNAPSHOT)]
+    if list_ids:
+        print(f"Building the snapshots of {len(list_ids)} lists")
+        await rebuild_snapshots(conn, list_ids)
+
+
+async def update_snapshots(conn: Connection | PoolConnectionProxy, snapshot_changes: SnapshotChanges) -> None:
+    """Apply ``snapshot_changes`` to the snapshots, it must run in the transaction that changed the rows.
+
+    The snapshot rows are locked in order so concurrent updates can't deadlock.
+    """
+    for list_id, changes in sorted(snapshot_changes.changes.items()):
+        record = await conn.fetchrow(SELECT_SNAPSHOT_FOR_UPDATE, list_id)
+        if record is None:
+            await rebuild_snapshots(conn, [list_id])
+            continue
+        size = sum(len(cidrs) for _, cidrs in changes) + len(record["ipv4"]) // 5 + len(record["ipv6"]) // 17
+        ipv4, ipv6 = await run_cpu_bound(apply_snapshot_changes, size, record["ipv4"], record["ipv6"], changes)
+        await conn.execute(UPSERT_SNAPSHOT, list_id, ipv4, ipv6)
+
+
+async def update_deleted_snapshots(conn: Connection | PoolConnectionProxy, records: list[Record]) -> None:
+    """Exclude the deleted ``(list_id, address)`` rows from the snapshots of their lists.
+
+    Deleted rows may overlap with others of the same list, these are added back to the
+    snapshot so it doesn't need to be rebuilt from all the rows. It must run in the
+    transaction that deleted the rows, the snapshots are locked before reading them so
+    the rows added by the worker meanwhile aren't missed.
+    """
+    deleted = defaultdict(list)
+    for record in records:
+        deleted[record["list_id"]].append(record["address"])
+
+    snapshot_changes = SnapshotChanges()
+    for list_id, addresses in sorted(deleted.items()):
+        await conn.execute(SELECT_SNAPSHOT_FOR_UPDATE, list_id)
+        overlapping = [
+            record["address"] for record in await conn.fetch(SELECT_OVERLAPPING_ADDRESSES, list_id, addresses)
+        ]
+        snapshot_changes.exclude(list_id, await run_cpu_bound(CidrSet.from_strings, len(addresses), addresses))
+        if overlapping:
+            snapshot_changes.add(list_id, await run_cpu_bound(CidrSet.from_strings, len(overlapping), overlapping))
+    await update_snapshots(conn, snapshot_changes)
@@ -0,0 +1,40 @@
+from collections.abc import AsyncGenerator, Callable
+
+import msgspec
+from asyncpg import Record
+from litestar.serialization import encode_json
+
+from app.lib.db.base import get_dbmanager
+from app.lib.settings import get_settings
+
+settings = get_settings()
+
+
+async def stream_json_array(
+    query: str,
+    args: list,
+    to_struct: Callable[[Record], msgspec.Struct],
+    prefix: bytes = b"",
+    suffix: bytes = b"",
+) -> AsyncGenerator[bytes, None]:
+    """Stream the rows of ``query`` as a JSON array, reading them with a server side cursor.
+
+    The connection of the request is released before the response is sent, so the
+    stream takes its own from the pool. Rows are fetched and encoded in chunks of
+    ``STREAM_CHUNK_SIZE`` so the memory doesn't grow with the number of rows.
+    ``prefix`` and ``suffix`` wrap the array, to stream it inside an object. The structs
+    are encoded like the regular responses, with the default Litestar serializer.
+    """
+    dbmngr = get_dbmanager()
+    async with (
+        dbmngr.pool.acquire(timeout=settings.DB_POOL_ACQUIRE_CONN_TIMEOUT) as conn,
+        conn.transaction(readonly=True),
+    ):
+        cursor = await conn.cursor(query, *args)
+        yield prefix + b"["
+        separator = b""
+        while records := await cursor.fetch(settings.STREAM_CHUNK_SIZE):
+            # strip the brackets of the encoded chunk to join it with the previous ones
+            yield separator + encode_json([to_struct(x) for x in records])[1:-1]
+            separator = b","
+        yield b"]" + suffix
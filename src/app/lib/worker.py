@@ -1,47 +1,151 @@
 import asyncio
-import ipaddress
+import contextlib
+import os
+import socket
 import threading
 import time
-from collections import Counter
+from collections import Counter, defaultdict
+from collections.abc import Awaitable, Callable
 from datetime import datetime, timedelta, timezone
-from ipaddress import IPv4Network, IPv6Network, collapse_addresses, ip_network
-from uuid import UUID
+from uuid import UUID, uuid4
 
+import asyncpg
 import msgspec
-from asyncpg import Connection
+from asyncpg import Connection, Record
 
 from app.domain.lists.schemas import ActionEnum, CidrJob, ListTypeEnum
-from app.lib.db.base import get_connection
-from app.lib.iputils import address_exclude_many
+from app.domain.lists.services import JOB_QUEUE_CHANNEL
+from app.lib.cidrset import CidrArray, CidrSet, cidr_range, is_global_cidr, parse_cidr
+from app.lib.cidrset_numpy import HAS_NUMPY, parse_cidrs_vectorized
+from app.lib.db.base import CONNECTION_ERRORS, DBManager, backoff_delay, dsn
+from app.lib.iputils import exclude_ranges_many
+from app.lib.metrics import WORKER_BATCH_SECONDS, WORKER_FAILED_JOBS, WORKER_JOBS, WORKER_PHASE_SECONDS
+from app.lib.process_pool import run_cpu_bound
+from app.lib.scheduled_tasks import CIDR_EXPIRY_CHANNEL
 from app.lib.settings import get_settings
+from app.lib.snapshots import SnapshotChanges, rebuild_missing_snapshots, update_snapshots
 
 settings = get_settings()
 
 cidrjob_dec = msgspec.json.Decoder(type=CidrJob)
 
-CONSUME_JOB_QUERY = """
-DELETE FROM
+EnabledCidrsGetter = Callable[[Connection, UUID, str], Awaitable[CidrSet]]
+"""Gets the collapsed CIDRs of the enabled lists of a user and a type, with committed changes only."""
+
+# Claims are serialized with an advisory lock so a job is never claimed while an
+# older job of the same user is held by another worker, jobs of a user run in order
+CLAIM_JOBS_LOCK = "SELECT pg_advisory_xact_lock(hashtext('job_queue_claim'))"
+
+CLAIM_JOBS_QUERY = """
+UPDATE
+    job_queue
+SET
+    claimed_by = $1, claimed_at = now()
+WHERE id IN (
+    SELECT id FROM job_queue q
+    WHERE
+        q.failed_at IS NULL
+    AND
+        (q.claimed_at IS NULL OR q.claimed_at < now() - make_interval(secs => $3))
+    AND NOT EXISTS (
+        SELECT 1 FROM job_queue o WHERE
+            o.payload->>'user_id' = q.payload->>'user_id'
+        AND
+            o.id < q.id
+        AND
+            o.claimed_at >= now() - make_interval(secs => $3)
+    )
+    ORDER BY id LIMIT $2 FOR UPDATE SKIP LOCKED
+)
+RETURNING id, payload, attempts;
+"""
+
+# Only the jobs still claimed by this worker, if the lease expired they may have been claimed by other
+DELETE_CLAIMED_JOBS_QUERY = """
+DELETE FROM job_queue WHERE id = ANY($1::int[]) AND claimed_by = $2 RETURNING id
+"""
+
+# The failed jobs keep their claim time so they're retried when the lease expires, meanwhile
+# the next jobs of the user wait for them. After the last attempt they're kept as failed.
+FAIL_CLAIMED_JOBS_QUERY = """
+UPDATE
     job_queue
-USING (
-    SELECT * FROM job_queue ORDER BY id FOR UPDATE SKIP LOCKED
-) q
-WHERE q.id = job_queue.id RETURNING job_queue.*;
+SET
+    attempts = attempts + 1,
+    error = $3,
+    claimed_by = NULL,
+    claimed_at = CASE WHEN attempts + 1 >= $4 THEN NULL ELSE claimed_at END,
+    failed_at = CASE WHEN attempts + 1 >= $4 THEN now() END
+WHERE id = ANY($1::int[]) AND claimed_by = $2
+RETURNING id, failed_at IS NOT NULL AS failed
+"""
+
+# The jobs skipped because an older job of the user failed, they can be claimed again at once
+RELEASE_CLAIMED_JOBS_QUERY = """
+UPDATE job_queue SET claimed_by = NULL, claimed_at = NULL WHERE id = ANY($1::int[]) AND claimed_by = $2 RETURNING id
+"""
+
+# Run out of the transaction that applies the jobs so the other workers see the new lease
+RENEW_CLAIMED_JOBS_QUERY = """
+UPDATE job_queue SET claimed_at = now() WHERE id = ANY($1::int[]) AND claimed_by = $2
+"""
+
+# Rows are loaded with COPY into a staging table and applied with one statement,
+# the table is dropped when the job transaction ends.
+CREATE_CIDR_STAGING = """
+CREATE TEMPORARY TABLE IF NOT EXISTS cidr_staging (
+    address TEXT NOT NULL,
+    list_id TEXT NOT NULL,
+    expires_at TIMESTAMPTZ NULL
+) ON COMMIT DROP;
+TRUNCATE cidr_staging;
 """
 
-UPSERT_CIDR = """
+# The same address can be staged twice for a list when existing rows overlap,
+# the row that expires later wins. Rows that don't change aren't rewritten.
+UPSERT_CIDRS_FROM_STAGING = """
 INSERT INTO cidr
     (address, list_id, expires_at)
-VALUES
-    ($1, $2, $3)
+SELECT DISTINCT ON (s.address::cidr, s.list_id)
+    s.address::cidr, s.list_id, s.expires_at
+FROM
+    cidr_staging s
+ORDER BY
+    s.address::cidr, s.list_id, s.expires_at DESC NULLS FIRST
 ON CONFLICT (address, list_id)
 DO
-    UPDATE SET expires_at = $3
+    UPDATE SET expires_at = EXCLUDED.expires_at
+    WHERE cidr.expires_at IS DISTINCT FROM EXCLUDED.expires_at
 """
 
+DELETE_CIDRS_FROM_STAGING = """
+DELETE FROM
+    cidr
+USING
+    cidr_staging s
+WHERE
+    cidr.address = s.address::cidr AND cidr.list_id = s.list_id
+"""
+
+SELECT_SAFE_CIDRS_BY_USER = """
+SELECT
+    address::text AS address
+FROM
+    cidr
+WHERE
+    list_id IN (
+            SELECT id FROM list WHERE
+                enabled = true
+            AND
+                list_type = 'SAFE'
+            AND
+                user_id = $1
+        )
+"""
 
 SELECT_ENABLED_CIDRS_BY_LIST_TYPE = """
 SELECT
-    address, list_id, expires_at
+    address::text AS address, list_id, expires_at
 FROM
     cidr
 WHERE
@@ -57,7 +161,7 @@ WHERE
 
 SELECT_ENABLED_CIDRS_BY_LIST_ID = """
 SELECT
-    address, list_id, expires_at
+    address::text AS address, list_id, expires_at
 FROM
     cidr
 WHERE
@@ -71,7 +175,7 @@ WHERE
 
 SELECT_ALL_CIDRS_BY_LIST_ID = """
 SELECT
-    address, list_id, expires_at
+    address::text AS address, list_id, expires_at
 FROM
     cidr
 WHERE
@@ -82,80 +186,147 @@ WHERE
 """
 
 
-async def parse_raw_cidrs(
-    cidrs: list[str], only_global: bool = True
-) -> tuple[Counter, set[IPv4Network], set[IPv6Network]]:
+async def _stage_cidrs(conn: Connection, records: list[tuple[str, str, datetime | None]]) -> None:
+    """Load ``(address, list_id, expires_at)`` records into an empty ``cidr_staging`` table."""
+    await conn.execute(CREATE_CIDR_STAGING)
+    await conn.copy_records_to_table("cidr_staging", records=records, columns=("address", "list_id", "expires_at"))
+    await conn.execute("ANALYZE cidr_staging")
+
+
+async def upsert_cidrs(conn: Connection, records: list[tuple[str, str, datetime | None]]) -> None:
+    """Insert ``(address, list_id, expires_at)`` records, updating ``expires_at`` if they exist.
+
+    The expiry task is notified of records with a TTL when the transaction commits.
+    """
+    if not records:
+        return
+    async with conn.transaction():
+        await _stage_cidrs(conn, records)
+        await conn.execute(UPSERT_CIDRS_FROM_STAGING)
+        if any(record[2] is not None for record in records):
+            await conn.execute("SELECT pg_notify($1, '')", CIDR_EXPIRY_CHANNEL)
+
+
+async def delete_cidr_rows(conn: Connection, records: list[tuple[str, str]]) -> None:
+    """Delete the rows matching the exact ``(address, list_id)`` records."""
+    if not records:
+        return
+    async with conn.transaction():
+        await _stage_cidrs(conn, [(address, list_id, None) for address, list_id in records])
+        await conn.execute(DELETE_CIDRS_FROM_STAGING)
+
+
+def parse_cidrs(cidrs: list[str], only_global: bool = True) -> tuple[Counter, CidrSet]:
     """Parse the initial list of CIDRs coming from a job.
 
-    1. Converts the str representation to an IPv4Network/IPv6Network object, filtering malformed
+    1. Converts the str representation to integers, filtering malformed
     2. Filters non routable/non global addresses if ``only_global`` is True
-    3. Splits IPv4Network and IPv6Network is two sets
-    4. Collapses the two sets
-    5. Returns a counter with the parsing information a set of IPv4Networks and another of IPv6Networks
+    3. Collapses the IPv4 and IPv6 networks
+    4. Returns a counter with the parsing information and a CidrSet with the networks
+
+    Big jobs use the vectorized path when numpy is installed, the result is the same.
     """
+    if HAS_NUMPY and len(cidrs) >= settings.JOB_VECTORIZED_PARSE_MIN_SIZE:
+        return parse_cidrs_vectorized(cidrs, only_global=only_global)
+
     result = Counter(total_job=0, malformed=0, non_global=0)
-    ipv4_cidrs: set[IPv4Network] = set()
-    ipv6_cidrs: set[IPv6Network] = set()
+    cidr_set = CidrSet()
 
     for cidr in cidrs:
         result["total_job"] += 1
         try:
-            ipn = ipaddress.ip_network(cidr)
-            if not ipn.is_global and only_global:
-                result["not_global"] += 1
-                continue
+            version, start, prefixlen = parse_cidr(cidr)
         except ValueError:
             result["malformed"] += 1
             continue
+        if only_global and not is_global_cidr(version, start, prefixlen):
+            result["not_global"] += 1
+            continue
+        cidr_set.add(version, start, prefixlen)
 
-        if ipn.version == 4:
-            ipv4_cidrs.add(ipn)
-        elif ipn.version == 6:
-            ipv6_cidrs.add(ipn)
-        else:
-            raise ValueError(f"Unknown IP Version {ipn.version}")
+    return result, cidr_set.collapse()
 
-    ipv4_cidrs = set(collapse_addresses(iter(ipv4_cidrs)))
-    ipv6_cidrs = set(collapse_addresses(iter(ipv6_cidrs)))
 
-    return result, ipv4_cidrs, ipv6_cidrs
+async def parse_raw_cidrs(cidrs: list[str], only_global: bool = True) -> tuple[Counter, CidrSet]:
+    """Run ``parse_cidrs`` in the process pool."""
+    return await run_cpu_bound(parse_cidrs, len(cidrs), cidrs, only_global=only_global)
+
+
+def parse_cidrs_to_add(cidrs: list[str]) -> tuple[Counter, CidrSet]:
+    """Run ``parse_cidrs`` removing the special addresses that should not touch the DB, like 0.0.0.0."""
+    result, parsed_cidrs = parse_cidrs(cidrs)
+    cidr_set = CidrSet()
+    for version, start, prefixlen in parsed_cidrs:
+        if prefixlen == 0:
+            continue
+        if version == 4 and start == 0:
+            continue
+        cidr_set.add(version, start, prefixlen)
+    return result, cidr_set
+
+
+def parse_safe_cidrs(addresses: list[str]) -> CidrSet:
+    """Parse and collapse the CIDRs of safe lists as returned by the DB."""
+    return CidrSet.from_strings(addresses).collapse()
+
+
+def exclude_from_addresses(addresses: list[str], exclusion_cidrs: CidrSet) -> list[tuple[int, list[str]]]:
+    """Exclude ``exclusion_cidrs`` from each of the ``addresses`` stored in the DB.
+
+    Returns the index of the addresses that changed with the subnets left of each one, which
+    may be none. Addresses not overlapping with ``exclusion_cidrs`` are not returned.
+    """
+    ranges_by_version: dict[int, list[tuple[int, tuple[int, int]]]] = {4: [], 6: []}
+    for index, address in enumerate(addresses):
+        version, start, prefixlen = parse_cidr(address)
+        ranges_by_version[version].append((index, cidr_range(version, start, prefixlen)))
+
+    changed = []
+    for version, ranges in ranges_by_version.items():
+        if not ranges:
+            continue
+        ranges_left = exclude_ranges_many(
+            base_ranges=[x[1] for x in ranges],
+            exclude_ranges=exclusion_cidrs.by_version(version).ranges(),
+        )
+        for (index, address_range), address_ranges_left in zip(ranges, ranges_left, strict=True):
+            if address_ranges_left != [address_range]:
+                changed.append((index, list(CidrArray.from_ranges(version, address_ranges_left).to_strings())))
+    return changed
 
 
 async def filter_safe_cidrs(
     conn: Connection,
     user_id: UUID,
-    cidrs: set[IPv4Network | IPv6Network],
-) -> tuple[set[IPv4Network], set[IPv6Network]]:
-    """Filter input ``cidrs`` that are present on enabled lists of type SAFE for ``user_id``."""
-    safe_cidrs = set()
-    for safe_cidr_record in await conn.fetch(
-        "select address from cidr where list_id in (select id from list where enabled = true and list_type = $1 and user_id = $2)",
-        ListTypeEnum.SAFE,
-        user_id,
-    ):
-        safe_cidrs.add(safe_cidr_record["address"])
-
-    safe_cidr_ipv4 = {x for x in safe_cidrs if x.version == 4}
-    safe_cidr_ipv6 = {x for x in safe_cidrs if x.version == 6}
-
-    deny_subnets = set()
-    for deny_cidr in cidrs:
-        for subnet in await address_exclude_many(
-            cidr=deny_cidr,
-            exclusion_cidrs=safe_cidr_ipv4 if deny_cidr.version == 4 else safe_cidr_ipv6,  # type: ignore
-        ):
-            deny_subnets.add(subnet)
-
-    return (
-        set(collapse_addresses(x for x in deny_subnets if x.version == 4)),
-        set(collapse_addresses(x for x in deny_subnets if x.version == 6)),
-    )
+    cidrs: CidrSet,
+    safe_cidrs_cache: dict[UUID, CidrSet] | None = None,
+    safe_lists_changed: bool = False,
+    get_enabled_cidrs: EnabledCidrsGetter | None = None,
+) -> CidrSet:
+    """Filter input ``cidrs`` that are present on enabled lists of type SAFE for ``user_id``.
+
+    The safe CIDRs come from ``get_enabled_cidrs`` if given, usually a cache of the process,
+    it only has committed changes so they're read from the DB if ``safe_lists_changed`` in
+    the current transaction or without it.
+    They're stored in ``safe_cidrs_cache`` if given, so they're loaded once per batch of jobs.
+    """
+    safe_cidrs = safe_cidrs_cache.get(user_id) if safe_cidrs_cache is not None else None
+    if safe_cidrs is None:
+        if safe_lists_changed or get_enabled_cidrs is None:
+            addresses = [record["address"] for record in await conn.fetch(SELECT_SAFE_CIDRS_BY_USER, user_id)]
+            safe_cidrs = await run_cpu_bound(parse_safe_cidrs, len(addresses), addresses)
+        else:
+            safe_cidrs = await get_enabled_cidrs(conn, user_id, ListTypeEnum.SAFE)
+        if safe_cidrs_cache is not None:
+            safe_cidrs_cache[user_id] = safe_cidrs
+    return await run_cpu_bound(cidrs.difference, len(cidrs) + len(safe_cidrs), safe_cidrs)
 
 
 async def delete_excluded_cidrs(
     conn: Connection,
     user_id: UUID,
-    exclusion_cidrs: set[IPv4Network | IPv6Network],
+    exclusion_cidrs: CidrSet,
+    snapshot_changes: SnapshotChanges,
     list_id: str | None = None,
     list_type: ListTypeEnum | None = None,
 ) -> None:
@@ -180,141 +351,230 @@ async def delete_excluded_cidrs(
     if not exclusion_record:
         return
 
-    exclusion_cidr_ipv4 = {x for x in exclusion_cidrs if x.version == 4}
-    exclusion_cidr_ipv6 = {x for x in exclusion_cidrs if x.version == 6}
-    new_subnets = []
-    to_delete = set()
-
-    for record in exclusion_record:
-        exclusion_cidr = ipaddress.ip_network(str(record["address"]))
-        exclusion_subnets = await address_exclude_many(
-            cidr=exclusion_cidr,
-            exclusion_cidrs=exclusion_cidr_ipv4 if exclusion_cidr.version == 4 else exclusion_cidr_ipv6,  # type: ignore
-        )
+    addresses = [record["address"] for record in exclusion_record]
+    changed = await run_cpu_bound(
+        exclude_from_addresses, len(addresses) + len(exclusion_cidrs), addresses, exclusion_cidrs
+    )
 
-        if len(exclusion_subnets) == 1:
-            subnet = exclusion_subnets.pop()
-            if subnet == exclusion_cidr:
-                # the same address has been returned so no filtering was needed, we
-                # upsert to update expires_at
-                new_subnets.append((subnet, record["list_id"], record["expires_at"]))
-            else:
-                # one subnet left which isn't the original, upsert the new and delete the old
-                to_delete.add((exclusion_cidr, record["list_id"]))
-                new_subnets.append((subnet, record["list_id"], record["expires_at"]))
-        else:
-            # either no subnets returned or many which means the original needs to be deleted
-            to_delete.add((exclusion_cidr, record["list_id"]))
-            for exc_subnet in exclusion_subnets:
-                new_subnets.append((exc_subnet, record["list_id"], record["expires_at"]))
+    # Records not changed aren't touched, the others are deleted and what is left of them inserted
+    to_delete = set()
+    new_subnets = []
+    for index, subnets in changed:
+        record = exclusion_record[index]
+        to_delete.add((record["address"], record["list_id"]))
+        new_subnets.extend((subnet, record["list_id"], record["expires_at"]) for subnet in subnets)
+    for changed_list_id in {x[1] for x in to_delete}:
+        snapshot_changes.exclude(changed_list_id, exclusion_cidrs)
 
     # Execute the queries
-    await conn.executemany("delete from cidr where address = $1 and list_id = $2", list(to_delete))
-    await conn.executemany(UPSERT_CIDR, new_subnets)
+    await delete_cidr_rows(conn, list(to_delete))
+    await upsert_cidrs(conn, new_subnets)
 
 
-async def add_cidrs(conn: Connection, cidr_job: CidrJob) -> None:
-    """Add the CIDRs included in the job."""
+async def add_cidrs(
+    conn: Connection,
+    cidr_job: CidrJob,
+    snapshot_changes: SnapshotChanges,
+    safe_cidrs_cache: dict[UUID, CidrSet] | None = None,
+    safe_lists_changed: bool = False,
+    get_enabled_cidrs: EnabledCidrsGetter | None = None,
+) -> None:
+    """Add the CIDRs included in the job, ``safe_lists_changed`` and ``get_enabled_cidrs`` as in ``filter_safe_cidrs``."""
     stime = time.perf_counter()
 
     # Initial parsing
-    result, ipv4_cidrs_parsed, ipv6_cidrs_parsed = await parse_raw_cidrs(cidrs=cidr_job.cidrs)
+    with WORKER_PHASE_SECONDS.time("parse"):
+        result, cidrs = await run_cpu_bound(parse_cidrs_to_add, len(cidr_job.cidrs), cidr_job.cidrs)
 
-    # Remove special addresses that should not touch the DB, like 0.0.0.0
-    ipv4_cidrs: set[IPv4Network] = set()
-    for c in ipv4_cidrs_parsed:
-        if c.prefixlen == 0:
-            continue
-        if c.compressed.split("/")[0] == "0.0.0.0":  # noqa: S104
-            continue
-        ipv4_cidrs.add(c)
-    ipv4_cidrs_parsed.clear()
-
-    ipv6_cidrs: set[IPv6Network] = set()
-    for c in ipv6_cidrs_parsed:
-        if c.prefixlen == 0:
-            continue
-        ipv6_cidrs.add(c)
-    ipv6_cidrs_parsed.clear()
-
-    if not ipv4_cidrs and not ipv6_cidrs:
+    if not cidrs:
         print(f"Add({cidr_job.list_type}): {result}")
         return
 
     if cidr_job.list_type == ListTypeEnum.DENY:
         # When adding CIDRs to a deny list, we only need to filter out CIDRs in current safe lists
-        ipv4_cidrs, ipv6_cidrs = await filter_safe_cidrs(
-            conn=conn, user_id=cidr_job.user_id, cidrs=ipv4_cidrs | ipv6_cidrs
-        )
+        with WORKER_PHASE_SECONDS.time("safe_filter"):
+            cidrs = await filter_safe_cidrs(
+                conn=conn,
+                user_id=cidr_job.user_id,
+                cidrs=cidrs,
+                safe_cidrs_cache=safe_cidrs_cache,
+                safe_lists_changed=safe_lists_changed,
+                get_enabled_cidrs=get_enabled_cidrs,
+            )
     else:
         # When adding CIDRs to a safe list, we must delete matching CIDRs in current deny lists
         # if the target safe list is enabled
         if cidr_job.list_enabled:
-            await delete_excluded_cidrs(
-                conn=conn,
-                user_id=cidr_job.user_id,
-                exclusion_cidrs=ipv4_cidrs | ipv6_cidrs,
-                list_type=ListTypeEnum.DENY,
-            )
-
-    sql_params = []
-    for cidr in ipv4_cidrs | ipv6_cidrs:
-        result["total_final"] += 1
-        expires_at = datetime.now(tz=timezone.utc) + timedelta(seconds=cidr_job.ttl) if cidr_job.ttl else None
-        sql_params.append((cidr, cidr_job.list_id, expires_at))
-
-    await conn.executemany(UPSERT_CIDR, sql_params)
+            with WORKER_PHASE_SECONDS.time("exclusion"):
+                await delete_excluded_cidrs(
+                    conn=conn,
+                    user_id=cidr_job.user_id,
+                    exclusion_cidrs=cidrs,
+                    snapshot_changes=snapshot_changes,
+                    list_type=ListTypeEnum.DENY,
+                )
+
+    expires_at = datetime.now(tz=timezone.utc) + timedelta(seconds=cidr_job.ttl) if cidr_job.ttl else None
+    sql_params = [(cidr, cidr_job.list_id, expires_at) for cidr in cidrs.to_strings()]
+    result["total_final"] += len(sql_params)
+
+    with WORKER_PHASE_SECONDS.time("upsert"):
+        await upsert_cidrs(conn, sql_params)
+    if sql_params:
+        snapshot_changes.add(cidr_job.list_id, cidrs)
     print(f"Add({cidr_job.list_type}): {result} - took {time.perf_counter() - stime} seconds")
 
 
-async def delete_cidrs(conn: Connection, cidr_job: CidrJob) -> None:
+async def delete_cidrs(conn: Connection, cidr_job: CidrJob, snapshot_changes: SnapshotChanges) -> None:
     """Delete the CIDRs included in the job."""
     stime = time.perf_counter()
 
     # Initial parsing
-    result, ipv4_cidrs, ipv6_cidrs = await parse_raw_cidrs(cidrs=cidr_job.cidrs, only_global=False)
-    if not ipv4_cidrs and not ipv6_cidrs:
+    with WORKER_PHASE_SECONDS.time("parse"):
+        result, cidrs = await parse_raw_cidrs(cidrs=cidr_job.cidrs, only_global=False)
+    if not cidrs:
         return
 
-    await delete_excluded_cidrs(
-        conn=conn, user_id=cidr_job.user_id, exclusion_cidrs=ipv4_cidrs | ipv6_cidrs, list_id=cidr_job.list_id
-    )
+    with WORKER_PHASE_SECONDS.time("exclusion"):
+        await delete_excluded_cidrs(
+            conn=conn,
+            user_id=cidr_job.user_id,
+            exclusion_cidrs=cidrs,
+            snapshot_changes=snapshot_changes,
+            list_id=cidr_job.list_id,
+        )
 
     print(f"Delete({cidr_job.list_type}): {result} - took {time.perf_counter() - stime} seconds")
 
 
-async def update_cleanup(conn: Connection, cidr_job: CidrJob) -> None:
+async def update_cleanup(conn: Connection, cidr_job: CidrJob, snapshot_changes: SnapshotChanges) -> None:
     """Do a CIDR cleanup from denylists when a safelist is re-enabled."""
     stime = time.perf_counter()
 
     if cidr_job.list_type != ListTypeEnum.SAFE:
         raise ValueError("update_cleanup() should only process safe lists.")
 
-    # This job doesn't actually carry the CIDRs from the safelist, we get them here
-    num_addresses = 0
-    all_addresses = set()
-    for record in await conn.fetch(SELECT_ENABLED_CIDRS_BY_LIST_ID, cidr_job.list_id):
-        num_addresses += 1
-        all_addresses.add(ip_network(record["address"]))
-    ipv4_collapsed = set(collapse_addresses(x for x in all_addresses if x.version == 4))
-    ipv6_collapsed = set(collapse_addresses(x for x in all_addresses if x.version == 6))
-
-    await delete_excluded_cidrs(
-        conn=conn,
-        user_id=cidr_job.user_id,
-        exclusion_cidrs=ipv4_collapsed | ipv6_collapsed,
-        list_type=ListTypeEnum.DENY,
+    # This job doesn't actually carry the CIDRs from the safelist, we get them here,
+    # there's no need to collapse them as the exclusion merges them anyway
+    addresses = [record["address"] for record in await conn.fetch(SELECT_ENABLED_CIDRS_BY_LIST_ID, cidr_job.list_id)]
+    all_addresses = await run_cpu_bound(CidrSet.from_strings, len(addresses), addresses)
+
+    with WORKER_PHASE_SECONDS.time("exclusion"):
+        await delete_excluded_cidrs(
+            conn=conn,
+            user_id=cidr_job.user_id,
+            exclusion_cidrs=all_addresses,
+            snapshot_changes=snapshot_changes,
+            list_type=ListTypeEnum.DENY,
+        )
+    print(
+        f"UpdateCleanup({cidr_job.list_type}): for {len(all_addresses)} cidrs took {time.perf_counter() - stime} seconds"
+    )
+
+
+def _job_group_key(cidr_job: CidrJob) -> tuple:
+    """Return the key of the jobs that can be merged into one."""
+    return (
+        cidr_job.user_id,
+        cidr_job.list_id,
+        cidr_job.list_type,
+        cidr_job.list_enabled,
+        cidr_job.action,
+        cidr_job.ttl,
     )
-    print(f"UpdateCleanup({cidr_job.list_type}): for {num_addresses} cidrs took {time.perf_counter() - stime} seconds")
+
+
+def _jobs_commute(cidr_job: CidrJob, other: CidrJob) -> bool:
+    """Return True if both jobs give the same result no matter the order they run.
+
+    Jobs of different users never touch the same lists, jobs of the same user
+    commute only if they change different deny lists, safe lists change deny lists.
+    """
+    if cidr_job.user_id != other.user_id:
+        return True
+    return cidr_job.list_id != other.list_id and cidr_job.list_type == other.list_type == ListTypeEnum.DENY
+
+
+def decode_jobs(records: list[Record]) -> tuple[list[Record], list[CidrJob], list[int]]:
+    """Decode the payload of the job ``records``.
+
+    Returns the records that could be decoded, their jobs and the ids of the ones that couldn't.
+    """
+    job_records: list[Record] = []
+    cidr_jobs: list[CidrJob] = []
+    invalid_ids: list[int] = []
+    for record in records:
+        try:
+            cidr_jobs.append(cidrjob_dec.decode(record["payload"]))
+            job_records.append(record)
+        except msgspec.DecodeError as err:
+            print(f"Invalid job {record['id']}: {err!r}")
+            invalid_ids.append(record["id"])
+    return job_records, cidr_jobs, invalid_ids
+
+
+def coalesce_job_groups(
+    cidr_jobs: list[CidrJob], isolated: frozenset[int] = frozenset()
+) -> list[tuple[CidrJob, list[int]]]:
+    """Merge the jobs with the same user, list, action and TTL into one job.
+
+    A job is merged into a previous group only if it commutes with every group of the
+    same user after it, so running the groups in order gives the same result as
+    running the jobs one by one. The jobs whose index is in ``isolated`` get a group
+    of their own. Returns each group with the indexes of its jobs.
+    """
+    groups: list[tuple[CidrJob, list[int]]] = []
+    groups_by_user: dict[UUID, list[int]] = defaultdict(list)
+
+    for job_index, cidr_job in enumerate(cidr_jobs):
+        key = _job_group_key(cidr_job)
+        user_groups = groups_by_user[cidr_job.user_id]
+        merged = False
+        for index in reversed(user_groups if job_index not in isolated else []):
+            group, indexes = groups[index]
+            if _job_group_key(group) == key and indexes[0] not in isolated:
+                group.cidrs.extend(cidr_job.cidrs)
+                indexes.append(job_index)
+                merged = True
+                break
+            if not _jobs_commute(group, cidr_job):
+                break
+
+        if not merged:
+            user_groups.append(len(groups))
+            groups.append((msgspec.structs.replace(cidr_job, cidrs=list(cidr_job.cidrs)), [job_index]))
+
+    return groups
+
+
+def coalesce_jobs(cidr_jobs: list[CidrJob]) -> list[CidrJob]:
+    """Merge the jobs as ``coalesce_job_groups`` without keeping their indexes."""
+    return [group for group, _ in coalesce_job_groups(cidr_jobs)]
+
+
+class LeaseLostError(Exception):
+    """The jobs being applied were claimed by another worker."""
 
 
 class CidrWorker:
     """Consumes the job queue that inserts and deletes CIDRs in/from lists."""
 
     keep_running: bool
-
-    def __init__(self) -> None:
+    worker_id: str
+    listen_conn: Connection | None
+    jobs_queued: asyncio.Event | None
+    dbmngr: DBManager
+    get_enabled_cidrs: EnabledCidrsGetter | None
+
+    def __init__(self, get_enabled_cidrs: EnabledCidrsGetter | None = None) -> None:
+        """Create the worker, ``get_enabled_cidrs`` gets the safe CIDRs as in ``filter_safe_cidrs``."""
         self.keep_running = True
+        self.get_enabled_cidrs = get_enabled_cidrs
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.listen_conn = None
+        self.jobs_queued = None
+        # the pool is created inside the loop that runs the worker, it may be another thread
+        self.dbmngr = DBManager(min_size=settings.DB_BG_POOL_MIN_SIZE, max_size=settings.DB_BG_POOL_MAX_SIZE)
 
     def stop(self) -> None:
         """Stop CidrWorker consume_loop."""
@@ -342,27 +602,212 @@ class CidrWorker:
 
         Mostly used for testing.
         """
-        await self._process_jobs()
+        await self.dbmngr.setup()
+        try:
+            await self._process_jobs()
+        finally:
+            await self.dbmngr.stop()
 
     async def _consume_loop(self) -> None:
-        """Consume jobs in a loop."""
+        """Consume jobs in a loop.
+
+        The loop wakes up as soon as a job is queued, polling every ``JOB_QUEUE_QUERY_INTERVAL``
+        seconds is only a fallback for lost notifications or when the listen connection is down.
+        """
+        self.jobs_queued = asyncio.Event()
+        await self.dbmngr.setup()
         try:
+            async with self.dbmngr.pool.acquire() as conn, conn.transaction():
+                await rebuild_missing_snapshots(conn)
             print(f"Starting CidrWorker.consume_loop() - {self.keep_running=}")
+            failed_attempts = 0
             while self.keep_running:
-                await self._process_jobs()
-                await asyncio.sleep(settings.JOB_QUEUE_QUERY_INTERVAL)
+                await self._listen()
+                self.jobs_queued.clear()
+                try:
+                    total_jobs = await self._process_jobs()
+                except CONNECTION_ERRORS as err:
+                    # the pool reconnects on the next acquire
+                    failed_attempts += 1
+                    delay = backoff_delay(failed_attempts)
+                    print(f"CidrWorker could not reach the DB ({err!r}), retrying in {delay} seconds ...")
+                    await asyncio.sleep(delay)
+                    continue
+                except Exception as err:  # noqa: BLE001
+                    # the failures of the jobs are handled in the batch, the loop keeps running anyway
+                    failed_attempts += 1
+                    delay = backoff_delay(failed_attempts)
+                    print(f"CidrWorker failed to process a batch ({err!r}), retrying in {delay} seconds ...")
+                    await asyncio.sleep(delay)
+                    continue
+                failed_attempts = 0
+                # There may be more jobs waiting when the batch was full
+                if total_jobs < settings.JOB_QUEUE_BATCH_SIZE:
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self.jobs_queued.wait(), timeout=settings.JOB_QUEUE_QUERY_INTERVAL)
         except KeyboardInterrupt:
             self.keep_running = False
-
-    async def _process_jobs(self) -> None:
-        """Process one batch of jobs."""
-        async for conn in get_connection():
-            async with conn.transaction():
-                for record in await conn.fetch(CONSUME_JOB_QUERY):
-                    cidr_job = cidrjob_dec.decode(record["payload"])
-                    if cidr_job.action == ActionEnum.ADD:
-                        await add_cidrs(conn=conn, cidr_job=cidr_job)
-                    elif cidr_job.action == ActionEnum.DELETE:
-                        await delete_cidrs(conn=conn, cidr_job=cidr_job)
-                    elif cidr_job.action == ActionEnum.UPDATE:
-                        await update_cleanup(conn=conn, cidr_job=cidr_job)
+        finally:
+            await self._unlisten()
+            await self.dbmngr.stop()
+
+    def _on_notification(self, *_: object) -> None:
+        """Wake up the consume loop."""
+        if self.jobs_queued is not None:
+            self.jobs_queued.set()
+
+    async def _listen(self) -> None:
+        """Open the connection that listens for new jobs, if it's not open already."""
+        if self.listen_conn is not None and not self.listen_conn.is_closed():
+            return
+        try:
+            self.listen_conn = await asyncpg.connect(dsn=dsn)
+            await self.listen_conn.add_listener(JOB_QUEUE_CHANNEL, self._on_notification)
+            # wake up to reconnect if the connection is lost
+            self.listen_conn.add_termination_listener(self._on_notification)
+        except CONNECTION_ERRORS as err:
+            print(f"CidrWorker could not listen for new jobs, polling instead: {err!r}")
+            await self._unlisten()
+
+    async def _unlisten(self) -> None:
+        """Close the connection that listens for new jobs."""
+        if self.listen_conn is not None:
+            self.listen_conn.terminate()
+            self.listen_conn = None
+
+    async def _claim_jobs(self, conn: Connection) -> list[Record]:
+        """Claim a batch of jobs for this worker, sorted by id."""
+        async with conn.transaction():
+            await conn.execute(CLAIM_JOBS_LOCK)
+            records = await conn.fetch(
+                CLAIM_JOBS_QUERY, self.worker_id, settings.JOB_QUEUE_BATCH_SIZE, settings.JOB_QUEUE_LEASE_SECONDS
+            )
+        return sorted(records, key=lambda x: x["id"])
+
+    async def _renew_lease(self, job_ids: list[int]) -> None:
+        """Renew the lease of the claimed jobs every third of ``JOB_QUEUE_LEASE_SECONDS`` until cancelled."""
+        while True:
+            await asyncio.sleep(settings.JOB_QUEUE_LEASE_SECONDS / 3)
+            try:
+                async with self.dbmngr.pool.acquire(timeout=settings.DB_POOL_ACQUIRE_CONN_TIMEOUT) as conn:
+                    await conn.execute(RENEW_CLAIMED_JOBS_QUERY, job_ids, self.worker_id)
+            except CONNECTION_ERRORS as err:
+                # the claim is checked before committing, the batch is rolled back if it was lost
+                print(f"CidrWorker could not renew the lease of {len(job_ids)} jobs: {err!r}")
+
+    async def _process_jobs(self) -> int:
+        """Process one batch of jobs, returning the number of jobs consumed.
+
+        The jobs are claimed in a short transaction and deleted in the same transaction
+        that applies them, if it fails they're retried when the lease expires. The lease
+        is renewed while the batch runs, if it's lost anyway the batch is rolled back so
+        the jobs are only applied by the worker that claimed them last.
+        Jobs to the same list are merged so a burst of small jobs runs like a single one,
+        and the safe lists of each user are loaded once per batch.
+        """
+        async with self.dbmngr.pool.acquire(timeout=settings.DB_POOL_ACQUIRE_CONN_TIMEOUT) as conn:
+            records = await self._claim_jobs(conn)
+            if not records:
+                return 0
+
+            job_ids = [record["id"] for record in records]
+            lease = asyncio.create_task(self._renew_lease(job_ids))
+            try:
+                await self._apply_jobs(conn, records)
+            except LeaseLostError as err:
+                print(f"CidrWorker rolled back a batch: {err}")
+                return 0
+            finally:
+                lease.cancel()
+            return len(records)
+
+    async def _apply_jobs(self, conn: Connection, records: list[Record]) -> None:
+        """Apply the claimed jobs and delete them in a single transaction.
+
+        Each group of merged jobs runs in a savepoint, if it fails only the group is rolled
+        back and its jobs are retried one by one when the lease expires, up to
+        ``JOB_QUEUE_MAX_ATTEMPTS`` times. The next jobs of the same user are left for the
+        next batches so the jobs of a user still run in order.
+        Raise ``LeaseLostError`` if any of them is no longer claimed by this worker, the
+        transaction is rolled back.
+        """
+        job_records, cidr_jobs, invalid_ids = decode_jobs(records)
+        isolated = frozenset(index for index, record in enumerate(job_records) if record["attempts"])
+        groups = coalesce_job_groups(cidr_jobs, isolated)
+        if len(groups) < len(job_records):
+            print(f"Merged {len(job_records)} jobs into {len(groups)}")
+
+        stime = time.perf_counter()
+        async with conn.transaction():
+            safe_cidrs_cache: dict[UUID, CidrSet] = {}
+            safe_changed_users: set[UUID] = set()
+            snapshot_changes = SnapshotChanges()
+            applied_ids: list[int] = []
+            skipped_ids: list[int] = []
+            # users with a job to retry, their next jobs wait for it
+            waiting_users: set[UUID] = set()
+            failed = (
+                await conn.fetch(FAIL_CLAIMED_JOBS_QUERY, invalid_ids, self.worker_id, "Invalid payload", 0)
+                if invalid_ids
+                else []
+            )
+            for cidr_job, indexes in groups:
+                job_ids = [job_records[index]["id"] for index in indexes]
+                if cidr_job.user_id in waiting_users:
+                    skipped_ids.extend(job_ids)
+                    continue
+                group_changes = SnapshotChanges()
+                try:
+                    async with conn.transaction():
+                        await self._apply_job(conn, cidr_job, group_changes, safe_cidrs_cache, safe_changed_users)
+                except CONNECTION_ERRORS:
+                    raise
+                except Exception as err:  # noqa: BLE001
+                    # the safe CIDRs read in the savepoint may include its rolled back changes
+                    safe_cidrs_cache.pop(cidr_job.user_id, None)
+                    safe_changed_users.add(cidr_job.user_id)
+                    group_failed = await conn.fetch(
+                        FAIL_CLAIMED_JOBS_QUERY, job_ids, self.worker_id, repr(err), settings.JOB_QUEUE_MAX_ATTEMPTS
+                    )
+                    if not all(record["failed"] for record in group_failed):
+                        waiting_users.add(cidr_job.user_id)
+                    failed.extend(group_failed)
+                    print(f"CidrWorker failed to apply the jobs {job_ids}: {err!r}")
+                    continue
+                snapshot_changes.extend(group_changes)
+                applied_ids.extend(job_ids)
+                if cidr_job.list_type == ListTypeEnum.SAFE:
+                    safe_cidrs_cache.pop(cidr_job.user_id, None)
+                    safe_changed_users.add(cidr_job.user_id)
+            with WORKER_PHASE_SECONDS.time("snapshot"):
+                await update_snapshots(conn, snapshot_changes)
+            deleted = await conn.fetch(DELETE_CLAIMED_JOBS_QUERY, applied_ids, self.worker_id)
+            released = await conn.fetch(RELEASE_CLAIMED_JOBS_QUERY, skipped_ids, self.worker_id) if skipped_ids else []
+            if (lost := len(records) - len(deleted) - len(released) - len(failed)) > 0:
+                raise LeaseLostError(f"{lost} of {len(records)} jobs claimed by another worker")
+        WORKER_BATCH_SECONDS.observe(time.perf_counter() - stime)
+        WORKER_JOBS.inc(amount=len(deleted))
+        WORKER_FAILED_JOBS.inc(amount=sum(record["failed"] for record in failed))
+
+    async def _apply_job(
+        self,
+        conn: Connection,
+        cidr_job: CidrJob,
+        snapshot_changes: SnapshotChanges,
+        safe_cidrs_cache: dict[UUID, CidrSet],
+        safe_changed_users: set[UUID],
+    ) -> None:
+        """Apply one group of merged jobs."""
+        if cidr_job.action == ActionEnum.ADD:
+            await add_cidrs(
+                conn=conn,
+                cidr_job=cidr_job,
+                snapshot_changes=snapshot_changes,
+                safe_cidrs_cache=safe_cidrs_cache,
+                safe_lists_changed=cidr_job.user_id in safe_changed_users,
+                get_enabled_cidrs=self.get_enabled_cidrs,
+            )
+        elif cidr_job.action == ActionEnum.DELETE:
+            await delete_cidrs(conn=conn, cidr_job=cidr_job, snapshot_changes=snapshot_changes)
+        elif cidr_job.action == ActionEnum.UPDATE:
+            await update_cleanup(conn=conn, cidr_job=cidr_job, snapshot_changes=snapshot_changes)
@@ -1,6 +1,7 @@
 from pathlib import Path
 
 from litestar import Litestar
+from litestar.config.compression import CompressionConfig
 from litestar.contrib.jinja import JinjaTemplateEngine
 from litestar.datastructures import ResponseHeader
 from litestar.di import Provide
@@ -11,11 +12,13 @@ from litestar.template.config import TemplateConfig
 
 from app.domain import routes
 from app.domain.auth.middleware import JWTAuthenticationMiddleware
+from app.domain.cidr.services import get_enabled_cidrs
 from app.lib.cli import CLIPlugin
 from app.lib.db.base import get_dbmanager
 from app.lib.db.migrations import run_migrations
 from app.lib.default_admin_user import create_default_admin_user
 from app.lib.exceptions import default_httpexception_handler
+from app.lib.metrics import metrics_middleware_factory
 from app.lib.openapi import openapi_config
 from app.lib.scheduled_tasks import Scheduler
 from app.lib.settings import get_settings
@@ -35,12 +38,13 @@ auth_mw = DefineMiddleware(
         "^/favicon.ico$",
         "^/login",
         "^/v1/auth",
+        "^/metrics$",
     ],
     exclude_http_methods=["OPTIONS"],
 )
 
 dbmngr = get_dbmanager()
-cidr_worker = CidrWorker()
+cidr_worker = CidrWorker(get_enabled_cidrs=get_enabled_cidrs)
 scheduler = Scheduler()
 
 
@@ -51,7 +55,10 @@ app = Litestar(
     response_headers=[ResponseHeader(name="Vary", value="Accept-Encoding", description="Default vary header")],
     exception_handlers={HTTPException: default_httpexception_handler},
     plugins=[CLIPlugin()],
-    middleware=[auth_mw],
+    middleware=[metrics_middleware_factory, auth_mw],
+    compression_config=CompressionConfig(
+        backend="gzip", minimum_size=settings.GZIP_MIN_SIZE, gzip_compress_level=settings.GZIP_COMPRESS_LEVEL
+    ),
     dependencies={"conn": Provide(dbmngr.get_connection)},
     on_startup=[dbmngr.setup, run_migrations, scheduler.run, create_default_admin_user],
     on_app_init=[],
@@ -1,9 +1,18 @@
 import asyncio
 
+from app.domain.cidr.services import get_enabled_cidrs
+from app.lib.metrics import start_http_server
+from app.lib.settings import get_settings
 from app.lib.worker import CidrWorker
 
+settings = get_settings()
+
 if __name__ == "__main__":
     print("Starting...")
-    cidr_worker = CidrWorker()
+    # the API serves the metrics of the worker only when it runs in the same process
+    if settings.METRICS_ENABLED and settings.WORKER_METRICS_PORT:
+        start_http_server(settings.WORKER_METRICS_HOST, settings.WORKER_METRICS_PORT, settings.METRICS_TOKEN)
+        print(f"Serving the metrics at {settings.WORKER_METRICS_HOST}:{settings.WORKER_METRICS_PORT}/metrics")
+    cidr_worker = CidrWorker(get_enabled_cidrs=get_enabled_cidrs)
     asyncio.run(cidr_worker.run())
     print("Finished...")
@@ -1,5 +1,7 @@
 import os
+import random
 import time
+from ipaddress import IPv4Network, IPv6Network, ip_network
 
 import pytest
 from litestar.status_codes import HTTP_200_OK
@@ -24,6 +26,18 @@ async def get_api_token_header(client):
     return {"Authorization": f"Bearer {response.json()['access_token']}"}
 
 
+def random_networks(version: int, total: int, min_prefixlen: int, seed: int) -> set[IPv4Network | IPv6Network]:
+    rnd = random.Random(seed)
+    bits = 32 if version == 4 else 128
+    base = 0x0B000000 if version == 4 else 0x2A000000 << 96
+    networks = set()
+    for _ in range(total):
+        prefixlen = rnd.randint(min_prefixlen, bits)
+        address = base + (rnd.getrandbits(bits - min_prefixlen + 4) << (bits - prefixlen) >> (bits - prefixlen))
+        networks.add(ip_network((address, prefixlen), strict=False))
+    return networks
+
+
 @pytest.fixture(scope="session")
 def test_client() -> AsyncTestClient:
     settings.JOB_QUEUE_QUERY_INTERVAL = 1
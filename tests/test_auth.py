@@ -1,8 +1,25 @@
+import threading
+from pathlib import Path
+
+import pytest
 from conftest import get_api_token_header
-from litestar.status_codes import HTTP_200_OK, HTTP_201_CREATED, HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED
+from litestar.exceptions import ServiceUnavailableException
+from litestar.status_codes import (
+    HTTP_200_OK,
+    HTTP_201_CREATED,
+    HTTP_204_NO_CONTENT,
+    HTTP_400_BAD_REQUEST,
+    HTTP_401_UNAUTHORIZED,
+    HTTP_403_FORBIDDEN,
+    HTTP_404_NOT_FOUND,
+)
 from litestar.testing import AsyncTestClient
 
+from app.domain.auth.middleware import get_auth_store, get_invalid_token_store
+from app.lib import authcrypt
+from app.lib.lru_store import BoundedFileStore, LRUMemoryStore
 from app.lib.settings import get_settings
+from app.lib.worker import CidrWorker
 
 settings = get_settings()
 
@@ -56,10 +73,19 @@ async def test_signup(test_client: AsyncTestClient) -> None:
         payload = {"login": "testc01", "password": "aaaaaaaaaAF40", "new_password": "aaaa0"}
         response = await client.put("/v1/auth/password", json=payload)
         assert response.status_code == HTTP_400_BAD_REQUEST
+        # A token issued before the password change
+        response = await client.post("/v1/auth/token", json={"login": "testc01", "password": "aaaaaaaaaAF40"})
+        assert response.status_code == HTTP_200_OK
+        old_token_header = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        response = await client.get("/v1/list", headers=old_token_header)
+        assert response.status_code == HTTP_200_OK
         # Correct new password
         payload = {"login": "testc01", "password": "aaaaaaaaaAF40", "new_password": "newPasssswordOK01"}
         response = await client.put("/v1/auth/password", json=payload)
         assert response.status_code == HTTP_200_OK
+        # The tokens issued before are revoked
+        response = await client.get("/v1/list", headers=old_token_header)
+        assert response.status_code == HTTP_401_UNAUTHORIZED
         # Login with the old password = 401
         payload = {"login": "testc01", "password": "aaaaaaaaaAF40"}
         response = await client.post("/v1/auth/token", json=payload, follow_redirects=False)
@@ -82,3 +108,188 @@ async def test_signup(test_client: AsyncTestClient) -> None:
         payload = {"login": "newuser001", "password": "abcdefgHij1"}
         response = await client.post("/v1/admin/signup", json=payload, headers=user_token_header)
         assert response.status_code == HTTP_401_UNAUTHORIZED
+
+
+async def test_password_hash_queue_limit(monkeypatch: pytest.MonkeyPatch) -> None:
+    salt, hashed_password = await authcrypt.generate_salt_and_hashed_password("abcdefgHij1")
+    assert await authcrypt.verify_password(salt, hashed_password, "abcdefgHij1")
+    assert not await authcrypt.verify_password(salt, hashed_password, "abcdefgHij2")
+
+    # the hashes waiting for a thread are over the limit
+    monkeypatch.setattr(authcrypt, "_password_slots", threading.BoundedSemaphore(1))
+    authcrypt._password_slots.acquire()
+    with pytest.raises(ServiceUnavailableException):
+        await authcrypt.verify_password(salt, hashed_password, "abcdefgHij1")
+
+
+async def test_lru_memory_store() -> None:
+    store = LRUMemoryStore(max_size=2)
+    await store.set("a", b"1", expires_in=60)
+    await store.set("b", b"2")
+    assert await store.get("a") == b"1"
+    # "b" is the least recently used
+    await store.set("c", "3")
+    assert len(store) == 2
+    assert await store.get("b") is None
+    assert await store.get("c") == b"3"
+    assert 0 < await store.expires_in("a") <= 60
+    await store.set("a", b"1", expires_in=0)
+    assert not await store.exists("a")
+
+
+async def test_bounded_file_store(tmp_path: Path) -> None:
+    store = BoundedFileStore(str(tmp_path), max_size=20)
+    for i in range(100):
+        await store.set(f"token{i}", b"user", expires_in=60)
+        assert len(list(tmp_path.iterdir())) <= 20 + 2
+    # the most recent values are kept
+    assert await store.get("token99") == b"user"
+    assert await store.get("token0") is None
+    # the expired values go first
+    await store.set("expired", b"user", expires_in=-1)
+    await store.prune()
+    assert not await store.exists("expired")
+
+
+async def test_invalid_token_store() -> None:
+    store, invalid_store = get_auth_store(), get_invalid_token_store()
+    assert invalid_store is not store
+    await store.set("valid", b"user", expires_in=60)
+    # a spray of invalid tokens doesn't evict the valid ones
+    for i in range(settings.AUTH_CACHE_INVALID_MAX_SIZE + 10):
+        await invalid_store.set(f"invalid{i}", b"", expires_in=60)
+    assert await store.get("valid") == b"user"
+    assert await invalid_store.get("invalid0") is None
+    await store.delete("valid")
+
+
+async def test_invalid_token(test_client: AsyncTestClient) -> None:
+    async with test_client as client:
+        # the second time the invalid token is rejected from the cache
+        for _ in range(2):
+            response = await client.get("/v1/list", headers={"Authorization": "Bearer not-a-token"})
+            assert response.status_code == HTTP_401_UNAUTHORIZED
+
+
+async def test_api_keys(test_client: AsyncTestClient) -> None:
+    async with test_client as client:
+        api_token_header = await get_api_token_header(client)
+
+        payload = {"name": "firewall agent", "read_only": True, "list_type": "DENY"}
+        response = await client.post("/v1/key", json=payload, headers=api_token_header)
+        assert response.status_code == HTTP_201_CREATED
+        api_key = response.json()
+        assert api_key["key"].startswith(api_key["key_prefix"])
+        api_key_header = {"Authorization": f"Bearer {api_key['key']}"}
+
+        response = await client.get("/v1/key", headers=api_token_header)
+        assert response.status_code == HTTP_200_OK
+        assert api_key["id"] in [x["id"] for x in response.json()]
+        assert all("key" not in x for x in response.json())
+
+        # the scopes of the key
+        response = await client.get("/v1/cidr/collapsed?list_type=DENY", headers=api_key_header)
+        assert response.status_code == HTTP_200_OK
+        response = await client.get("/v1/cidr/collapsed?list_type=SAFE", headers=api_key_header)
+        assert response.status_code == HTTP_403_FORBIDDEN
+        response = await client.post("/v1/list?list_type=DENY", json={"id": "TEST_API_KEY"}, headers=api_key_header)
+        assert response.status_code == HTTP_403_FORBIDDEN
+        response = await client.get("/v1/key", headers=api_key_header)
+        assert response.status_code == HTTP_403_FORBIDDEN
+
+        response = await client.delete(f"/v1/key/{api_key['id']}", headers=api_token_header)
+        assert response.status_code == HTTP_204_NO_CONTENT
+        response = await client.get("/v1/cidr/collapsed?list_type=DENY", headers=api_key_header)
+        assert response.status_code == HTTP_401_UNAUTHORIZED
+        response = await client.delete(f"/v1/key/{api_key['id']}", headers=api_token_header)
+        assert response.status_code == HTTP_404_NOT_FOUND
+
+
+async def test_api_key_admin(test_client: AsyncTestClient) -> None:
+    async with test_client as client:
+        api_token_header = await get_api_token_header(client)
+
+        # a key of a superuser without restrictions
+        payload = {"name": "automation", "read_only": False}
+        response = await client.post("/v1/key", json=payload, headers=api_token_header)
+        assert response.status_code == HTTP_201_CREATED
+        api_key = response.json()
+        api_key_header = {"Authorization": f"Bearer {api_key['key']}"}
+
+        response = await client.get("/v1/list", headers=api_key_header)
+        assert response.status_code == HTTP_200_OK
+        payload = {"login": "test_api_key_admin", "password": "abcdefgHij1"}
+        response = await client.post("/v1/admin/signup", json=payload, headers=api_key_header)
+        assert response.status_code == HTTP_403_FORBIDDEN
+        response = await client.post("/v1/key", json={"name": "other"}, headers=api_key_header)
+        assert response.status_code == HTTP_403_FORBIDDEN
+
+        response = await client.delete(f"/v1/key/{api_key['id']}", headers=api_token_header)
+        assert response.status_code == HTTP_204_NO_CONTENT
+
+
+async def test_api_key_list_type(test_client: AsyncTestClient) -> None:
+    async with test_client as client:
+        api_token_header = await get_api_token_header(client)
+        worker = CidrWorker()
+
+        deny_list = {"id": "TEST_API_KEY_DENY", "list_type": "DENY", "enabled": True}
+        safe_list = {"id": "TEST_API_KEY_SAFE", "list_type": "SAFE", "enabled": True}
+        for test_list in (deny_list, safe_list):
+            response = await client.post("/v1/list", json=test_list, headers=api_token_header)
+            assert response.status_code == HTTP_201_CREATED
+            payload = {"cidrs": ["81.2.69.0/24"]}
+            response = await client.post(f"/v1/list/{test_list['id']}/cidr/add", json=payload, headers=api_token_header)
+            assert response.status_code == HTTP_201_CREATED
+        await worker.run_once()
+
+        response = await client.post(
+            "/v1/key", json={"name": "deny agent", "list_type": "DENY"}, headers=api_token_header
+        )
+        assert response.status_code == HTTP_201_CREATED
+        api_key_header = {"Authorization": f"Bearer {response.json()['key']}"}
+
+        # the lists of the type of the key
+        response = await client.get("/v1/list", headers=api_key_header)
+        assert response.status_code == HTTP_200_OK
+        list_ids = [x["id"] for x in response.json()]
+        assert deny_list["id"] in list_ids
+        assert safe_list["id"] not in list_ids
+        response = await client.get(f"/v1/list/{deny_list['id']}/cidr", headers=api_key_header)
+        assert response.status_code == HTTP_200_OK
+        payload = {"cidrs": ["81.2.70.0/24"]}
+        response = await client.post(f"/v1/list/{deny_list['id']}/cidr/add", json=payload, headers=api_key_header)
+        assert response.status_code == HTTP_201_CREATED
+
+        # the lists of other types, even with the query parameter list_type of the key
+        safe_path = f"/v1/list/{safe_list['id']}"
+        for method, path, payload in (
+            ("GET", f"{safe_path}?list_type=DENY", None),
+            ("GET", f"{safe_path}/cidr?list_type=DENY", None),
+            ("POST", f"{safe_path}/cidr/add?list_type=DENY", {"cidrs": ["81.2.70.0/24"]}),
+            ("POST", f"{safe_path}/cidr/delete?list_type=DENY", {"cidrs": ["81.2.69.0/24"]}),
+            ("POST", f"{safe_path}/cidr/add/raw?list_type=DENY", {"cidrs": "81.2.70.0/24"}),
+            ("POST", f"{safe_path}/cidr/delete/raw?list_type=DENY", {"cidrs": "81.2.69.0/24"}),
+            ("PUT", f"{safe_path}?list_type=DENY", {"enabled": False}),
+            ("PUT", f"/v1/list/{deny_list['id']}?list_type=DENY", {"list_type": "SAFE"}),
+            ("DELETE", f"{safe_path}?list_type=DENY", None),
+            ("POST", "/v1/list?list_type=DENY", {"id": "TEST_API_KEY_SAFE2", "list_type": "SAFE"}),
+            ("GET", "/v1/cidr/collapsed?list_type=SAFE", None),
+            ("GET", "/v1/cidr/collapsed", None),
+        ):
+            response = await client.request(method, path, json=payload, headers=api_key_header)
+            assert response.status_code == HTTP_403_FORBIDDEN, (method, path)
+        response = await client.get(safe_path, headers=api_token_header)
+        assert response.status_code == HTTP_200_OK
+
+        # lookup and match only return the lists of the type of the key
+        response = await client.get("/v1/cidr/lookup?ip=81.2.69.1", headers=api_token_header)
+        assert {x["list_id"] for x in response.json()} >= {deny_list["id"], safe_list["id"]}
+        response = await client.get("/v1/cidr/lookup?ip=81.2.69.1", headers=api_key_header)
+        assert response.status_code == HTTP_200_OK
+        assert response.json()
+        assert {x["list_type"] for x in response.json()} == {"DENY"}
+        response = await client.post("/v1/cidr/match", json={"ips": ["81.2.69.1"]}, headers=api_key_header)
+        assert response.status_code == HTTP_200_OK
+        assert response.json()[0]["matches"]
+        assert {x["list_type"] for x in response.json()[0]["matches"]} == {"DENY"}
@@ -0,0 +1,64 @@
+import pytest
+from conftest import get_api_token_header
+from litestar.status_codes import HTTP_200_OK, HTTP_201_CREATED
+from litestar.testing import AsyncTestClient
+
+from app.domain.lists.schemas import ListTypeEnum
+from app.lib.worker import CidrWorker
+
+
+@pytest.mark.asyncio
+async def test_cidr_changes(test_client: AsyncTestClient) -> None:
+    async with test_client as client:
+        api_token_header = await get_api_token_header(client)
+        worker = CidrWorker()
+
+        # Create a Deny list
+        list_deny = {"enabled": True, "id": "TEST_CIDR_CHANGES_DENY1", "list_type": ListTypeEnum.DENY}
+        response = await client.post("/v1/list", json=list_deny, headers=api_token_header)
+        assert response.status_code == HTTP_201_CREATED
+        changes_url = f"/v1/cidr/changes?list_type={ListTypeEnum.DENY}&list_id={list_deny['id']}"
+
+        # 1. Without a cursor a resync is required
+        response = await client.get(changes_url, headers=api_token_header)
+        assert response.status_code == HTTP_200_OK
+        assert response.json()["resync_required"] is True
+        cursor = response.json()["cursor"]
+
+        # 2. Add CIDRs and get the changes since the cursor
+        payload = {"cidrs": ["78.0.1.0/24", "78.0.2.0/24"]}
+        response = await client.post(f"/v1/list/{list_deny['id']}/cidr/add", json=payload, headers=api_token_header)
+        assert response.status_code == HTTP_201_CREATED
+        await worker.run_once()
+
+        response = await client.get(f"{changes_url}&since={cursor}", headers=api_token_header)
+        assert response.status_code == HTTP_200_OK
+        assert response.json()["resync_required"] is False
+        changes = response.json()["changes"]
+        assert sorted(x["address"] for x in changes if x["change"] == "ADD") == payload["cidrs"]
+        cursor = response.json()["cursor"]
+
+        # 3. Delete a CIDR
+        payload = {"cidrs": ["78.0.2.0/24"]}
+        response = await client.post(f"/v1/list/{list_deny['id']}/cidr/delete", json=payload, headers=api_token_header)
+        assert response.status_code == HTTP_201_CREATED
+        await worker.run_once()
+
+        response = await client.get(f"{changes_url}&since={cursor}", headers=api_token_header)
+        assert response.status_code == HTTP_200_OK
+        changes = response.json()["changes"]
+        assert [(x["address"], x["change"]) for x in changes] == [("78.0.2.0/24", "DELETE")]
+        cursor = response.json()["cursor"]
+
+        # 4. Disabling the list requires a resync
+        list_deny["enabled"] = False
+        response = await client.put(f"/v1/list/{list_deny['id']}", json=list_deny, headers=api_token_header)
+        assert response.status_code == HTTP_200_OK
+        response = await client.get(f"{changes_url}&since={cursor}", headers=api_token_header)
+        assert response.status_code == HTTP_200_OK
+        assert response.json()["resync_required"] is True
+
+        # 5. A cursor older than the watermark requires a resync
+        response = await client.get(f"{changes_url}&since=0", headers=api_token_header)
+        assert response.status_code == HTTP_200_OK
+        assert response.json()["resync_required"] is True
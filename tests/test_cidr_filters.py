@@ -1,6 +1,6 @@
 import pytest
 from conftest import get_api_token_header
-from litestar.status_codes import HTTP_200_OK, HTTP_201_CREATED
+from litestar.status_codes import HTTP_200_OK, HTTP_201_CREATED, HTTP_400_BAD_REQUEST
 from litestar.testing import AsyncTestClient
 
 from app.domain.lists.schemas import ListTypeEnum
@@ -145,3 +145,51 @@ async def test_cidr_filters(test_client: AsyncTestClient) -> None:
         assert response.status_code == HTTP_200_OK
         assert len(response.json()) == 3
         assert sorted(response.json()) == sorted(safe_cidrs_payload_2["cidrs"])
+
+        # The streamed responses are the same as the regular ones
+        for url in (
+            f"/v1/cidr/?list_type={ListTypeEnum.SAFE}&tags=COMMON",
+            f"/v1/list/{list_safe_1['id']}/cidr",
+        ):
+            response = await client.get(url, headers=api_token_header)
+            assert response.status_code == HTTP_200_OK
+            response_stream = await client.get(
+                f"{url}{'&' if '?' in url else '?'}stream=true", headers=api_token_header
+            )
+            assert response_stream.status_code == HTTP_200_OK
+            # the rows are not ordered
+            data, data_stream = response.json(), response_stream.json()
+            if isinstance(data, dict):
+                cidrs, cidrs_stream = data.pop("cidrs"), data_stream.pop("cidrs")
+                assert data_stream == data
+                data, data_stream = cidrs, cidrs_stream
+            assert sorted(data_stream, key=lambda x: x["address"]) == sorted(data, key=lambda x: x["address"])
+
+        # Lookup the lists containing an IP, disabled lists are included
+        response = await client.get("/v1/cidr/lookup?ip=60.50.40.7", headers=api_token_header)
+        assert response.status_code == HTTP_200_OK
+        assert [(x["list_id"], x["address"]) for x in response.json()] == [(list_safe_2["id"], "60.50.40.0/24")]
+        response = await client.get("/v1/cidr/lookup?ip=60.50.40.300", headers=api_token_header)
+        assert response.status_code == HTTP_400_BAD_REQUEST
+
+        # Match a batch of IPs against the enabled lists
+        payload = {"ips": ["60.50.40.7", "8.8.8.8"]}
+        response = await client.post("/v1/cidr/match", json=payload, headers=api_token_header)
+        assert response.status_code == HTTP_200_OK
+        assert response.json()[0]["matches"] == [
+            {"list_id": list_safe_2["id"], "list_type": ListTypeEnum.SAFE, "address": "60.50.40.0/24"}
+        ]
+        assert response.json()[1] == {"ip": "8.8.8.8", "matches": []}
+        response = await client.post("/v1/cidr/match", json={"ips": ["60.50.40.0/24"]}, headers=api_token_header)
+        assert response.status_code == HTTP_400_BAD_REQUEST
+
+        # Overlaps of a network with the enabled lists of a type
+        response = await client.get(
+            f"/v1/cidr/overlaps?list_type={ListTypeEnum.SAFE}&cidr=60.50.0.0/16", headers=api_token_header
+        )
+        assert response.status_code == HTTP_200_OK
+        assert response.json() == [{"list_id": list_safe_2["id"], "address": "60.50.40.0/24"}]
+        response = await client.get(
+            f"/v1/cidr/overlaps?list_type={ListTypeEnum.SAFE}&cidr=60.50.40.7", headers=api_token_header
+        )
+        assert response.json() == [{"list_id": list_safe_2["id"], "address": "60.50.40.0/24"}]
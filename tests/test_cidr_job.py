@@ -1,19 +1,28 @@
 import ipaddress
+from typing import Any
 
 import pytest
+from asyncpg import Connection, Record
 from conftest import get_api_token_header
 from litestar.status_codes import HTTP_200_OK, HTTP_201_CREATED
 from litestar.testing import AsyncTestClient
 
+from app.domain.cidr.services import get_enabled_cidrs
 from app.domain.lists.schemas import ListTypeEnum
+from app.lib import worker as worker_module
+from app.lib.db.base import get_dbmanager
+from app.lib.settings import get_settings
 from app.lib.worker import CidrWorker
 
+settings = get_settings()
+
 
 @pytest.mark.asyncio
 async def test_job_tasks(test_client: AsyncTestClient) -> None:
     async with test_client as client:
         api_token_header = await get_api_token_header(client)
-        worker = CidrWorker()
+        # the safe CIDRs come from the in-memory tries of the process
+        worker = CidrWorker(get_enabled_cidrs=get_enabled_cidrs)
 
         # Deny list
         list_deny = {"enabled": True, "id": "TEST_CIDRJOB_DENY1", "list_type": ListTypeEnum.DENY}
@@ -319,3 +328,101 @@ async def test_job_tasks(test_client: AsyncTestClient) -> None:
         )
         assert response.status_code == HTTP_200_OK
         assert len(response.json()) == 0
+
+
+@pytest.mark.asyncio
+async def test_job_lease_lost(test_client: AsyncTestClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    async with test_client as client:
+        api_token_header = await get_api_token_header(client)
+        worker1, worker2 = CidrWorker(), CidrWorker()
+
+        list_deny = {"enabled": True, "id": "TEST_CIDRJOB_LEASE", "list_type": ListTypeEnum.DENY}
+        response = await client.post("/v1/list", json=list_deny, headers=api_token_header)
+        assert response.status_code == HTTP_201_CREATED
+        payload = {"cidrs": ["88.1.2.0/24"]}
+        response = await client.post(f"/v1/list/{list_deny['id']}/cidr/add", json=payload, headers=api_token_header)
+        assert response.status_code == HTTP_201_CREATED
+
+        claim_jobs = worker1._claim_jobs
+
+        async def claim_jobs_and_lose_lease(conn: Connection) -> list[Record]:
+            records = await claim_jobs(conn)
+            # the lease expires in the middle of the batch of the worker 1, the worker 2
+            # claims the job and applies it, then a newer job deletes the CIDR
+            async for api_conn in get_dbmanager().get_connection():
+                await api_conn.execute(
+                    "update job_queue set claimed_at = now() - interval '1 day' where id = any($1::int[])",
+                    [record["id"] for record in records],
+                )
+            await worker2.run_once()
+            response = await client.post(
+                f"/v1/list/{list_deny['id']}/cidr/delete", json=payload, headers=api_token_header
+            )
+            assert response.status_code == HTTP_201_CREATED
+            await worker2.run_once()
+            return records
+
+        monkeypatch.setattr(worker1, "_claim_jobs", claim_jobs_and_lose_lease)
+        await worker1.dbmngr.setup()
+        try:
+            # the batch of the worker 1 is rolled back, it would add the CIDR back
+            assert await worker1._process_jobs() == 0
+        finally:
+            await worker1.dbmngr.stop()
+
+        response = await client.get(
+            f"/v1/cidr/collapsed?list_type={ListTypeEnum.DENY}&list_id={list_deny['id']}", headers=api_token_header
+        )
+        assert response.status_code == HTTP_200_OK
+        assert response.json() == []
+
+
+@pytest.mark.asyncio
+async def test_job_failure(test_client: AsyncTestClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    async with test_client as client:
+        api_token_header = await get_api_token_header(client)
+        worker = CidrWorker()
+        monkeypatch.setattr(settings, "JOB_QUEUE_MAX_ATTEMPTS", 2)
+
+        lists = {}
+        for list_id in ("TEST_CIDRJOB_POISON", "TEST_CIDRJOB_HEALTHY"):
+            list_deny = {"enabled": True, "id": list_id, "list_type": ListTypeEnum.DENY}
+            response = await client.post("/v1/list", json=list_deny, headers=api_token_header)
+            assert response.status_code == HTTP_201_CREATED
+            lists[list_id] = list_deny
+
+        add_cidrs = worker_module.add_cidrs
+
+        async def add_cidrs_or_fail(**kwargs: Any) -> None:
+            if kwargs["cidr_job"].list_id == "TEST_CIDRJOB_POISON":
+                raise ValueError("poison job")
+            await add_cidrs(**kwargs)
+
+        monkeypatch.setattr(worker_module, "add_cidrs", add_cidrs_or_fail)
+
+        for list_id, cidr in (("TEST_CIDRJOB_POISON", "89.1.0.0/24"), ("TEST_CIDRJOB_HEALTHY", "89.2.0.0/24")):
+            payload = {"cidrs": [cidr]}
+            response = await client.post(f"/v1/list/{list_id}/cidr/add", json=payload, headers=api_token_header)
+            assert response.status_code == HTTP_201_CREATED
+
+        async def get_collapsed(list_id: str) -> list[str]:
+            response = await client.get(
+                f"/v1/cidr/collapsed?list_type={ListTypeEnum.DENY}&list_id={list_id}", headers=api_token_header
+            )
+            assert response.status_code == HTTP_200_OK
+            return response.json()
+
+        # the first attempt fails, the next job of the user waits for the retry
+        await worker.run_once()
+        assert await get_collapsed("TEST_CIDRJOB_HEALTHY") == []
+
+        # the last attempt fails too, the job is kept as failed and the others are applied
+        async for conn in get_dbmanager().get_connection():
+            await conn.execute("update job_queue set claimed_at = now() - interval '1 day' where failed_at is null")
+        await worker.run_once()
+        assert await get_collapsed("TEST_CIDRJOB_HEALTHY") == ["89.2.0.0/24"]
+        assert await get_collapsed("TEST_CIDRJOB_POISON") == []
+
+        async for conn in get_dbmanager().get_connection():
+            records = await conn.fetch("delete from job_queue where failed_at is not null returning attempts, error")
+        assert [(x["attempts"], x["error"]) for x in records] == [(2, "ValueError('poison job')")]
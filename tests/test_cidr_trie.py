@@ -0,0 +1,58 @@
+import ipaddress
+
+import pytest
+from conftest import random_networks
+
+from app.lib.cidr_trie import CidrTrie
+from app.lib.cidrset import CidrSet, parse_cidr
+
+
+@pytest.mark.parametrize("version", [4, 6])
+def test_cidr_trie(version: int) -> None:
+    min_prefixlen = 8 if version == 4 else 96
+    networks = [
+        (list_id, x.compressed)
+        for seed, list_id in enumerate(("LIST1", "LIST2"))
+        for x in random_networks(version=version, total=300, min_prefixlen=min_prefixlen, seed=seed)
+    ]
+    trie = CidrTrie.from_networks(networks)
+    assert trie.collapse() == CidrSet.from_strings([x[1] for x in networks]).collapse()
+
+    parsed = [(list_id, ipaddress.ip_network(network)) for list_id, network in networks]
+    for _, network in parsed[::25]:
+        for query in (network, network.supernet(4)):
+            found = {
+                (list_id, str(ipaddress.ip_network((start, prefixlen))))
+                for start, prefixlen, list_ids in trie.overlaps(*parse_cidr(query.compressed))
+                for list_id in list_ids
+            }
+            expected = {(list_id, str(x)) for list_id, x in parsed if x.overlaps(query)}
+            assert found == expected
+
+
+def test_cidr_trie_changes() -> None:
+    trie = CidrTrie()
+    changes = [
+        ("LIST1", "10.0.0.0/8", "ADD"),
+        ("LIST2", "10.0.0.0/8", "ADD"),
+        ("LIST1", "10.1.0.0/16", "ADD"),
+        ("LIST1", "10.0.0.0/8", "DELETE"),
+        ("LIST2", "2001:db8::/32", "ADD"),
+    ]
+    # replaying the changes gives the same trie
+    for _ in range(2):
+        trie.apply(changes)
+        assert len(trie) == 3
+        assert trie.containing(*parse_cidr("10.1.2.3")) == [
+            (0x0A010000, 16, ("LIST1",)),
+            (0x0A000000, 8, ("LIST2",)),
+        ]
+        assert trie.contained(*parse_cidr("10.0.0.0/8")) == [(0x0A010000, 16, ("LIST1",))]
+        assert list(trie.collapse().ipv4.to_strings()) == ["10.0.0.0/8"]
+
+    trie.apply([("LIST2", "10.0.0.0/8", "DELETE"), ("LIST2", "2001:db8::/32", "DELETE")])
+    assert len(trie) == 1
+    assert trie.contained(*parse_cidr("10.0.0.0/8")) == [(0x0A010000, 16, ("LIST1",))]
+    assert trie.containing(*parse_cidr("2001:db8::1")) == []
+    assert list(trie.collapse().ipv4.to_strings()) == ["10.1.0.0/16"]
+    assert not trie.remove("LIST2", *parse_cidr("10.0.0.0/8"))
@@ -32,7 +32,10 @@ async def test_cidr_ttl(test_client: AsyncTestClient) -> None:
         response = await client.post(f"/v1/list/{list_deny['id']}/cidr/add", json=payload, headers=api_token_header)
         assert response.status_code == HTTP_400_BAD_REQUEST
 
-        # 1. Add a CIDR with 10 TTL
+        # 1. Add a CIDR without TTL and an overlapping one with TTL
+        payload = {"cidrs": ["77.0.1.128/25"]}
+        response = await client.post(f"/v1/list/{list_deny['id']}/cidr/add", json=payload, headers=api_token_header)
+        assert response.status_code == HTTP_201_CREATED
         payload = {"cidrs": ["77.0.1.0/24"], "ttl": 7}
         response = await client.post(f"/v1/list/{list_deny['id']}/cidr/add", json=payload, headers=api_token_header)
         assert response.status_code == HTTP_201_CREATED
@@ -53,9 +56,9 @@ async def test_cidr_ttl(test_client: AsyncTestClient) -> None:
         await asyncio.sleep(payload["ttl"] + 1)
         await task_delete_expired.run_once()
 
-        # 5. Ensure the CIDR has been deleted
+        # 5. Ensure the CIDR has been deleted, the overlapping one is kept
         response = await client.get(
             f"/v1/cidr/collapsed?list_type={ListTypeEnum.DENY}&list_id={list_deny['id']}", headers=api_token_header
         )
         assert response.status_code == HTTP_200_OK
-        assert len(response.json()) == 0
+        assert response.json() == ["77.0.1.128/25"]
@@ -0,0 +1,150 @@
+import ipaddress
+
+import pytest
+from conftest import random_networks
+
+from app.lib.cidr_formats import decode_binary, encode_binary, format_cidrs
+from app.lib.cidrset import CidrArray, CidrSet, format_cidr, is_global_cidr, parse_cidr
+from app.lib.cidrset_numpy import parse_cidrs_vectorized
+from app.lib.iputils import address_exclude_many
+from app.lib.worker import parse_raw_cidrs
+
+PARSE_SAMPLES = [
+    "1.2.3.4",
+    "1.2.3.0/24",
+    "1.2.3.4/24",
+    "01.2.3.4",
+    "1.2.3.4/",
+    "1.2.3.4/33",
+    "1.2.3.4/024",
+    "1.2.3.0/255.255.255.0",
+    "256.1.1.1",
+    "1.2.3",
+    " 1.2.3.4",
+    "::",
+    "::/0",
+    "::1",
+    "::ffff:1.2.3.4",
+    "fe80::1%eth0",
+    "1::2::3",
+    "1:2:3:4:5:6:7::8",
+    "2001:DB8::/32",
+    "2c0f:fb50::/129",
+    "fasd::dsf:bf",
+    "",
+]
+
+
+@pytest.mark.parametrize("cidr", PARSE_SAMPLES)
+def test_parse_cidr(cidr: str) -> None:
+    try:
+        ipn = ipaddress.ip_network(cidr)
+    except ValueError:
+        with pytest.raises(ValueError):
+            parse_cidr(cidr)
+        return
+    assert parse_cidr(cidr) == (ipn.version, int(ipn.network_address), ipn.prefixlen)
+
+
+@pytest.mark.parametrize("version", [4, 6])
+def test_cidr_array(version: int) -> None:
+    min_prefixlen = 20 if version == 4 else 100
+    cidrs = random_networks(version=version, total=500, min_prefixlen=min_prefixlen, seed=3)
+    exclusion_cidrs = random_networks(version=version, total=500, min_prefixlen=min_prefixlen + 2, seed=4)
+    cidr_array = CidrArray.from_strings(version, (x.compressed for x in cidrs))
+    exclusion_array = CidrArray.from_strings(version, (x.compressed for x in exclusion_cidrs))
+
+    for ipn in cidrs | exclusion_cidrs:
+        args = (ipn.version, int(ipn.network_address), ipn.prefixlen)
+        assert format_cidr(*args) == ipn.compressed
+        assert is_global_cidr(*args) == ipn.is_global
+
+    collapsed = [x.compressed for x in ipaddress.collapse_addresses(cidrs)]
+    assert list(cidr_array.collapse().to_strings()) == collapsed
+
+    union = [x.compressed for x in ipaddress.collapse_addresses(cidrs | exclusion_cidrs)]
+    assert list(cidr_array.union(exclusion_array).to_strings()) == union
+
+    left = set().union(*(address_exclude_many(cidr=x, exclusion_cidrs=exclusion_cidrs) for x in cidrs))
+    difference = [x.compressed for x in ipaddress.collapse_addresses(left)]
+    assert list(cidr_array.difference(exclusion_array).to_strings()) == difference
+
+
+def test_cidr_set() -> None:
+    cidr_set = CidrSet.from_strings(["2001:db8::/33", "10.0.0.0/24", "2001:db8:8000::/33", "10.0.1.0/24"])
+    assert len(cidr_set) == 4
+    assert list(cidr_set.collapse().to_strings()) == ["10.0.0.0/23", "2001:db8::/32"]
+
+    exclusion = CidrSet.from_strings(["10.0.0.128/25", "2001:db8::/34"])
+    assert list(cidr_set.difference(exclusion).to_strings()) == [
+        "10.0.0.0/25",
+        "10.0.1.0/24",
+        "2001:db8:4000::/34",
+        "2001:db8:8000::/33",
+    ]
+    with pytest.raises(ValueError):
+        CidrSet.from_strings(["10.0.0.1/24"])
+
+
+@pytest.mark.parametrize("only_global", [True, False])
+async def test_parse_cidrs_vectorized(only_global: bool) -> None:
+    pytest.importorskip("numpy")
+    cidrs = [
+        x.compressed
+        for version, min_prefixlen in ((4, 16), (6, 96))
+        for x in random_networks(version=version, total=2000, min_prefixlen=min_prefixlen, seed=5)
+    ]
+    cidrs += [*PARSE_SAMPLES, "10.0.0.0/8", "0.0.0.0/0", "1.2.3.4\x00", "1.2.3.4/32/", "255.255.255.255"]
+    # long strings are parsed apart, the array of the rest stays narrow
+    cidrs += ["1.2.3.4" + " " * 20_000, "1" * 20_000, "2001:db8:0:0:0:0:0:0/128"]
+    assert parse_cidrs_vectorized(cidrs, only_global=only_global) == await parse_raw_cidrs(
+        cidrs, only_global=only_global
+    )
+
+
+@pytest.mark.parametrize("version", [4, 6])
+def test_cidr_array_bytes(version: int) -> None:
+    cidrs = random_networks(version=version, total=200, min_prefixlen=8, seed=6)
+    cidr_array = CidrArray.from_strings(version, (x.compressed for x in cidrs))
+    data = cidr_array.to_bytes()
+    assert len(data) == len(cidrs) * (5 if version == 4 else 17)
+    assert CidrArray.from_bytes(version, data) == cidr_array
+    assert CidrArray.from_bytes(version, b"") == CidrArray(version)
+    with pytest.raises(ValueError):
+        CidrArray.from_bytes(version, data[:-1])
+
+
+def test_format_cidrs() -> None:
+    cidr_set = CidrSet.from_strings(["10.0.0.0/24", "2001:db8::/32", "10.0.1.0/24", "1.2.3.4/32"]).collapse()
+
+    def formatted(cidr_format: str, **kwargs) -> list[str]:
+        return b"".join(format_cidrs(cidr_set, cidr_format, "deny", **kwargs)).decode().splitlines()
+
+    assert formatted("text") == ["1.2.3.4/32", "10.0.0.0/23", "2001:db8::/32"]
+    assert formatted("nginx") == ["deny 1.2.3.4/32;", "deny 10.0.0.0/23;", "deny 2001:db8::/32;"]
+    assert formatted("nginx", allow=True)[0] == "allow 1.2.3.4/32;"
+    assert formatted("csv") == ["cidr,ip_version", "1.2.3.4/32,4", "10.0.0.0/23,4", "2001:db8::/32,6"]
+    assert formatted("ipset")[1:4] == ["flush deny_v4", "add deny_v4 1.2.3.4/32", "add deny_v4 10.0.0.0/23"]
+    assert formatted("ipset")[-1] == "add deny_v6 2001:db8::/32"
+    assert formatted("nft")[2] == "add element inet filter deny_v4 { 1.2.3.4/32, 10.0.0.0/23 }"
+    with pytest.raises(ValueError):
+        formatted("xml")
+
+
+@pytest.mark.parametrize("ipv4_total", [0, 1, 8, 200])
+def test_binary_format(ipv4_total: int) -> None:
+    cidr_set = CidrSet(
+        CidrArray.from_strings(
+            4, (x.compressed for x in random_networks(version=4, total=ipv4_total, min_prefixlen=8, seed=7))
+        ),
+        CidrArray.from_strings(
+            6, (x.compressed for x in random_networks(version=6, total=100, min_prefixlen=32, seed=8))
+        ),
+    )
+    data = encode_binary(cidr_set)
+    assert (len(data) - len(cidr_set.ipv6) * 17) % 8 == 0  # the IPv6 arrays are aligned
+    assert decode_binary(data) == cidr_set
+    with pytest.raises(ValueError):
+        decode_binary(data[:-1])
+    with pytest.raises(ValueError):
+        decode_binary(b"JSON" + data[4:])
@@ -0,0 +1,19 @@
+from litestar.testing import RequestFactory
+
+from app.lib.etag import etag_matches, make_etag
+
+
+def test_etag_matches() -> None:
+    etag = make_etag("cidrs", 1)
+    assert etag.startswith('W/"')
+    assert etag != make_etag("cidrs", 2)
+
+    def request(if_none_match: str | None):
+        return RequestFactory().get("/", headers={"If-None-Match": if_none_match} if if_none_match else None)
+
+    assert not etag_matches(request(None), etag)
+    assert etag_matches(request(etag), etag)
+    assert etag_matches(request(etag.removeprefix("W/")), etag)
+    assert etag_matches(request(f'"other", {etag}'), etag)
+    assert etag_matches(request("*"), etag)
+    assert not etag_matches(request(make_etag("cidrs", 2)), etag)
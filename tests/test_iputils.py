@@ -0,0 +1,13 @@
+from app.lib.iputils import exclude_ranges_many, merge_ranges
+
+
+def test_merge_ranges() -> None:
+    assert merge_ranges([(10, 20), (0, 5), (6, 8), (15, 30), (40, 40)]) == [(0, 8), (10, 30), (40, 40)]
+    assert merge_ranges([]) == []
+
+
+def test_exclude_ranges_many() -> None:
+    base = [(0, 100), (50, 60), (200, 300), (10, 10)]
+    exclude = [(55, 70), (0, 9), (250, 400), (11, 11)]
+    assert exclude_ranges_many(base, exclude) == [[(10, 10), (12, 54), (71, 100)], [(50, 54)], [(200, 249)], [(10, 10)]]
+    assert exclude_ranges_many(base, []) == [[x] for x in base]
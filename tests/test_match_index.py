@@ -0,0 +1,37 @@
+import ipaddress
+import random
+
+import pytest
+from conftest import random_networks
+
+from app.lib.match_index import MatchIndex, parse_ip, parse_networks
+
+
+@pytest.mark.parametrize("version", [4, 6])
+def test_match_index(version: int) -> None:
+    min_prefixlen = 8 if version == 4 else 96
+    networks = [
+        (list_id, "DENY", x.compressed)
+        for seed, list_id in enumerate(("LIST1", "LIST2", "LIST3"))
+        for x in random_networks(version=version, total=300, min_prefixlen=min_prefixlen, seed=seed)
+    ]
+    index = MatchIndex(parse_networks(networks))
+
+    rnd = random.Random(9)
+    parsed = [(ipaddress.ip_network(x[2]), x) for x in networks]
+    ips = [x[0].network_address + rnd.randint(0, x[0].num_addresses - 1) for x in rnd.sample(parsed, 100)]
+    ips += [
+        ipaddress.ip_network(networks[0][2]).network_address - 1,
+        ipaddress.ip_address("0.0.0.0" if version == 4 else "::"),
+    ]
+    for ip in ips:
+        expected = tuple(sorted(x for ipn, x in parsed if ip in ipn))
+        assert index.match(*parse_ip(str(ip))) == expected
+
+
+def test_parse_ip() -> None:
+    assert parse_ip(" 1.2.3.4 ") == (4, 0x01020304)
+    assert parse_ip("::1") == (6, 1)
+    for ip in ("1.2.3.0/24", "1.2.3", "::/0"):
+        with pytest.raises(ValueError):
+            parse_ip(ip)
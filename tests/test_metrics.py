@@ -0,0 +1,117 @@
+import urllib.error
+import urllib.request
+
+import pytest
+from conftest import get_api_token_header
+from litestar.status_codes import HTTP_200_OK, HTTP_201_CREATED, HTTP_401_UNAUTHORIZED, HTTP_404_NOT_FOUND
+from litestar.testing import AsyncTestClient
+
+from app.lib.metrics import Counter, Histogram, Registry, start_http_server
+from app.lib.settings import get_settings
+from app.lib.worker import CidrWorker
+
+settings = get_settings()
+
+
+async def test_registry() -> None:
+    registry = Registry()
+    requests = registry.register(Histogram("requests_seconds", "Requests.", ("route",), buckets=(0.1, 1)))
+    jobs = registry.register(Counter("jobs_total", "Jobs."))
+    requests.observe(0.05, "/a")
+    requests.observe(0.5, "/a")
+    requests.observe(5, "/a")
+    jobs.inc(amount=3)
+    with pytest.raises(ValueError):
+        requests.observe(1)
+    with pytest.raises(ValueError):
+        registry.register(Counter("jobs_total", "Jobs."))
+
+    lines = registry.render().decode().splitlines()
+    assert lines == [
+        "# HELP requests_seconds Requests.",
+        "# TYPE requests_seconds histogram",
+        'requests_seconds_bucket{route="/a",le="0.1"} 1',
+        'requests_seconds_bucket{route="/a",le="1"} 2',
+        'requests_seconds_bucket{route="/a",le="+Inf"} 3',
+        'requests_seconds_sum{route="/a"} 5.55',
+        'requests_seconds_count{route="/a"} 3',
+        "# HELP jobs_total Jobs.",
+        "# TYPE jobs_total counter",
+        "jobs_total 3",
+    ]
+
+
+async def test_metrics(test_client: AsyncTestClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    async with test_client as client:
+        headers = await get_api_token_header(client)
+        response = await client.get("/v1/list", headers=headers)
+        assert response.status_code == HTTP_200_OK
+
+        response = await client.get("/metrics")
+        assert response.status_code == HTTP_401_UNAUTHORIZED
+
+        monkeypatch.setattr(settings, "METRICS_TOKEN", "metrics")
+        response = await client.get("/metrics")
+        assert response.status_code == HTTP_401_UNAUTHORIZED
+        response = await client.get("/metrics", headers={"Authorization": "Bearer other"})
+        assert response.status_code == HTTP_401_UNAUTHORIZED
+        response = await client.get("/metrics", headers={"Authorization": "Bearer metrics"})
+        assert response.status_code == HTTP_200_OK
+        assert response.headers["content-type"].startswith("text/plain")
+        assert 'http_request_duration_seconds_count{method="GET",route="/v1/list",status="200"}' in response.text
+        assert "db_pool_acquire_seconds_count" in response.text
+        assert "job_queue_depth " in response.text
+
+
+def scrape(port: int, path: str = "/metrics", token: str | None = None) -> tuple[int, str]:
+    request = urllib.request.Request(f"http://127.0.0.1:{port}{path}")
+    if token:
+        request.add_header("Authorization", f"Bearer {token}")
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as err:
+        return err.code, ""
+
+
+async def test_metrics_server() -> None:
+    for token in (None, "metrics"):
+        server = start_http_server("127.0.0.1", 0, token)
+        port = server.server_address[1]
+        try:
+            assert scrape(port)[0] == HTTP_401_UNAUTHORIZED
+            assert scrape(port, token="other")[0] == HTTP_401_UNAUTHORIZED
+            assert scrape(port, path="/other", token=token)[0] == HTTP_404_NOT_FOUND
+            if token:
+                status, text = scrape(port, token=token)
+                assert status == HTTP_200_OK
+                assert "# TYPE worker_phase_duration_seconds histogram" in text
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+async def test_worker_metrics(test_client: AsyncTestClient) -> None:
+    async with test_client as client:
+        headers = await get_api_token_header(client)
+        test_list = {"enabled": True, "id": "TEST_WORKER_METRICS", "list_type": "DENY"}
+        response = await client.post("/v1/list", json=test_list, headers=headers)
+        assert response.status_code == HTTP_201_CREATED
+        response = await client.post(
+            f"/v1/list/{test_list['id']}/cidr/add", json={"cidrs": ["90.1.0.0/24"]}, headers=headers
+        )
+        assert response.status_code == HTTP_201_CREATED
+        await CidrWorker().run_once()
+
+        # the worker running on its own serves its metrics, the API doesn't see them
+        server = start_http_server("127.0.0.1", 0, "metrics")
+        try:
+            status, text = scrape(server.server_address[1], token="metrics")
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert status == HTTP_200_OK
+        for phase in ("parse", "safe_filter", "upsert", "snapshot"):
+            assert f'worker_phase_duration_seconds_count{{phase="{phase}"}}' in text
+        assert "worker_batch_duration_seconds_count " in text
+        assert "worker_jobs_total " in text
@@ -0,0 +1,95 @@
+import uuid
+from collections import OrderedDict
+
+import pytest
+
+from app.domain.cidr import services
+from app.domain.lists.schemas import ActionEnum, CidrJob, ListTypeEnum
+from app.lib.cidrset import CidrSet
+from app.lib.snapshots import apply_snapshot_changes, build_snapshot, decode_snapshot
+from app.lib.worker import coalesce_job_groups, coalesce_jobs
+
+
+def make_job(
+    user_id: uuid.UUID, list_id: str, list_type: ListTypeEnum, action: ActionEnum, cidrs: list[str]
+) -> CidrJob:
+    return CidrJob(list_id=list_id, list_type=list_type, list_enabled=True, user_id=user_id, action=action, cidrs=cidrs)
+
+
+def test_coalesce_jobs() -> None:
+    user1, user2 = uuid.uuid4(), uuid.uuid4()
+    deny, add, delete = ListTypeEnum.DENY, ActionEnum.ADD, ActionEnum.DELETE
+    jobs = [
+        make_job(user1, "DENY1", deny, add, ["1.1.1.1"]),
+        make_job(user2, "DENY3", deny, add, ["3.3.3.3"]),
+        make_job(user1, "DENY2", deny, add, ["2.2.2.2"]),
+        make_job(user1, "DENY1", deny, add, ["1.1.1.2"]),
+        make_job(user2, "DENY3", deny, add, ["3.3.3.4"]),
+        make_job(user1, "DENY1", deny, delete, ["1.1.1.1"]),
+        make_job(user1, "DENY1", deny, add, ["1.1.1.3"]),
+        make_job(user1, "SAFE1", ListTypeEnum.SAFE, add, ["2.2.2.2"]),
+        make_job(user1, "DENY2", deny, add, ["2.2.2.3"]),
+    ]
+    groups = coalesce_jobs(jobs)
+    assert [(x.list_id, x.action, x.cidrs) for x in groups] == [
+        ("DENY1", add, ["1.1.1.1", "1.1.1.2"]),
+        ("DENY3", add, ["3.3.3.3", "3.3.3.4"]),
+        ("DENY2", add, ["2.2.2.2"]),
+        ("DENY1", delete, ["1.1.1.1"]),
+        ("DENY1", add, ["1.1.1.3"]),
+        ("SAFE1", add, ["2.2.2.2"]),
+        ("DENY2", add, ["2.2.2.3"]),
+    ]
+    # the original jobs are not modified
+    assert jobs[0].cidrs == ["1.1.1.1"]
+
+    # the jobs retried after a failure run alone, the others aren't merged into them
+    groups = coalesce_job_groups(jobs, isolated=frozenset((1,)))
+    assert [(x.list_id, x.action, indexes) for x, indexes in groups] == [
+        ("DENY1", add, [0, 3]),
+        ("DENY3", add, [1]),
+        ("DENY2", add, [2]),
+        ("DENY3", add, [4]),
+        ("DENY1", delete, [5]),
+        ("DENY1", add, [6]),
+        ("SAFE1", add, [7]),
+        ("DENY2", add, [8]),
+    ]
+
+
+def test_apply_snapshot_changes() -> None:
+    rows = ["10.0.0.0/24", "10.0.1.0/24", "10.0.0.128/25", "2001:db8::/32"]
+    snapshot = build_snapshot(rows)
+    assert list(decode_snapshot(*snapshot).to_strings()) == ["10.0.0.0/23", "2001:db8::/32"]
+
+    changes = [
+        (True, CidrSet.from_strings(["10.0.2.0/23", "2001:db9::/32"])),
+        (False, CidrSet.from_strings(["10.0.1.0/24", "2001:db8::/33"])),
+    ]
+    assert list(decode_snapshot(*apply_snapshot_changes(*snapshot, changes)).to_strings()) == [
+        "10.0.0.0/24",
+        "10.0.2.0/23",
+        "2001:db8:8000::/33",
+        "2001:db9::/32",
+    ]
+
+
+async def test_collapsed_cache(monkeypatch: pytest.MonkeyPatch) -> None:
+    snapshots = {
+        "BIG": build_snapshot([f"10.0.{i}.0/32" for i in range(0, 256, 2)]),
+        "SMALL1": build_snapshot(["1.1.1.1"]),
+        "SMALL2": build_snapshot(["2.2.2.2"]),
+    }
+
+    class SnapshotConnection:
+        async def fetch(self, query: str, list_ids: list[str]) -> list[dict]:
+            return [{"list_id": x, "version": 1, "ipv4": snapshots[x][0], "ipv6": snapshots[x][1]} for x in list_ids]
+
+    monkeypatch.setattr(services, "_collapsed_cache", OrderedDict())
+    monkeypatch.setattr(services.settings, "SNAPSHOT_CACHE_MAX_NETWORKS", 129)
+    for list_id in ("SMALL1", "SMALL2", "BIG"):
+        _, collapsed = await services.get_collapsed_cidrs(SnapshotConnection(), [{"list_id": list_id, "version": 1}])
+        assert collapsed.strings()[0]
+    # the big snapshot evicts the least recently used ones until the networks fit
+    assert list(services._collapsed_cache) == [(("SMALL2", 1),), (("BIG", 1),)]
+    assert sum(len(x.cidrs) for x in services._collapsed_cache.values()) == 129